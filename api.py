@@ -0,0 +1,298 @@
+"""Versioned JSON admin API mounted at ``/api/v1``.
+
+GET responses carry an ``ETag`` derived from the inventory version, so
+pollers sending ``If-None-Match`` get a ``304`` without a payload while
+nothing changed. Write endpoints change a single card, category or config
+block and accept ``If-Match`` to reject edits made against a stale view.
+"""
+from functools import wraps
+import logging
+
+from flask import (
+    Blueprint,
+    Response,
+    abort,
+    jsonify,
+    make_response,
+    request,
+    session,
+    stream_with_context,
+)
+from werkzeug.local import LocalProxy
+
+from batch_ingest import batches
+import catalog_io
+from image_store import images
+from partitions import partitions
+
+logger = logging.getLogger(__name__)
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+def current_store():
+    """Inventory of the guild picked in the admin session; see partitions.py."""
+    return partitions.get(session.get('guild_id'))
+
+
+# Shared with app.py. Work outliving the request gets ``current_store()`` instead.
+store = LocalProxy(current_store)
+
+PER_PAGE = 50
+MAX_PER_PAGE = 200
+
+CARD_FIELDS = ('name', 'front', 'back')
+CATEGORY_FIELDS = ('name',)
+SECTION_FIELDS = {
+    'embed': ('title', 'description', 'button_label', 'color', 'thumbnail', 'image', 'footer'),
+    'settings': ('inventory_channel_id', 'claims_channel_id', 'image_channel_id', 'grid_size'),
+}
+
+
+def require_api_login(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not session.get('logged_in'):
+            logger.debug('Unauthorized API request to %s', request.path)
+            return jsonify(error='login required'), 401
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+def current_etag():
+    """ETag of :data:`store`; partitions at the same version still get different ones."""
+    key = partitions.key(session.get('guild_id'))
+    return store.etag() if key is None else f'{key}-{store.etag()}'
+
+
+def cached(func):
+    """Answer ``If-None-Match`` with 304 before building the payload."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        etag = current_etag()
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+        else:
+            response = make_response(func(*args, **kwargs))
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    return wrapper
+
+
+def changes(func):
+    """Check ``If-Match`` and return the new ETag with the response.
+
+    The check and the change run under the store's write lock, so of two
+    requests sent with the same ETag only the first one gets through.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with store.writing():
+            if request.if_match and not request.if_match.contains(current_etag()):
+                logger.debug('Precondition failed for %s %s', request.method, request.path)
+                return jsonify(error='inventory changed'), 412
+            response = make_response(func(*args, **kwargs))
+            response.set_etag(current_etag())
+        return response
+
+    return wrapper
+
+
+def page_args():
+    """Read ``page``/``per_page`` from the query string and return ``(page, per_page, offset)``."""
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = min(MAX_PER_PAGE, max(1, request.args.get('per_page', PER_PAGE, type=int)))
+    return page, per_page, (page - 1) * per_page
+
+
+def payload(fields):
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(make_response(jsonify(error='expected a JSON object'), 400))
+    return {k: body[k] for k in fields if k in body}
+
+
+def card_json(card):
+    data = {k: card.get(k) for k in ('id', 'name', 'front', 'back', 'claimed_by')}
+    data['thumb'] = images.thumb_url(card.get('front'))
+    return data
+
+
+def category_json(cat):
+    return dict(id=cat['id'], name=cat.get('name'), **store.category_stats(cat['id']))
+
+
+def _category_or_404(cat_id):
+    cat = store.get_category(cat_id)
+    if cat is None:
+        abort(make_response(jsonify(error='category not found'), 404))
+    return cat
+
+
+@api.route('/inventory')
+@require_api_login
+@cached
+def inventory():
+    page, per_page, offset = page_args()
+    categories, total = store.query_categories(request.args.get('q', ''), offset, per_page)
+    return jsonify(total=total, page=page, per_page=per_page,
+                   categories=[category_json(c) for c in categories])
+
+
+@api.route('/categories', methods=['POST'])
+@require_api_login
+@changes
+def add_category():
+    fields = payload(CATEGORY_FIELDS)
+    cat = store.add_category({'name': fields.get('name', ''), 'cards': []})
+    logger.debug('API added category %s', cat['id'])
+    return jsonify(category_json(cat)), 201
+
+
+@api.route('/categories/<cat_id>')
+@require_api_login
+@cached
+def category(cat_id):
+    cat = _category_or_404(cat_id)
+    page, per_page, offset = page_args()
+    cards, total = store.query_cards(cat_id, request.args.get('q', ''),
+                                     request.args.get('status', ''),
+                                     request.args.get('claimant', ''), offset, per_page)
+    return jsonify(dict(category_json(cat), total=total, page=page, per_page=per_page,
+                        cards=[card_json(c) for c in cards]))
+
+
+@api.route('/categories/<cat_id>', methods=['PATCH'])
+@require_api_login
+@changes
+def patch_category(cat_id):
+    cat = store.update_category(cat_id, payload(CATEGORY_FIELDS))
+    if cat is None:
+        return jsonify(error='category not found'), 404
+    return jsonify(category_json(cat))
+
+
+@api.route('/categories/<cat_id>', methods=['DELETE'])
+@require_api_login
+@changes
+def delete_category(cat_id):
+    if not store.delete_category(cat_id):
+        return jsonify(error='category not found'), 404
+    logger.debug('API deleted category %s', cat_id)
+    return '', 204
+
+
+@api.route('/categories/<cat_id>/cards', methods=['POST'])
+@require_api_login
+@changes
+def add_card(cat_id):
+    _category_or_404(cat_id)
+    card = dict({'name': '', 'front': '', 'back': ''}, **payload(CARD_FIELDS))
+    card['claimed_by'] = None
+    store.add_card(cat_id, card)
+    logger.debug('API added card %s to category %s', card['id'], cat_id)
+    return jsonify(card_json(card)), 201
+
+
+@api.route('/categories/<cat_id>/batches', methods=['POST'])
+@require_api_login
+def add_batch(cat_id):
+    """Start a batch-add from multipart ``names`` and front/back ``images`` pairs."""
+    _category_or_404(cat_id)
+    names = [n.strip() for n in request.form.get('names', '').splitlines() if n.strip()]
+    job = batches.submit(cat_id, names, request.files.getlist('images'), current_store())
+    response = jsonify(job.to_dict())
+    response.status_code = 202
+    response.headers['Location'] = f'{api.url_prefix}/batches/{job.id}'
+    return response
+
+
+@api.route('/batches/<job_id>')
+@require_api_login
+def batch(job_id):
+    status = batches.status(job_id)
+    if status is None:
+        return jsonify(error='batch not found'), 404
+    return jsonify(status)
+
+
+@api.route('/categories/<cat_id>/cards/<card_id>')
+@require_api_login
+@cached
+def card(cat_id, card_id):
+    card = store.get_card(cat_id, card_id)
+    if card is None:
+        return jsonify(error='card not found'), 404
+    return jsonify(card_json(card))
+
+
+@api.route('/categories/<cat_id>/cards/<card_id>', methods=['PATCH'])
+@require_api_login
+@changes
+def patch_card(cat_id, card_id):
+    card = store.update_card(cat_id, card_id, payload(CARD_FIELDS))
+    if card is None:
+        return jsonify(error='card not found'), 404
+    return jsonify(card_json(card))
+
+
+@api.route('/categories/<cat_id>/cards/<card_id>', methods=['DELETE'])
+@require_api_login
+@changes
+def delete_card(cat_id, card_id):
+    if not store.delete_card(cat_id, card_id):
+        return jsonify(error='card not found'), 404
+    logger.debug('API deleted card %s from category %s', card_id, cat_id)
+    return '', 204
+
+
+@api.route('/<any(embed, settings):section>')
+@require_api_login
+@cached
+def section(section):
+    return jsonify(store.load().get(section, {}))
+
+
+@api.route('/<any(embed, settings):section>', methods=['PATCH'])
+@require_api_login
+@changes
+def patch_section(section):
+    fields = payload(SECTION_FIELDS[section])
+    if 'grid_size' in fields:
+        try:
+            fields['grid_size'] = int(fields['grid_size'])
+        except (TypeError, ValueError):
+            return jsonify(error='grid_size must be a number'), 400
+    return jsonify(store.update_section(section, fields))
+
+
+EXPORT_TYPES = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+
+@api.route('/export/<any(catalog, claims):kind>.<any(csv, jsonl):fmt>')
+@require_api_login
+def export(kind, fmt):
+    """Stream the catalog or the claims report one card per line."""
+    claims = kind == 'claims'
+    fields = catalog_io.CLAIM_FIELDS if claims else catalog_io.CATALOG_FIELDS
+    lines = catalog_io.encode(catalog_io.export_rows(current_store(), claims_only=claims), fmt, fields)
+    response = Response(stream_with_context(lines), mimetype=EXPORT_TYPES[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename={kind}.{fmt}'
+    return response
+
+
+@api.route('/import', methods=['POST'])
+@require_api_login
+def import_catalog():
+    """Upsert cards from an uploaded CSV or JSONL ``file``."""
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify(error='no file uploaded'), 400
+    try:
+        report = catalog_io.import_file(store, upload, request.values.get('format'))
+    except ValueError as exc:
+        return jsonify(error=str(exc)), 400
+    return jsonify(report)
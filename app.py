@@ -1,15 +1,25 @@
 from flask import (
     Flask,
+    abort,
+    g,
     request,
     redirect,
     render_template,
     render_template_string,
+    send_file,
     session,
     url_for,
 )
-from functools import wraps
-from werkzeug.utils import secure_filename
-from data_manager import load_data, save_data
+from functools import partial, wraps
+from api import PER_PAGE, api, current_store, page_args, store
+from batch_ingest import batches
+import catalog_io
+from events import EventClient
+from image_store import images
+import log_config
+import metrics
+from partitions import partitions
+import serving
 import logging
 try:
     from dotenv import load_dotenv
@@ -17,19 +27,66 @@ except ModuleNotFoundError:  # pragma: no cover - optional dependency
     def load_dotenv(*args, **kwargs):
         print("Warning: python-dotenv not installed; .env file will be ignored")
 import os
+import time
 
 load_dotenv()
 
-logging.basicConfig(
-    filename=os.getenv('DEBUG_LOG', 'debug.log'),
-    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
-    format='%(asctime)s [%(levelname)s] %(name)s: %(message)s',
-    filemode='a'
-)
+log_config.configure(serving.PROCESS)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.secret_key = os.getenv('ADMIN_PASSWORD', 'change-me')
+app.register_blueprint(api)
+app.add_template_filter(images.thumb_url, 'thumb')
+serving.install(app)
+
+# Tell the bot about every change made here; see events.py.
+change_events = EventClient()
+if change_events.enabled:
+    partitions.default.listeners.append(change_events.publish)
+    partitions.on_open.append(
+        lambda key, opened: opened.listeners.append(partial(change_events.publish, guild=key)))
+
+IMAGE_MAX_AGE = 365 * 24 * 3600
+REQUEST_SECONDS = metrics.histogram(
+    'cardbot_admin_request_seconds', 'Time taken to handle admin UI and API requests.')
+
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_timing(response):
+    started = g.pop('request_started', None)
+    if started is not None and request.endpoint not in ('metrics_endpoint', 'healthz'):
+        REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=request.endpoint or 'none',
+                                method=request.method, status=response.status_code)
+    return response
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics of the admin app and of the bot's latest export."""
+    token = os.getenv('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(401)
+    body = metrics.render(metrics.collect(serving.PROCESS))
+    return body, 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@app.route('/healthz')
+def healthz():
+    """Health check for run.py: fails while draining or if the inventory cannot be read."""
+    if serving.drain.draining:
+        return 'draining', 503
+    try:
+        partitions.default.etag()
+    except Exception:
+        logger.exception('Health check could not read the inventory')
+        return 'storage unavailable', 503
+    return 'ok', 200, {'Cache-Control': 'no-store'}
 
 
 def require_login(func):
@@ -57,28 +114,61 @@ def index():
     return render_template('index.html', error=error)
 
 
+@app.context_processor
+def guild_choices():
+    return {'guild_choices': partitions.guilds() if partitions.enabled else []}
+
+
+@app.route('/guild', methods=['POST'])
+@require_login
+def select_guild():
+    """Pick whose inventory the admin pages and API work on."""
+    guild_id = request.form.get('guild_id', '').strip()
+    if guild_id and guild_id not in partitions.guilds():
+        abort(404)
+    session['guild_id'] = guild_id or None
+    logger.debug('Admin switched to guild %s', guild_id or 'shared')
+    return redirect(url_for('inventory'))
+
+
 @app.route('/logout')
 def logout():
     session.clear()
     return redirect('/')
 
 
+def pagination(page, per_page, total, **filters):
+    """Pager for templates/pagination.html; ``filters`` are kept in its links."""
+    if per_page != PER_PAGE:
+        filters['per_page'] = per_page
+    return {
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'pages': max(1, -(-total // per_page)),
+        'filters': {k: v for k, v in filters.items() if v},
+    }
+
+
 @app.route('/inventory')
 @require_login
 def inventory():
     logger.debug('Rendering inventory list')
-    data = load_data()
-    return render_template('inventory.html', data=data)
+    q = request.args.get('q', '')
+    page, per_page, offset = page_args()
+    categories, total = store.query_categories(q, offset, per_page)
+    stats = {cat['id']: store.category_stats(cat['id']) for cat in categories}
+    return render_template('inventory.html', categories=categories, stats=stats, q=q,
+                           pager=pagination(page, per_page, total, q=q))
 
 
 @app.route('/embed-builder', methods=['GET', 'POST'])
 @require_login
 def embed_builder():
     logger.debug('Accessing embed builder')
-    data = load_data()
-    embed = data.get('embed', {})
+    embed = store.load().get('embed', {})
     if request.method == 'POST':
-        embed = {
+        embed = store.update_section('embed', {
             'title': request.form.get('title', ''),
             'description': request.form.get('description', ''),
             'button_label': request.form.get('button_label', 'Explore'),
@@ -86,9 +176,7 @@ def embed_builder():
             'thumbnail': request.form.get('thumbnail', ''),
             'image': request.form.get('image', ''),
             'footer': request.form.get('footer', ''),
-        }
-        data['embed'] = embed
-        save_data(data)
+        })
     return render_template('embed_builder.html', embed=embed)
 
 
@@ -96,17 +184,15 @@ def embed_builder():
 @require_login
 def settings():
     logger.debug('Accessing settings')
-    data = load_data()
-    settings = data.get('settings', {})
+    settings = store.load().get('settings', {})
     if request.method == 'POST':
-        settings = {
+        # Update in place so bot-managed keys such as the claims message ids survive.
+        settings = store.update_section('settings', {
             'inventory_channel_id': request.form.get('inventory_channel_id', ''),
             'claims_channel_id': request.form.get('claims_channel_id', ''),
             'image_channel_id': request.form.get('image_channel_id', ''),
             'grid_size': int(request.form.get('grid_size', '3')),
-        }
-        data['settings'] = settings
-        save_data(data)
+        })
     return render_template('settings.html', settings=settings)
 
 
@@ -114,34 +200,45 @@ def settings():
 @require_login
 def uploads():
     """Upload and list image files."""
-    upload_dir = os.path.join('static', 'uploads')
-    os.makedirs(upload_dir, exist_ok=True)
     if request.method == 'POST':
         files = request.files.getlist('images')
         logger.debug('Uploading %s images', len(files))
         for f in files:
-            if not f.filename:
-                continue
-            fname = secure_filename(f.filename)
-            path = os.path.join(upload_dir, fname)
-            f.save(path)
-            logger.debug('Saved image %s', path)
-    images = os.listdir(upload_dir)
-    images.sort()
-    images = [os.path.join('/static/uploads', img) for img in images]
-    return render_template('uploads.html', images=images)
+            if f.filename:
+                images.add(f.stream, f.filename)
+    return render_template('uploads.html', images=images.listing(), image_url=images.url)
+
+
+def send_image(name, thumbnail=False):
+    record = images.get(name)
+    if record is None:
+        abort(404)
+    path = images.thumbnail(record) if thumbnail else images.path(record)
+    etag = record['digest'] + ('-thumb' if thumbnail else '')
+    response = send_file(path.resolve(), etag=etag, max_age=IMAGE_MAX_AGE, conditional=True)
+    # The URL changes whenever the content does, so clients never need to revalidate.
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route('/images/<name>')
+def image(name):
+    return send_image(name)
+
+
+@app.route('/images/thumbs/<name>')
+def image_thumbnail(name):
+    return send_image(name, thumbnail=True)
 
 
 @app.route('/add-category', methods=['GET', 'POST'])
 @require_login
 def add_category():
-    data = load_data()
     if request.method == 'POST':
         name = request.form.get('name')
         logger.debug('Adding category %s', name)
-        cat_id = str(len(data['categories']) + 1)
-        data['categories'].append({'id': cat_id, 'name': name, 'cards': []})
-        save_data(data)
+        store.add_category({'name': name, 'cards': []})
         return redirect('/inventory')
     return render_template_string('''\
         {% extends 'layout.html' %}
@@ -155,13 +252,38 @@ def add_category():
     ''')
 
 
+@app.route('/import', methods=['POST'])
+@require_login
+def import_catalog():
+    upload = request.files.get('file')
+    try:
+        if upload is None or not upload.filename:
+            raise ValueError('Choose a file to import')
+        report = catalog_io.import_file(store, upload)
+    except ValueError as exc:
+        report = {'error': str(exc)}
+    logger.debug('Import result %s', report)
+    return render_template_string('''\
+        {% extends 'layout.html' %}
+        {% block content %}
+        <h2>Import</h2>
+        {% if report.error %}
+        <p class="error">{{ report.error }}</p>
+        {% else %}
+        <p>{{ report.rows }} rows: {{ report.added }} cards added, {{ report.updated }} updated,
+           {{ report.failed }} failed.</p>
+        <ul>{% for error in report.errors %}<li>{{ error }}</li>{% endfor %}</ul>
+        {% endif %}
+        <a href="/inventory" class="button">Back to inventory</a>
+        {% endblock %}
+    ''', report=report)
+
+
 @app.route('/delete-category/<cat_id>', methods=['POST'])
 @require_login
 def delete_category(cat_id):
-    data = load_data()
     logger.debug('Deleting category %s', cat_id)
-    data['categories'] = [c for c in data['categories'] if c['id'] != cat_id]
-    save_data(data)
+    store.delete_category(cat_id)
     return redirect('/inventory')
 
 
@@ -169,8 +291,7 @@ def delete_category(cat_id):
 @require_login
 def manage_category(cat_id):
     logger.debug('Managing category %s', cat_id)
-    data = load_data()
-    cat = next((c for c in data['categories'] if c['id'] == cat_id), None)
+    cat = store.get_category(cat_id)
     if not cat:
         logger.debug('Category %s not found', cat_id)
         return 'Category not found', 404
@@ -178,52 +299,39 @@ def manage_category(cat_id):
         action = request.form.get('action')
         if action == 'add-card':
             card = {
-                'id': str(len(cat['cards']) + 1),
                 'name': request.form.get('name'),
                 'front': request.form.get('front'),
                 'back': request.form.get('back'),
                 'claimed_by': None,
             }
             logger.debug('Adding card %s to category %s', card['name'], cat_id)
-            cat['cards'].append(card)
-            save_data(data)
+            store.add_card(cat_id, card)
         elif action == 'batch-add':
             names = [n.strip() for n in request.form.get('names', '').splitlines() if n.strip()]
             files = request.files.getlist('images')
             logger.debug('Batch adding %s cards with %s images', len(names), len(files))
-            upload_dir = os.path.join('static', 'uploads')
-            os.makedirs(upload_dir, exist_ok=True)
-            for idx, name in enumerate(names):
-                front_file = files[2*idx] if len(files) > 2*idx else None
-                back_file = files[2*idx+1] if len(files) > 2*idx+1 else None
-                front_path = back_path = ''
-                if front_file:
-                    fname = secure_filename(front_file.filename)
-                    front_path = os.path.join(upload_dir, f'f_{len(cat["cards"])}_{fname}')
-                    front_file.save(front_path)
-                if back_file:
-                    fname = secure_filename(back_file.filename)
-                    back_path = os.path.join(upload_dir, f'b_{len(cat["cards"])}_{fname}')
-                    back_file.save(back_path)
-                card = {
-                    'id': str(len(cat['cards']) + 1),
-                    'name': name,
-                    'front': '/' + front_path if front_path else '',
-                    'back': '/' + back_path if back_path else '',
-                    'claimed_by': None,
-                }
-                logger.debug('Batch add card %s', card['name'])
-                cat['cards'].append(card)
-            save_data(data)
+            job = batches.submit(cat_id, names, files, current_store())
+            return redirect(url_for('manage_category', cat_id=cat_id, batch=job.id))
         elif action == 'delete-card':
             card_id = request.form.get('card_id')
             logger.debug('Deleting card %s from category %s', card_id, cat_id)
-            cat['cards'] = [c for c in cat['cards'] if c['id'] != card_id]
-            save_data(data)
-    return render_template('category.html', category=cat)
+            store.delete_card(cat_id, card_id)
+    q = request.args.get('q', '')
+    status = request.args.get('status', '')
+    claimant = request.args.get('claimant', '')
+    page, per_page, offset = page_args()
+    cards, total = store.query_cards(cat_id, q, status, claimant, offset, per_page)
+    return render_template('category.html', category=cat, cards=cards,
+                           stats=store.category_stats(cat_id),
+                           batch=batches.status(request.args.get('batch', '')),
+                           q=q, status=status, claimant=claimant,
+                           pager=pagination(page, per_page, total,
+                                            q=q, status=status, claimant=claimant))
 
 
 if __name__ == '__main__':
     logger.info('Starting Flask app')
-    debug = os.getenv('FLASK_DEBUG', 'false').lower() in ('1', 'true', 'yes')
-    app.run(debug=debug)
+    if serving.debug_mode():
+        app.run(host=serving.HOST, port=serving.PORT, debug=True)
+    else:
+        serving.serve(app)
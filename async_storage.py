@@ -0,0 +1,71 @@
+import asyncio
+import functools
+import logging
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncStore:
+    """Asyncio facade over :class:`data_manager.InventoryStore`.
+
+    Every storage call runs on a single worker thread so disk reads and JSON
+    encoding never block the bot's event loop. Claim mutations are also
+    serialized per card with an ``asyncio.Lock``; the bot's claims already
+    arrive one card at a time through :class:`claim_queue.ClaimQueue`, which
+    measures how long they wait.
+    """
+
+    def __init__(self, store, executor=None):
+        self.store = store
+        self._executor = executor or ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='storage')
+        self._locks = weakref.WeakValueDictionary()
+        self.pending = 0
+
+    async def run(self, func, *args, **kwargs):
+        """Run ``func`` on the storage thread and return its result."""
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            return await loop.run_in_executor(
+                self._executor, functools.partial(func, *args, **kwargs))
+        finally:
+            self.pending -= 1
+
+    def card_lock(self, cat_id, card_id):
+        key = (cat_id, card_id)
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    async def load(self):
+        return await self.run(self.store.load)
+
+    async def save(self, data=None):
+        await self.run(self.store.save, data)
+
+    async def get_category(self, cat_id):
+        return await self.run(self.store.get_category, cat_id)
+
+    async def get_card(self, cat_id, card_id):
+        return await self.run(self.store.get_card, cat_id, card_id)
+
+    async def update_cards(self, updates):
+        return await self.run(self.store.update_cards, updates)
+
+    async def claimed_cards(self):
+        return await self.run(self.store.claimed_cards)
+
+    async def _locked(self, func, cat_id, card_id, user):
+        async with self.card_lock(cat_id, card_id):
+            return await self.run(func, cat_id, card_id, user)
+
+    async def claim(self, cat_id, card_id, user):
+        return await self._locked(self.store.claim, cat_id, card_id, user)
+
+    async def unclaim(self, cat_id, card_id, user):
+        return await self._locked(self.store.unclaim, cat_id, card_id, user)
+
@@ -0,0 +1,436 @@
+"""Synthetic-load benchmarks for storage, bot views and admin routes.
+
+Builds a synthetic inventory in a temporary directory, drives the bot's
+interaction handlers through fake interactions and channels, exercises the
+admin app through Flask's test client and prints latency percentiles and
+throughput as JSON::
+
+    python bench.py --cards 10000 --claim-ratio 0.3 --output bench.json
+    python bench.py --sizes 10,1000,100000
+    python bench.py --ingest 500
+
+``--ingest`` also times a batch-add of that many cards with two 200 KiB
+images each.
+
+``--sizes`` runs each size in its own process so module-level caches do
+not leak between runs. Discord rate limits are disabled so the numbers
+measure this code, not the pacing.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+
+
+def generate_inventory(cards, categories=None, claim_ratio=0.2, seed=0):
+    """Return an inventory document with ``cards`` cards spread over ``categories``."""
+    rnd = random.Random(seed)
+    categories = categories or max(1, min(50, cards // 200))
+    cats = [{'id': str(c + 1), 'name': f'Set {c + 1}', 'cards': []} for c in range(categories)]
+    for i in range(cards):
+        cat = cats[i % categories]
+        cat['cards'].append({
+            'id': str(len(cat['cards']) + 1),
+            'name': f'Card {i:06d} {rnd.choice("ABCDEFGH")}',
+            'front': f'https://cdn.example/{i}/front.png',
+            'back': f'https://cdn.example/{i}/back.png',
+            'claimed_by': f'user{rnd.randrange(500)}' if rnd.random() < claim_ratio else None,
+        })
+    return {
+        'categories': cats,
+        'embed': {'title': 'Bench', 'description': 'Synthetic inventory', 'button_label': 'Explore',
+                  'color': '#336699', 'thumbnail': '', 'image': '', 'footer': ''},
+        'settings': {'inventory_channel_id': '100', 'claims_channel_id': '200',
+                     'image_channel_id': '', 'grid_size': 3,
+                     'claims_message_id': '', 'claims_message_ids': []},
+    }
+
+
+def percentiles(samples, elapsed):
+    """Summarize latencies (seconds) as milliseconds plus throughput per second."""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'p50_ms': pct(50),
+        'p90_ms': pct(90),
+        'p99_ms': pct(99),
+        'max_ms': round(ordered[-1] * 1000, 3),
+        'mean_ms': round(statistics.fmean(ordered) * 1000, 3),
+        'ops_per_s': round(len(ordered) / elapsed, 1) if elapsed else None,
+    }
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = f'user{user_id}'
+
+    def is_on_mobile(self):
+        return False
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.done = False
+
+    def is_done(self):
+        return self.done
+
+    async def _respond(self, kind):
+        self.done = True
+        self.interaction.responded(kind)
+
+    async def defer(self, **kwargs):
+        await self._respond('defer')
+
+    async def send_message(self, *args, **kwargs):
+        await self._respond('send')
+
+    async def edit_message(self, **kwargs):
+        await self._respond('edit')
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, *args, **kwargs):
+        self.interaction.responded('followup')
+
+
+class FakeInteraction:
+    """Just enough of ``discord.Interaction`` for the bot's handlers.
+
+    ``first_response`` is the delay until the interaction was acknowledged,
+    which Discord requires within three seconds.
+    """
+
+    _ids = iter(range(1, 1 << 62))
+
+    def __init__(self, user, guild, custom_id=''):
+        self.id = next(self._ids)
+        self.user = user
+        self.guild = guild
+        self.guild_id = guild.id
+        self.type = None
+        self.data = {'custom_id': custom_id}
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.started = time.perf_counter()
+        self.created_at = datetime.now(timezone.utc)
+        self.first_response = None
+
+    def responded(self, kind):
+        if self.first_response is None:
+            self.first_response = time.perf_counter() - self.started
+
+    async def edit_original_response(self, **kwargs):
+        self.responded('edit_original')
+
+
+class FakeGuild:
+    def __init__(self, channels):
+        self.id = 1
+        self.channels = {c.id: c for c in channels}
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+
+class FakeContext:
+    def __init__(self, guild, channel, author):
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+
+    async def send(self, *args, **kwargs):
+        pass
+
+
+async def drive(op, count, concurrency):
+    """Run ``op(i)`` ``count`` times with ``concurrency`` workers; return latencies and wall time."""
+    samples = []
+    queue = iter(range(count))
+
+    async def worker():
+        for i in queue:
+            started = time.perf_counter()
+            await op(i)
+            samples.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return samples, time.perf_counter() - started
+
+
+def run_storage(data, ops):
+    from data_manager import load_data, save_data
+    path = Path('data/bench-copy.json')
+    results = {}
+    for name, func in (('save_data', lambda: save_data(data, path)),
+                       ('load_data', lambda: load_data(path))):
+        samples = []
+        started = time.perf_counter()
+        for _ in range(ops):
+            t = time.perf_counter()
+            func()
+            samples.append(time.perf_counter() - t)
+        results[name] = percentiles(samples, time.perf_counter() - started)
+    path.unlink()
+    return results
+
+
+async def run_bot(args, data):
+    import bot
+    from claim_queue import UserLimiter
+    from publisher import FakeChannel, RateLimiter, ROUTE_LIMITS
+
+    unlimited = {route: (1 << 30, 1.0) for route in ROUTE_LIMITS}
+    bot.listing_publisher.limiter = RateLimiter(unlimited)
+    inventory = FakeChannel(100)
+    claims = FakeChannel(200)
+    guild = FakeGuild([inventory, claims])
+    shop = bot.shop_for(guild)
+    shop.image_dump.limiter = RateLimiter(unlimited)
+    shop.claims.limiter = UserLimiter(1 << 30, 1.0)
+    rnd = random.Random(args.seed)
+    keys = [(cat['id'], card['id']) for cat in data['categories'] for card in cat['cards']]
+    users = [FakeUser(i) for i in range(max(1, args.concurrency))]
+    await shop.storage.load()
+    results = {}
+    first = []
+
+    def record(interaction):
+        if interaction.first_response is not None:
+            first.append(interaction.first_response)
+
+    async def claim(i):
+        cat_id, card_id = rnd.choice(keys)
+        snap = shop.sessions.snapshot(cat_id)
+        user = users[i % len(users)]
+        view = bot.CardView(shop, user, snap, snap.card(card_id))
+        interaction = FakeInteraction(user, guild)
+        await view.claim.callback(interaction)
+        record(interaction)
+
+    async def next_page(i):
+        cat = data['categories'][i % len(data['categories'])]
+        user = users[i % len(users)]
+        view = bot.ExploreView(shop, user, shop.sessions.snapshot(cat['id']), 3)
+        for _ in range(args.pages):
+            interaction = FakeInteraction(user, guild)
+            await view.next_btn.callback(interaction)
+            record(interaction)
+
+    async def explore(i):
+        cat = data['categories'][i % len(data['categories'])]
+        interaction = FakeInteraction(users[i % len(users)], guild, bot.explore_id(cat['id']))
+        await bot.dispatch_explore(interaction)
+        record(interaction)
+
+    async def claims_message(i):
+        await bot.update_claims_message(guild)
+
+    async def register(i):
+        await bot.register.callback(FakeContext(guild, inventory, users[0]))
+
+    scenarios = [
+        ('claim', claim, args.ops),
+        ('explore', explore, args.ops),
+        ('next_page', next_page, max(1, args.ops // args.pages)),
+        ('update_claims_message', claims_message, max(1, args.ops // 10)),
+        ('register', register, max(1, args.ops // 50)),
+    ]
+    for name, op, count in scenarios:
+        first.clear()
+        samples, elapsed = await drive(op, count, args.concurrency)
+        results[name] = percentiles(samples, elapsed)
+        if first:
+            results[name]['first_response'] = percentiles(first, elapsed)
+            results[name]['first_response']['over_3s'] = sum(1 for f in first if f > 3)
+
+    # Everything at once, the way a busy drop looks.
+    mixed = [claim, explore, next_page, claims_message]
+    first.clear()
+    samples, elapsed = await drive(lambda i: mixed[i % len(mixed)](i), args.ops, args.concurrency)
+    results['mixed'] = percentiles(samples, elapsed)
+    results['mixed']['first_response'] = percentiles(first, elapsed)
+    results['discord_calls'] = len(inventory.calls) + len(claims.calls)
+    await shop.close()
+    return results
+
+
+def run_flask(args, data):
+    import app as admin
+    client = admin.app.test_client()
+    client.post('/', data={'password': os.getenv('ADMIN_PASSWORD', 'change-me')})
+    rnd = random.Random(args.seed)
+    cat_ids = [cat['id'] for cat in data['categories']]
+    etag = client.get('/api/v1/inventory').headers.get('ETag')
+    routes = {
+        'GET /inventory': lambda i: client.get('/inventory'),
+        'GET /category/<id>': lambda i: client.get(f'/category/{rnd.choice(cat_ids)}?page=2'),
+        'GET /api/v1/inventory (304)': lambda i: client.get(
+            '/api/v1/inventory', headers={'If-None-Match': etag}),
+        'GET /api/v1/categories/<id>': lambda i: client.get(
+            f'/api/v1/categories/{rnd.choice(cat_ids)}'),
+        'PATCH /api/v1/categories/<id>/cards/1': lambda i: client.patch(
+            f'/api/v1/categories/{rnd.choice(cat_ids)}/cards/1', json={'name': f'Renamed {i}'}),
+    }
+    results = {}
+    for name, request in routes.items():
+        samples = []
+        started = time.perf_counter()
+        for i in range(args.ops // 5 or 1):
+            t = time.perf_counter()
+            response = request(i)
+            samples.append(time.perf_counter() - t)
+            if response.status_code >= 300 and response.status_code != 304:
+                raise RuntimeError(f'{name} returned {response.status_code}')
+        results[name] = percentiles(samples, time.perf_counter() - started)
+    return results
+
+
+def run_ingest(count):
+    """Time a batch-add of ``count`` cards with random front/back images."""
+    import io
+    from batch_ingest import BatchIngest
+    from data_manager import InventoryStore, JsonBackend
+    from image_store import ImageStore
+
+    class Upload:
+        def __init__(self, data, filename):
+            self.stream = io.BytesIO(data)
+            self.filename = filename
+
+    root = Path('ingest')
+    inventory = InventoryStore(JsonBackend(root / 'inventory.json'))
+    inventory.add_category({'id': '1', 'name': 'Bench'})
+    ingest = BatchIngest(inventory, ImageStore(root / 'images', root / 'images.json'),
+                         root / 'batches')
+    names = [f'Card {i}' for i in range(count)]
+    files = [Upload(os.urandom(200 * 1024), f'{i}.png') for i in range(count * 2)]
+    started = time.perf_counter()
+    job = ingest.submit('1', names, files)
+    spooled = time.perf_counter() - started
+    while job.status in ('queued', 'running'):
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    added = len(inventory.load()['categories'][0]['cards'])
+    if job.status != 'done' or added != count:
+        raise RuntimeError(f'batch {job.status} with {added} of {count} cards added')
+    return {
+        'cards': job.done,
+        'spool_s': round(spooled, 3),
+        'total_s': round(elapsed, 3),
+        'cards_per_s': round(job.done / elapsed, 1),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    """Run every benchmark for one inventory size inside a scratch directory."""
+    data = generate_inventory(args.cards, args.categories, args.claim_ratio, args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.environ.setdefault('DISCORD_TOKEN', 'bench')
+        os.environ['DEBUG_LOG'] = os.path.join(tmp, 'bench.log')
+        os.environ['CLAIMS_EDIT_INTERVAL'] = str(args.edit_interval)
+        sys.path.insert(0, str(ROOT))
+        from data_manager import save_data
+        save_data(data, Path('data/inventory.json'))
+        results = {'storage': run_storage(data, max(1, args.ops // 50))}
+        results['bot'] = asyncio.run(run_bot(args, data))
+        results['flask'] = run_flask(args, data)
+        if args.ingest:
+            results['ingest'] = run_ingest(args.ingest)
+        os.chdir(ROOT)
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'backend': os.getenv('STORAGE_BACKEND', 'json'),
+            'cards': args.cards,
+            'categories': len(data['categories']),
+            'claim_ratio': args.claim_ratio,
+            'concurrency': args.concurrency,
+            'ops': args.ops,
+        },
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--cards', type=int, default=1000)
+    parser.add_argument('--sizes', help='comma separated card counts, each run in its own process')
+    parser.add_argument('--categories', type=int, default=None)
+    parser.add_argument('--claim-ratio', type=float, default=0.2)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--ops', type=int, default=500)
+    parser.add_argument('--pages', type=int, default=5)
+    parser.add_argument('--edit-interval', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ingest', type=int, default=0, help='cards to batch-add (0 skips it)')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args(argv)
+    if args.sizes:
+        report = []
+        base = [a for a in (argv if argv is not None else sys.argv[1:])]
+        for size in args.sizes.split(','):
+            cmd = [sys.executable, __file__, *_without(base, '--sizes', '--output'),
+                   '--cards', size.strip()]
+            out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+            report.append(json.loads(out))
+    else:
+        report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + '\n')
+    else:
+        print(text)
+
+
+def _without(argv, *options):
+    """Drop ``options`` and their values from ``argv``."""
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+            continue
+        name = arg.split('=', 1)[0]
+        if name in options:
+            skip = '=' not in arg
+            continue
+        result.append(arg)
+    return result
+
+
+if __name__ == '__main__':
+    main()
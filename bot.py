@@ -1,21 +1,35 @@
+import asyncio
+import functools
 import os
 import logging
+import signal
+from concurrent.futures import ThreadPoolExecutor
 try:
     from dotenv import load_dotenv
 except ModuleNotFoundError:  # pragma: no cover - optional dependency
     def load_dotenv(*args, **kwargs):
         print("Warning: python-dotenv not installed; .env file will be ignored")
 import discord
+from discord import app_commands
 from discord.ext import commands
-from data_manager import load_data, save_data
+from async_storage import AsyncStore
+import claim_queue
+from claim_queue import ClaimQueue, UserLimiter
+from claims_summary import ClaimsSummary
+from events import ChangeWatcher
+from image_dump import ImageDumpPublisher
+from image_store import images
+import log_config
+import metrics
+from publisher import ListingPublisher, load_listings, save_listings, summarize
+from routing import InteractionRouter
+from search_index import CardIndex
+from sessions import SessionRegistry, format_report
+from view_cache import EmbedFactory, PageLayouts
+from partitions import partitions
 
 load_dotenv()
-logging.basicConfig(
-    filename=os.getenv('DEBUG_LOG', 'debug.log'),
-    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
-    format='%(asctime)s [%(levelname)s] %(name)s: %(message)s',
-    filemode='a'
-)
+log_config.configure('bot')
 logger = logging.getLogger(__name__)
 TOKEN = os.getenv('DISCORD_TOKEN')
 if not TOKEN:
@@ -26,7 +40,77 @@ intents = discord.Intents.default()
 intents.messages = True
 intents.message_content = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+# BOT_SHARDS=auto lets Discord pick the shard count; a number fixes it.
+SHARDS = os.getenv('BOT_SHARDS', '').strip().lower()
+if SHARDS == 'auto':
+    bot = commands.AutoShardedBot(command_prefix='!', intents=intents)
+elif SHARDS.isdigit():
+    bot = commands.AutoShardedBot(command_prefix='!', intents=intents, shard_count=int(SHARDS))
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents)
+listing_publisher = ListingPublisher()
+# Interactions must be acknowledged within 3 seconds; defer well before that.
+RESPONSE_DEADLINE = 3.0
+DEFER_AFTER = 1.0
+FIRST_RESPONSE = metrics.histogram(
+    'cardbot_interaction_first_response_seconds',
+    'Time from an interaction being created to its first response.')
+LATE_RESPONSES = metrics.counter(
+    'cardbot_interaction_late_total', 'Interactions first answered after the 3 second deadline.')
+CLAIMS = metrics.counter('cardbot_claims_total', 'Claim and unclaim attempts by outcome.')
+# How long a SIGTERM waits for queued claims and summary edits before logging out.
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', '20'))
+
+
+def acknowledged(interaction, kind):
+    """Record how long Discord waited for the first response to ``interaction``."""
+    age = max(0.0, (discord.utils.utcnow() - interaction.created_at).total_seconds())
+    FIRST_RESPONSE.observe(age, kind=kind)
+    if age > RESPONSE_DEADLINE:
+        LATE_RESPONSES.inc(kind=kind)
+        logger.warning('Interaction %s answered after %.2fs', interaction.id, age)
+
+
+async def run_or_defer(interaction, coro, thinking=True):
+    """Await ``coro``, deferring ``interaction`` if it takes longer than DEFER_AFTER."""
+    task = asyncio.ensure_future(coro)
+    done, _ = await asyncio.wait({task}, timeout=DEFER_AFTER)
+    if not done:
+        logger.debug('Deferring slow interaction %s', interaction.id)
+        await interaction.response.defer(ephemeral=True, thinking=thinking)
+        acknowledged(interaction, 'defer')
+    return await task
+
+
+async def reply(interaction, content=None, **kwargs):
+    """Send an ephemeral reply, using the followup webhook if already deferred."""
+    if interaction.response.is_done():
+        await interaction.followup.send(content, ephemeral=True, **kwargs)
+    else:
+        await interaction.response.send_message(content, ephemeral=True, **kwargs)
+        acknowledged(interaction, 'send')
+
+
+async def edit_reply(interaction, **kwargs):
+    """Edit the message the component belongs to, deferred or not."""
+    if interaction.response.is_done():
+        await interaction.edit_original_response(**kwargs)
+    else:
+        await interaction.response.edit_message(**kwargs)
+        acknowledged(interaction, 'edit')
+
+async def decide(interaction, attempt):
+    """Acknowledge a queued claim attempt right away and wait for its outcome."""
+    if not attempt.done():
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        acknowledged(interaction, 'defer')
+    return await attempt
+
+
+def card_image(card, side):
+    """URL Discord can load for one side of a card, preferring the re-hosted copy."""
+    return card.get(f'{side}_url') or card.get(side)
+
 
 def build_category_embed(cat, config=None):
     config = config or {}
@@ -54,95 +138,198 @@ def build_category_embed(cat, config=None):
     return embed
 
 
-async def update_claims_message(guild):
-    """Update or create the persistent claims summary message."""
-    data = load_data()
-    settings = data.get('settings', {})
-    channel_id = settings.get('claims_channel_id')
-    if not channel_id:
+storage_executors = {}
+# Shared by all shops so click-spam in one guild counts everywhere.
+claim_limiter = UserLimiter()
+
+
+def storage_executor(key):
+    """Storage thread shared by the partitions of one shard."""
+    shard = (int(key) >> 22) % bot.shard_count if key is not None and bot.shard_count else 0
+    executor = storage_executors.get(shard)
+    if executor is None:
+        executor = storage_executors[shard] = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=f'storage-{shard}')
+    return executor
+
+
+class Shop:
+    """Everything the bot keeps for one inventory partition (see partitions.py)."""
+
+    def __init__(self, key, store):
+        self.key = key
+        self.store = store
+        self.storage = AsyncStore(store, storage_executor(key))
+        self.claims_summary = ClaimsSummary(self.storage)
+        self.claims = ClaimQueue(self.storage, claim_limiter,
+                                 on_promote=functools.partial(card_promoted, self))
+        self.image_dump = ImageDumpPublisher(self.storage, images, listing_publisher.limiter)
+        self.sessions = SessionRegistry(store)
+        self.card_index = CardIndex()
+        self.page_layouts = PageLayouts()
+        self.category_embed = EmbedFactory(build_category_embed)
+        self.router = InteractionRouter(
+            self.storage, functools.partial(build_routes, self), missing=route_missing)
+        self.listings_lock = asyncio.Lock()
+
+    def __repr__(self):
+        return f'<Shop {self.key or "shared"}>'
+
+    def guilds(self):
+        """Guilds the bot is in that use this partition."""
+        return [g for g in bot.guilds if partitions.key(g.id) == self.key]
+
+    def start(self):
+        self.image_dump.start(functools.partial(image_channel, self))
+
+    async def close(self):
+        """Decide queued claims and publish pending summaries, then unload the store."""
+        if self.image_dump.task is not None:
+            self.image_dump.task.cancel()
+        await self.claims.wait_idle()
+        await self.claims_summary.flush(bot.get_guild)
+        await self.storage.run(self.store.unload)
+
+
+shops = {}
+# Shops of evicted partitions that are still flushing; drain() waits for them.
+closing = set()
+
+
+def shop_for(guild):
+    """The :class:`Shop` of ``guild`` (a guild, its id or None), opening it on first use."""
+    guild_id = getattr(guild, 'id', guild)
+    store = partitions.get(guild_id)
+    key = partitions.key(guild_id)
+    shop = shops.get(key)
+    if shop is None or shop.store is not store:
+        logger.debug('Opening shop %s', key or 'shared')
+        shop = shops[key] = Shop(key, store)
+        shop.start()
+    return shop
+
+
+def drop_shop(key, store):
+    """Close the shop of an evicted partition, or just unload its store off the event loop."""
+    shop = shops.get(key)
+    if shop is None or shop.store is not store:
+        storage_executor(key).submit(store.unload)
+        return
+    logger.debug('Closing shop %s', key)
+    del shops[key]
+    task = asyncio.ensure_future(shop.close())
+    closing.add(task)
+    task.add_done_callback(closing.discard)
+
+
+partitions.unload_evicted = False
+partitions.on_evict.append(drop_shop)
+
+
+async def card_promoted(shop, cat_id, card_id, user_id, name):
+    """Book a card given to the first user on its waitlist and tell them."""
+    CLAIMS.inc(op='waitlist', result='promoted')
+    snap = shop.sessions.snapshot(cat_id)
+    card = snap.card(card_id) if snap else None
+    shop.card_index.set_claimed(cat_id, card_id, name)
+    if card is None:
         return
-    channel = guild.get_channel(int(channel_id))
-    if not channel:
+    shop.claims_summary.claimed(snap, card, name)
+    for guild in shop.guilds():
+        shop.claims_summary.schedule(guild)
+    user = bot.get_user(user_id)
+    if user is None:
         return
-    # Build summary
-    lines = []
-    for cat in data.get('categories', []):
-        for card in cat.get('cards', []):
-            if card.get('claimed_by'):
-                lines.append(f"{card['name']} - {card['claimed_by']}")
-    summary = "\n".join(lines) or "No claims yet"
-    message_id = settings.get('claims_message_id')
-    msg = None
-    if message_id:
-        try:
-            msg = await channel.fetch_message(int(message_id))
-            await msg.edit(content=summary)
-        except discord.NotFound:
-            msg = None
-    if msg is None:
-        msg = await channel.send(summary)
-        settings['claims_message_id'] = str(msg.id)
-        save_data(data)
+    try:
+        await user.send(f"{card['name']} was released and is now yours.")
+    except discord.HTTPException:
+        logger.debug('Could not tell %s about promoted card %s', name, card_id)
+
+
+async def update_claims_message(guild):
+    """Update or create the persistent claims summary messages right away."""
+    await shop_for(guild).claims_summary.publish(guild)
 
 class ExploreView(discord.ui.View):
-    def __init__(self, user, cat, grid_size):
+    def __init__(self, shop, user, cat, grid_size):
         super().__init__(timeout=300)
+        self.shop = shop
         self.user = user
         self.cat = cat
         self.index = 0
         self.grid_size = grid_size
         self.per_page = grid_size * grid_size
+        self.layout = shop.page_layouts.get(cat, cat.version, grid_size)
+        self.page = None
+        # Buttons are created once per view and relabelled on every page.
+        self.card_buttons = [self.make_card_button(i) for i in range(self.per_page)]
+        self.prev_btn = discord.ui.Button(label='Prev', style=discord.ButtonStyle.blurple)
+        self.prev_btn.callback = self.prev_page
+        self.next_btn = discord.ui.Button(label='Next', style=discord.ButtonStyle.blurple)
+        self.next_btn.callback = self.next_page
         logger.debug('Opening ExploreView for %s in category %s', user, cat['id'])
+        shop.sessions.open(self)
         self.update_children()
 
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         return interaction.user.id == self.user.id
 
+    def refresh(self):
+        """Switch to a newer snapshot of the category if there is one."""
+        snap = self.shop.sessions.current(self.cat)
+        if snap is not self.cat:
+            logger.debug('ExploreView moving to category %s version %s', snap.id, snap.version)
+            self.cat = snap
+            self.layout = self.shop.page_layouts.get(snap, snap.version, self.grid_size)
+
     def update_children(self):
         self.clear_items()
         logger.debug('Updating ExploreView buttons index=%s', self.index)
-        cards = self.cat['cards'][self.index:self.index + self.per_page]
-        rows = self.grid_size
-        for i, card in enumerate(cards):
-            button = discord.ui.Button(label=card['name'], style=discord.ButtonStyle.grey, row=i // rows)
-            button.callback = self.make_view_card(card)
+        self.refresh()
+        self.page = self.layout.page(min(self.index // self.per_page, self.layout.page_count - 1))
+        for button, label in zip(self.card_buttons, self.page.labels):
+            button.label = label
             self.add_item(button)
-        if self.index > 0:
-            prev_btn = discord.ui.Button(label='Prev', style=discord.ButtonStyle.blurple)
-            prev_btn.callback = self.prev_page
-            self.add_item(prev_btn)
-        if self.index + self.per_page < len(self.cat['cards']):
-            next_btn = discord.ui.Button(label='Next', style=discord.ButtonStyle.blurple)
-            next_btn.callback = self.next_page
-            self.add_item(next_btn)
-
-    def make_view_card(self, card):
+        if self.page.has_prev:
+            self.add_item(self.prev_btn)
+        if self.page.has_next:
+            self.add_item(self.next_btn)
+
+    def make_card_button(self, slot):
+        button = discord.ui.Button(style=discord.ButtonStyle.grey, row=slot // self.grid_size)
+
         async def callback(interaction: discord.Interaction):
-            logger.debug('Viewing card %s from category %s', card['id'], self.cat['id'])
-            embed = discord.Embed(title=card['name'])
-            embed.set_image(url=card['front'])
-            view = CardView(self.user, self.cat, card)
-            await interaction.response.edit_message(embed=embed, view=view)
-        return callback
+            await self.view_card(interaction, self.page.cards[slot])
+        button.callback = callback
+        return button
+
+    async def view_card(self, interaction, card):
+        logger.debug('Viewing card %s from category %s', card['id'], self.cat['id'])
+        embed = discord.Embed(title=card['name'])
+        embed.set_image(url=card_image(card, 'front'))
+        view = CardView(self.shop, self.user, self.cat, card)
+        await edit_reply(interaction, embed=embed, view=view)
 
     async def prev_page(self, interaction: discord.Interaction):
         self.index = max(0, self.index - self.per_page)
         logger.debug('ExploreView prev_page index=%s', self.index)
         self.update_children()
-        await interaction.response.edit_message(view=self)
+        await edit_reply(interaction, view=self)
 
     async def next_page(self, interaction: discord.Interaction):
         self.index += self.per_page
         logger.debug('ExploreView next_page index=%s', self.index)
         self.update_children()
-        await interaction.response.edit_message(view=self)
+        await edit_reply(interaction, view=self)
 
 class CardView(discord.ui.View):
-    def __init__(self, user, cat, card):
+    def __init__(self, shop, user, cat, card):
         super().__init__(timeout=300)
+        self.shop = shop
         self.user = user
         self.cat = cat
         self.card = card
+        shop.sessions.open(self)
 
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         return interaction.user.id == self.user.id
@@ -151,107 +338,388 @@ class CardView(discord.ui.View):
     async def left(self, interaction: discord.Interaction, button: discord.ui.Button):
         logger.debug('Showing back of card %s', self.card['id'])
         embed = discord.Embed(title=self.card['name'])
-        embed.set_image(url=self.card['back'])
-        await interaction.response.edit_message(embed=embed, view=self)
+        embed.set_image(url=card_image(self.card, 'back'))
+        await edit_reply(interaction, embed=embed, view=self)
 
     @discord.ui.button(label='Right', style=discord.ButtonStyle.secondary)
     async def right(self, interaction: discord.Interaction, button: discord.ui.Button):
         logger.debug('Showing front of card %s', self.card['id'])
         embed = discord.Embed(title=self.card['name'])
-        embed.set_image(url=self.card['front'])
-        await interaction.response.edit_message(embed=embed, view=self)
+        embed.set_image(url=card_image(self.card, 'front'))
+        await edit_reply(interaction, embed=embed, view=self)
 
     @discord.ui.button(label='Claim', style=discord.ButtonStyle.green)
     async def claim(self, interaction: discord.Interaction, button: discord.ui.Button):
-        data = load_data()
-        cat = next((c for c in data['categories'] if c['id'] == self.cat['id']), None)
-        card = next((x for x in cat['cards'] if x['id'] == self.card['id']), None)
-        if card and not card.get('claimed_by'):
+        shop = self.shop
+        outcome = await decide(interaction, shop.claims.submit(
+            'claim', self.cat['id'], self.card['id'], interaction.user))
+        CLAIMS.inc(op='claim', result=outcome)
+        if outcome == claim_queue.WON:
             logger.debug('Card %s claimed by %s', self.card['id'], interaction.user)
-            card['claimed_by'] = interaction.user.name
-            save_data(data)
-            await interaction.response.send_message('Claimed!', ephemeral=True)
-            await update_claims_message(interaction.guild)
+            shop.card_index.set_claimed(self.cat['id'], self.card['id'], interaction.user.name)
+            shop.claims_summary.claimed(self.cat, self.card, interaction.user.name)
+            shop.claims_summary.schedule(interaction.guild)
+            await reply(interaction, 'Claimed!')
+        elif outcome == claim_queue.LIMITED:
+            await reply(interaction, 'Too many clicks; try again in a few seconds')
         else:
-            await interaction.response.send_message('Already claimed', ephemeral=True)
+            await reply(interaction, 'Already claimed',
+                        view=WaitlistView(shop, self.user, self.cat, self.card))
 
     @discord.ui.button(label='Unclaim', style=discord.ButtonStyle.red)
     async def unclaim(self, interaction: discord.Interaction, button: discord.ui.Button):
-        data = load_data()
-        cat = next((c for c in data['categories'] if c['id'] == self.cat['id']), None)
-        card = next((x for x in cat['cards'] if x['id'] == self.card['id']), None)
-        if card and card.get('claimed_by') == interaction.user.name:
+        shop = self.shop
+        outcome = await decide(interaction, shop.claims.submit(
+            'unclaim', self.cat['id'], self.card['id'], interaction.user))
+        CLAIMS.inc(op='unclaim', result=outcome)
+        if outcome == claim_queue.RELEASED:
             logger.debug('Card %s unclaimed by %s', self.card['id'], interaction.user)
-            card['claimed_by'] = None
-            save_data(data)
-            await interaction.response.send_message('Unclaimed', ephemeral=True)
-            await update_claims_message(interaction.guild)
+            # Before replying, so a waitlist promotion is booked after this.
+            shop.card_index.set_claimed(self.cat['id'], self.card['id'], None)
+            shop.claims_summary.unclaimed(self.cat, self.card)
+            shop.claims_summary.schedule(interaction.guild)
+            await reply(interaction, 'Unclaimed')
+        elif outcome == claim_queue.LIMITED:
+            await reply(interaction, 'Too many clicks; try again in a few seconds')
         else:
-            await interaction.response.send_message('Cannot unclaim', ephemeral=True)
+            await reply(interaction, 'Cannot unclaim')
 
     @discord.ui.button(label='Back', style=discord.ButtonStyle.secondary)
     async def back(self, interaction: discord.Interaction, button: discord.ui.Button):
         logger.debug('Returning to card list for category %s', self.cat['id'])
-        data = load_data()
+        shop = self.shop
+        data = await run_or_defer(interaction, shop.storage.load(), thinking=False)
         grid = data.get('settings', {}).get('grid_size', 3)
-        view = ExploreView(self.user, self.cat, grid)
-        data = load_data()
-        embed = build_category_embed(self.cat, data.get('embed'))
-        await interaction.response.edit_message(embed=embed, view=view)
+        view = ExploreView(shop, self.user, shop.sessions.current(self.cat), grid)
+        embed = shop.category_embed(self.cat, data.get('embed'))
+        await edit_reply(interaction, embed=embed, view=view)
+
+class WaitlistView(discord.ui.View):
+    """Offered with 'Already claimed' so the user can queue for the card."""
+
+    def __init__(self, shop, user, cat, card):
+        super().__init__(timeout=300)
+        self.shop = shop
+        self.user = user
+        self.cat = cat
+        self.card = card
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return interaction.user.id == self.user.id
+
+    @discord.ui.button(label='Join waitlist', style=discord.ButtonStyle.blurple)
+    async def join(self, interaction: discord.Interaction, button: discord.ui.Button):
+        shop = self.shop
+        cat_id, card_id = self.cat['id'], self.card['id']
+        outcome = await decide(interaction, shop.claims.submit('join', cat_id, card_id, interaction.user))
+        CLAIMS.inc(op='waitlist', result=outcome)
+        if outcome == claim_queue.WON:
+            shop.card_index.set_claimed(cat_id, card_id, interaction.user.name)
+            shop.claims_summary.claimed(self.cat, self.card, interaction.user.name)
+            shop.claims_summary.schedule(interaction.guild)
+            await reply(interaction, 'The card was free again - claimed!')
+        elif outcome == claim_queue.WAITING:
+            place = shop.claims.position(cat_id, card_id, interaction.user.id)
+            await reply(interaction, f'You are #{place} on the waitlist; '
+                                     'the card is yours if it is released.')
+        elif outcome == claim_queue.FULL:
+            await reply(interaction, 'The waitlist for this card is full')
+        elif outcome == claim_queue.LIMITED:
+            await reply(interaction, 'Too many clicks; try again in a few seconds')
+        else:
+            await reply(interaction, 'You already have this card, or it no longer exists')
+
+class ExploreButtonView(discord.ui.View):
+    """Persistent Explore button attached to a category listing.
+
+    Clicks go to the router of the clicking guild's shop, so one view
+    serves every partition with a category of that id.
+    """
+
+    def __init__(self, cat_id, label='Explore'):
+        super().__init__(timeout=None)
+        button = discord.ui.Button(label=label, custom_id=explore_id(cat_id))
+        button.callback = dispatch_explore
+        self.add_item(button)
+
+
+async def dispatch_explore(interaction):
+    await shop_for(interaction.guild_id).router.dispatch(interaction)
+
+
+def explore_id(cat_id):
+    return f'explore_{cat_id}'
+
+
+def explore_route(shop, cat_id):
+    return functools.partial(open_category, shop, cat_id=cat_id)
+
+
+def build_routes(shop, data):
+    return {explore_id(cat['id']): explore_route(shop, cat['id'])
+            for cat in data.get('categories', [])}
+
+
+async def route_missing(interaction):
+    await reply(interaction, 'Category missing')
+
+
+def render_listing(shop, cat, embed_cfg):
+    """Build the embed and Explore button posted for a category."""
+    embed = shop.category_embed(cat, embed_cfg)
+    view = ExploreButtonView(cat['id'], embed_cfg.get('button_label', 'Explore'))
+    return embed, view
+
+
+async def refresh_listings(shop):
+    """Edit, post or remove listings that no longer match the inventory.
+
+    Only does anything once ``!register`` has posted the listings.
+    """
+    async with shop.listings_lock:
+        data = await shop.storage.run(load_listings, shop.store)
+        settings = data.get('settings', {})
+        channel_id = settings.get('inventory_channel_id')
+        channel = bot.get_channel(int(channel_id)) if channel_id else None
+        if not settings.get('listings') or channel is None:
+            return
+        embed_cfg = data.get('embed', {})
+        steps = await listing_publisher.publish(
+            data, channel, lambda cat: render_listing(shop, cat, embed_cfg),
+            get_channel=bot.get_channel)
+        if steps:
+            await shop.storage.run(save_listings, shop.store, data, steps)
+            logger.info('Refreshed listings of %s: %s', shop, summarize(steps))
+
+
+async def inventory_changed(key, categories):
+    """Catch up after the admin app changed ``categories`` (None: possibly all of them)."""
+    shop = shops.get(key)
+    if shop is None:
+        return
+    logger.debug('Inventory of %s changed in categories %s', shop,
+                 'all' if categories is None else sorted(categories))
+    await shop.router.refresh()
+    await shop.storage.run(shop.card_index.sync, shop.store)
+    shop.image_dump.wake.set()
+    shop.claims.released(categories)
+    if categories is None or categories:
+        for guild in shop.guilds():
+            shop.claims_summary.schedule(guild)
+    await refresh_listings(shop)
+
+
+change_watcher = ChangeWatcher(
+    lambda: {key: shop.storage for key, shop in shops.items()}, inventory_changed)
+
 
 @bot.command()
-async def register(ctx):
+async def register(ctx, mode: str = ''):
+    """Post or refresh category listings; ``!register dry-run`` only reports the plan."""
     logger.debug('Register command invoked by %s', ctx.author)
-    data = load_data()
-    settings = data.get('settings', {})
-    embed_cfg = data.get('embed', {})
-    channel = ctx.channel
-    if settings.get('inventory_channel_id'):
-        chan = ctx.guild.get_channel(int(settings['inventory_channel_id']))
-        if chan:
-            channel = chan
-    claims_chan = None
-    if settings.get('claims_channel_id'):
-        claims_chan = ctx.guild.get_channel(int(settings['claims_channel_id']))
-    for cat in data['categories']:
-        embed = build_category_embed(cat, embed_cfg)
-        view = discord.ui.View()
-        label = embed_cfg.get('button_label', 'Explore')
-        view.add_item(discord.ui.Button(label=label, custom_id=f'explore_{cat["id"]}'))
-        msg = await channel.send(embed=embed, view=view)
-        cat['message_id'] = msg.id
-    save_data(data)
-    await ctx.send('Registration complete.')
+    dry_run = mode.lower() in ('dry', 'dry-run', 'dryrun')
+    shop = shop_for(ctx.guild)
+    async with shop.listings_lock:
+        # Loaded under the lock, so a concurrent refresh_listings cannot post in between.
+        data = await shop.storage.run(load_listings, shop.store)
+        settings = data.get('settings', {})
+        embed_cfg = data.get('embed', {})
+        channel = ctx.channel
+        if settings.get('inventory_channel_id'):
+            chan = ctx.guild.get_channel(int(settings['inventory_channel_id']))
+            if chan:
+                channel = chan
+        claims_chan = None
+        if settings.get('claims_channel_id'):
+            claims_chan = ctx.guild.get_channel(int(settings['claims_channel_id']))
+        steps = await listing_publisher.publish(
+            data, channel, lambda cat: render_listing(shop, cat, embed_cfg),
+            get_channel=ctx.guild.get_channel, dry_run=dry_run)
+        counts = summarize(steps)
+        report = '{send} new, {edit} updated, {delete} removed'.format(**counts)
+        if dry_run:
+            await ctx.send(f'Dry run: {report}.')
+            return
+        if steps:
+            await shop.storage.run(save_listings, shop.store, data, steps)
+    await ctx.send(f'Registration complete: {report}.')
     if claims_chan:
         await update_claims_message(ctx.guild)
 
+def search_cards(shop, query):
+    """Refresh the card index if needed and search it; runs on the storage thread."""
+    shop.store.load()
+    shop.card_index.sync(shop.store)
+    return [(key, shop.card_index.label(key)) for key in shop.card_index.search(query)]
+
+
+def resolve_card(shop, value):
+    """Map an autocomplete value (``cat_id:card_id``) or free text to a card key."""
+    shop.store.load()
+    shop.card_index.sync(shop.store)
+    cat_id, _, card_id = value.partition(':')
+    if (cat_id, card_id) in shop.card_index.entries:
+        return cat_id, card_id
+    found = shop.card_index.search(value, limit=1)
+    return found[0] if found else None
+
+
+async def card_autocomplete(interaction: discord.Interaction, current: str):
+    shop = shop_for(interaction.guild_id)
+    results = await shop.storage.run(search_cards, shop, current)
+    return [app_commands.Choice(name=label, value=f'{cat_id}:{card_id}')
+            for (cat_id, card_id), label in results]
+
+
+@bot.tree.command(name='card', description='Find a card by name')
+@app_commands.describe(name='Card name')
+@app_commands.autocomplete(name=card_autocomplete)
+async def card_search(interaction: discord.Interaction, name: str):
+    logger.debug('Card search %r by %s', name, interaction.user)
+    shop = shop_for(interaction.guild_id)
+    key = await run_or_defer(interaction, shop.storage.run(resolve_card, shop, name))
+    snap = shop.sessions.snapshot(key[0]) if key else None
+    card = snap.card(key[1]) if snap else None
+    if card is None:
+        await reply(interaction, 'No matching card found')
+        return
+    embed = discord.Embed(title=card['name'])
+    embed.set_image(url=card_image(card, 'front'))
+    await reply(interaction, embed=embed, view=CardView(shop, interaction.user, snap, card))
+
+
+async def image_channel(shop):
+    data = await shop.storage.load()
+    channel_id = data.get('settings', {}).get('image_channel_id')
+    return bot.get_channel(int(channel_id)) if channel_id else None
+
+
+@bot.command(name='images')
+async def publish_images(ctx):
+    """Upload pending card images to the image dump channel now."""
+    logger.debug('Image dump requested by %s', ctx.author)
+    shop = shop_for(ctx.guild)
+    channel = await image_channel(shop)
+    if channel is None:
+        await ctx.send('Set an image dump channel in the admin settings first.')
+        return
+    counts = await shop.image_dump.publish(channel)
+    await ctx.send('{uploaded} images uploaded in {messages} messages, {refreshed} links '
+                   'refreshed, {cards} cards updated.'.format(**counts))
+
+
+@bot.command(name='sessions')
+async def sessions_report(ctx):
+    """Report open browsing sessions and the category snapshots they share."""
+    report = shop_for(ctx.guild).sessions.report()
+    logger.info('Session report: %s', report)
+    await ctx.send(format_report(report))
+
+def stored_listings(store):
+    """Button label and ``(cat_id, message_id)`` of every category; runs on the storage thread."""
+    data = store.load()
+    label = data.get('embed', {}).get('button_label', 'Explore')
+    return label, [(cat['id'], cat.get('message_id')) for cat in data.get('categories', [])]
+
+
+async def attach_listings():
+    """Re-attach Explore buttons to the stored listings of every partition."""
+    loop = asyncio.get_running_loop()
+    keys = {None} | {partitions.key(guild_id) for guild_id in partitions.guilds()}
+    attached = 0
+    for key in sorted(keys, key=lambda k: k or ''):
+        store = partitions.get(key)
+        label, listings = await loop.run_in_executor(storage_executor(key), stored_listings, store)
+        for cat_id, message_id in listings:
+            bot.add_view(ExploreButtonView(cat_id, label),
+                         message_id=int(message_id) if message_id else None)
+            attached += 1
+    logger.info('Registered %s persistent listings in %s partitions', attached, len(keys))
+
+
+@bot.event
+async def setup_hook():
+    """Re-attach listings and warm up the shared shop; other shops open on first use."""
+    await attach_listings()
+    shop = shop_for(None)
+    await shop.router.refresh()
+    await shop.storage.run(shop.card_index.sync, shop.store)
+    change_watcher.start()
+    asyncio.ensure_future(export_metrics())
+    on_terminate(lambda: asyncio.ensure_future(drain()))
+    try:
+        await bot.tree.sync()
+    except discord.HTTPException:
+        logger.exception('Failed to sync application commands')
+
+
+async def export_metrics():
+    """Export metrics from the event loop, so run.py also sees a stale export if the loop hangs."""
+    while True:
+        try:
+            await asyncio.to_thread(metrics.export, 'bot')
+        except Exception:
+            logger.exception('Could not export metrics')
+        await asyncio.sleep(metrics.EXPORT_INTERVAL)
+
+
+def on_terminate(callback):
+    """Call ``callback`` on the event loop when run.py asks the bot to stop."""
+    loop = asyncio.get_running_loop()
+    for name in ('SIGTERM', 'SIGBREAK'):
+        sig = getattr(signal, name, None)
+        if sig is None:
+            continue
+        try:
+            loop.add_signal_handler(sig, callback)
+        except NotImplementedError:  # pragma: no cover - Windows
+            signal.signal(sig, lambda *args: loop.call_soon_threadsafe(callback))
+
+
+draining = False
+
+
+async def drain():
+    """Decide queued claims and publish pending claims summaries, then log out."""
+    global draining
+    if draining:
+        return
+    draining = True
+    logger.info('Draining %s shops before shutting down', len(shops))
+    change_watcher.stop()
+    try:
+        await asyncio.wait_for(asyncio.gather(*(
+            shop.claims.wait_idle() for shop in list(shops.values())), *closing), DRAIN_TIMEOUT)
+        await asyncio.wait_for(asyncio.gather(*(
+            shop.claims_summary.flush(bot.get_guild) for shop in list(shops.values()))),
+            DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning('Shutting down before the drain finished')
+    await bot.close()
+
 @bot.event
 async def on_ready():
     logger.info('Logged in as %s', bot.user)
 
-@bot.event
-async def on_interaction(interaction: discord.Interaction):
-    if interaction.type == discord.InteractionType.component:
-        custom = interaction.data.get('custom_id', '')
-        if custom.startswith('explore_'):
-            cat_id = custom.split('_', 1)[1]
-            logger.debug('Explore interaction for category %s by %s', cat_id, interaction.user)
-            data = load_data()
-            cat = next((c for c in data['categories'] if c['id'] == cat_id), None)
-            if not cat:
-                logger.debug('Category %s missing for interaction', cat_id)
-                await interaction.response.send_message('Category missing', ephemeral=True)
-                return
-            settings = data.get('settings', {})
-            grid = settings.get('grid_size', 3)
-            try:
-                if interaction.user.is_on_mobile():
-                    grid = min(grid, 2)
-            except AttributeError:
-                pass
-            view = ExploreView(interaction.user, cat, grid)
-            embed = build_category_embed(cat, data.get('embed'))
-            await interaction.response.send_message(embed=embed, ephemeral=True, view=view)
+async def open_category(shop, interaction: discord.Interaction, cat_id):
+    """Show the card grid for a category in an ephemeral message."""
+    logger.debug('Explore interaction for category %s by %s', cat_id, interaction.user)
+    data = await run_or_defer(interaction, shop.storage.load())
+    cat = shop.sessions.snapshot(cat_id)
+    if not cat:
+        logger.debug('Category %s missing for interaction', cat_id)
+        await reply(interaction, 'Category missing')
+        return
+    settings = data.get('settings', {})
+    grid = settings.get('grid_size', 3)
+    try:
+        if interaction.user.is_on_mobile():
+            grid = min(grid, 2)
+    except AttributeError:
+        pass
+    view = ExploreView(shop, interaction.user, cat, grid)
+    embed = shop.category_embed(cat, data.get('embed'))
+    await reply(interaction, embed=embed, view=view)
 
 if __name__ == '__main__':
     logger.info('Starting Discord bot')
@@ -0,0 +1,198 @@
+"""Streaming CSV/JSONL import and export of the card catalog and claims.
+
+Imports read one row at a time and apply them in chunks, and exports are
+generators yielding one line per card, so memory use does not grow with
+the size of the file.
+"""
+import codecs
+import csv
+import io
+import itertools
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 500
+MAX_ERRORS = 50
+CATALOG_FIELDS = ('category_id', 'category', 'id', 'name', 'front', 'back', 'claimed_by')
+CLAIM_FIELDS = ('category_id', 'category', 'id', 'name', 'claimed_by')
+FORMATS = ('csv', 'jsonl')
+
+
+def read_rows(stream, fmt):
+    """Yield ``(line, row)`` from a binary ``stream`` of CSV or JSON lines."""
+    text = codecs.getreader('utf-8-sig')(stream)
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt == 'jsonl':
+        for line_no, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as exc:
+                yield line_no, ValueError(f'invalid JSON: {exc.msg}')
+                continue
+            yield line_no, row if isinstance(row, dict) else ValueError('expected an object')
+    else:
+        raise ValueError(f'Unknown format {fmt!r}')
+
+
+def _image(value):
+    value = (value or '').strip()
+    if value and not value.startswith(('http://', 'https://', '/')):
+        raise ValueError(f'{value!r} is not a URL')
+    return value
+
+
+def validate(row):
+    """Return ``(category, card fields)`` for an import row or raise ValueError."""
+    if isinstance(row, Exception):
+        raise row
+    name = str(row.get('name') or '').strip()
+    category = str(row.get('category') or '').strip()
+    if not name:
+        raise ValueError('name is required')
+    if not category and not row.get('category_id'):
+        raise ValueError('category is required')
+    fields = {'name': name, 'front': _image(row.get('front')), 'back': _image(row.get('back'))}
+    if row.get('id'):
+        fields['id'] = str(row['id']).strip()
+    return (str(row.get('category_id') or '').strip(), category), fields
+
+
+class CatalogImport:
+    """Upserts cards from :func:`read_rows` into ``store`` in chunks.
+
+    Rows name their category by ``category_id`` or ``category`` (created if
+    missing). A card is matched by ``id`` when given, otherwise by name within
+    its category; matches are updated and everything else is added. Claims
+    are never changed by an import.
+    """
+
+    def __init__(self, store, chunk_size=CHUNK_SIZE):
+        self.store = store
+        self.chunk_size = chunk_size
+        self.report = {'rows': 0, 'added': 0, 'updated': 0, 'failed': 0, 'errors': []}
+        self._categories = None
+        self._names = {}
+
+    def run(self, rows):
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, self.chunk_size))
+            if not chunk:
+                break
+            self._apply(chunk)
+        logger.info('Catalog import: %s', {k: v for k, v in self.report.items() if k != 'errors'})
+        return self.report
+
+    def _error(self, line, message):
+        self.report['failed'] += 1
+        if len(self.report['errors']) < MAX_ERRORS:
+            self.report['errors'].append(f'line {line}: {message}')
+
+    def _category(self, cat_id, name):
+        if self._categories is None:
+            self._categories = {c.get('name'): c['id'] for c in self.store.load()['categories']}
+        if cat_id:
+            if self.store.get_category(cat_id) is None:
+                raise ValueError(f'unknown category id {cat_id}')
+            return cat_id
+        if name not in self._categories:
+            self._categories[name] = self.store.add_category({'name': name})['id']
+        return self._categories[name]
+
+    def _card_names(self, cat_id):
+        names = self._names.get(cat_id)
+        if names is None:
+            names = self._names[cat_id] = {}
+            for card in self.store.get_category(cat_id)['cards']:
+                names.setdefault(card.get('name'), card['id'])
+        return names
+
+    def _apply(self, chunk):
+        added = {}
+        updates = []
+        for line, row in chunk:
+            self.report['rows'] += 1
+            try:
+                (cat_id, cat_name), fields = validate(row)
+                cat_id = self._category(cat_id, cat_name)
+            except ValueError as exc:
+                self._error(line, exc)
+                continue
+            card_id = fields.pop('id', None)
+            if card_id is None:
+                card_id = self._card_names(cat_id).get(fields['name'])
+            if card_id is not None and self.store.get_card(cat_id, card_id) is not None:
+                updates.append((cat_id, card_id, fields))
+                continue
+            # Repeated rows for a card added in this chunk update the pending card.
+            key = card_id or ('name', fields['name'])
+            pending = added.setdefault(cat_id, {})
+            if key in pending:
+                pending[key][1].update(fields)
+            else:
+                card = dict(fields, claimed_by=None)
+                if card_id:
+                    card['id'] = card_id
+                pending[key] = (line, card)
+        cards = {cat_id: [card for _, card in pending.values()] for cat_id, pending in added.items()}
+        self.store.upsert_cards(cards, updates)
+        self.report['updated'] += len(updates)
+        for cat_id, pending in added.items():
+            if self.store.get_category(cat_id) is None:
+                for line, _ in pending.values():
+                    self._error(line, f'category {cat_id} was deleted')
+                continue
+            names = self._card_names(cat_id)
+            for card in cards[cat_id]:
+                names.setdefault(card['name'], card['id'])
+            self.report['added'] += len(cards[cat_id])
+
+
+def import_file(store, upload, fmt=None):
+    """Import an uploaded file, taking the format from its extension if not given."""
+    fmt = (fmt or upload.filename.rsplit('.', 1)[-1]).lower()
+    if fmt not in FORMATS:
+        raise ValueError('Upload a .csv or .jsonl file')
+    return CatalogImport(store).run(read_rows(upload.stream, fmt))
+
+
+def export_rows(store, claims_only=False):
+    """Yield one dict per card (or per claimed card) without copying the catalog."""
+    for cat in list(store.load()['categories']):
+        for card in cat.get('cards', []):
+            if claims_only and not card.get('claimed_by'):
+                continue
+            yield {
+                'category_id': cat['id'],
+                'category': cat.get('name'),
+                'id': card['id'],
+                'name': card.get('name'),
+                'front': card.get('front'),
+                'back': card.get('back'),
+                'claimed_by': card.get('claimed_by'),
+            }
+
+
+def encode(rows, fmt, fields):
+    """Turn dict rows into lines of CSV (with a header) or JSON."""
+    if fmt == 'jsonl':
+        for row in rows:
+            yield json.dumps({k: row[k] for k in fields}) + '\n'
+        return
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fields, extrasaction='ignore')
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
@@ -0,0 +1,233 @@
+"""Fair claim arbitration for busy drops.
+
+Every claim, unclaim or waitlist click becomes an attempt queued on its
+card the moment it arrives. One writer task per card decides the attempts
+in arrival order: the first claim on a free card goes to storage, and the
+claims queued behind it are turned down without another storage round
+trip. Users who lose can join the card's waitlist; when the card is
+released, through the bot or the admin app, the first user waiting gets it
+through the same writer. Waitlists live in memory and are lost when the bot
+restarts.
+
+A per-user token bucket (``CLAIM_RATE`` clicks per ``CLAIM_RATE_WINDOW``
+seconds) turns click-spam away before it reaches a queue, so one user
+cannot push everybody else to the back.
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+import logging
+
+import metrics
+
+logger = logging.getLogger(__name__)
+DECISION_SECONDS = metrics.histogram(
+    'cardbot_claim_decision_seconds', 'Time from a claim click to its decision by the card queue.')
+WAIT_SECONDS = metrics.histogram(
+    'cardbot_claim_wait_seconds', 'Time claim clicks waited in their card queue before being decided.')
+QUEUE_DEPTH = metrics.histogram(
+    'cardbot_claim_queue_depth', 'Attempts already queued on the card when a claim click arrived.',
+    buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250))
+
+RATE = int(os.getenv('CLAIM_RATE', '5'))
+WINDOW = float(os.getenv('CLAIM_RATE_WINDOW', '10'))
+WAITLIST_SIZE = int(os.getenv('CLAIM_WAITLIST_SIZE', '25'))
+# Forget idle users once this many are tracked.
+MAX_TRACKED_USERS = 10000
+
+WON = 'won'
+TAKEN = 'taken'
+RELEASED = 'released'
+REFUSED = 'refused'
+LIMITED = 'limited'
+WAITING = 'waiting'
+FULL = 'full'
+
+
+class UserLimiter:
+    """Token bucket per user allowing ``rate`` clicks per ``per`` seconds, without waiting."""
+
+    def __init__(self, rate=RATE, per=WINDOW):
+        self.rate = rate
+        self.per = per
+        self._buckets = {}
+
+    def allow(self, user_id, now=None):
+        now = time.monotonic() if now is None else now
+        tokens, updated = self._buckets.get(user_id, (self.rate, now))
+        tokens = min(self.rate, tokens + (now - updated) * self.rate / self.per)
+        allowed = tokens >= 1
+        self._buckets[user_id] = (tokens - 1 if allowed else tokens, now)
+        if len(self._buckets) > MAX_TRACKED_USERS:
+            self._prune(now)
+        return allowed
+
+    def _prune(self, now):
+        idle = now - self.per
+        self._buckets = {u: b for u, b in self._buckets.items() if b[1] > idle}
+
+
+class Attempt:
+    __slots__ = ('op', 'user_id', 'name', 'future', 'queued')
+
+    def __init__(self, op, user_id, name, future):
+        self.op = op
+        self.user_id = user_id
+        self.name = name
+        self.future = future
+        self.queued = time.perf_counter()
+
+
+class ClaimQueue:
+    """Per-card attempt queues over an :class:`async_storage.AsyncStore`; see the module docstring.
+
+    ``on_promote(cat_id, card_id, user_id, name)`` is awaited in the
+    background after a waiting user was given a card, once the outcome of
+    the attempt that freed it has been delivered.
+    """
+
+    def __init__(self, storage, limiter=None, waitlist_size=WAITLIST_SIZE, on_promote=None):
+        self.storage = storage
+        self.limiter = limiter or UserLimiter()
+        self.waitlist_size = waitlist_size
+        self.on_promote = on_promote
+        self.waitlists = {}
+        self.writes = 0
+        self._queues = {}
+        self._writers = {}
+        self._deciding = set()
+        self._promoted = []
+
+    def submit(self, op, cat_id, card_id, user):
+        """Queue ``op`` (claim, unclaim or join) by ``user`` and return a future of its outcome.
+
+        Must be called as soon as the click arrives, before anything is
+        awaited, so the queue keeps arrival order. A rate-limited click gets
+        a future that is already done with :data:`LIMITED`.
+        """
+        future = asyncio.get_running_loop().create_future()
+        if not self.limiter.allow(user.id):
+            future.set_result(LIMITED)
+            return future
+        key = (cat_id, card_id)
+        queue = self._queues.setdefault(key, deque())
+        # The attempt being decided has already left the queue.
+        QUEUE_DEPTH.observe(len(queue) + (key in self._deciding), op=op)
+        queue.append(Attempt(op, user.id, user.name, future))
+        if key not in self._writers:
+            self._writers[key] = asyncio.ensure_future(self._drain(key))
+        return future
+
+    def released(self, categories=None):
+        """Offer waitlisted cards in ``categories`` (None: all) that were freed elsewhere."""
+        for key in list(self.waitlists):
+            if categories is None or key[0] in categories:
+                self._queues.setdefault(key, deque()).append(Attempt('promote', None, None, None))
+                if key not in self._writers:
+                    self._writers[key] = asyncio.ensure_future(self._drain(key))
+
+    async def wait_idle(self):
+        """Wait until every attempt queued so far has been decided."""
+        while self._writers:
+            await asyncio.wait(list(self._writers.values()))
+
+    def position(self, cat_id, card_id, user_id):
+        """1-based place of ``user_id`` on the card's waitlist, or None."""
+        waiting = self.waitlists.get((cat_id, card_id), {})
+        for place, waiting_id in enumerate(waiting, 1):
+            if waiting_id == user_id:
+                return place
+        return None
+
+    async def _drain(self, key):
+        queue = self._queues[key]
+        # Whether the card is known to be claimed; only trusted within one burst.
+        taken = None
+        try:
+            while queue:
+                attempt = queue.popleft()
+                if attempt.future is not None:
+                    WAIT_SECONDS.observe(time.perf_counter() - attempt.queued, op=attempt.op)
+                self._deciding.add(key)
+                try:
+                    outcome, taken = await self._decide(key, attempt, taken)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as exc:
+                    logger.exception('Claim %s on %s failed', attempt.op, key)
+                    taken = None
+                    if attempt.future is not None and not attempt.future.done():
+                        attempt.future.set_exception(exc)
+                    continue
+                if attempt.future is not None:
+                    DECISION_SECONDS.observe(time.perf_counter() - attempt.queued, op=attempt.op)
+                    if not attempt.future.done():
+                        attempt.future.set_result(outcome)
+                self._announce()
+        finally:
+            self._deciding.discard(key)
+            self._announce()
+            del self._writers[key]
+            if queue:
+                self._writers[key] = asyncio.ensure_future(self._drain(key))
+            else:
+                del self._queues[key]
+
+    def _announce(self):
+        promoted, self._promoted = self._promoted, []
+        if self.on_promote is not None:
+            for args in promoted:
+                asyncio.ensure_future(self.on_promote(*args))
+
+    async def _decide(self, key, attempt, taken):
+        cat_id, card_id = key
+        if attempt.op == 'claim':
+            if taken:
+                return TAKEN, True
+            self.writes += 1
+            won = await self.storage.claim(cat_id, card_id, attempt.name)
+            return (WON if won else TAKEN), True
+        if attempt.op == 'unclaim':
+            self.writes += 1
+            if not await self.storage.unclaim(cat_id, card_id, attempt.name):
+                return REFUSED, taken
+            return RELEASED, await self._promote(key)
+        if attempt.op == 'promote':
+            if taken:
+                return None, True
+            card = await self.storage.get_card(cat_id, card_id)
+            if card is None or card.get('claimed_by') is not None:
+                return None, True
+            return None, await self._promote(key)
+        # join: take the card if it is free, otherwise wait in line for it.
+        card = await self.storage.get_card(cat_id, card_id)
+        if card is None or card.get('claimed_by') == attempt.name:
+            return REFUSED, taken
+        if card.get('claimed_by') is None and not await self._promote(key):
+            self.writes += 1
+            if await self.storage.claim(cat_id, card_id, attempt.name):
+                return WON, True
+        waiting = self.waitlists.setdefault(key, OrderedDict())
+        if attempt.user_id not in waiting and len(waiting) >= self.waitlist_size:
+            return FULL, True
+        waiting.setdefault(attempt.user_id, attempt.name)
+        return WAITING, True
+
+    async def _promote(self, key):
+        """Give a free card to the first user waiting for it; returns whether it is taken now."""
+        waiting = self.waitlists.get(key)
+        if not waiting:
+            self.waitlists.pop(key, None)
+            return False
+        user_id, name = next(iter(waiting.items()))
+        self.writes += 1
+        won = await self.storage.claim(*key, name)
+        if won:
+            del waiting[user_id]
+            if not waiting:
+                del self.waitlists[key]
+            logger.debug('Card %s promoted to waiting user %s', key, name)
+            self._promoted.append((*key, user_id, name))
+        return True
+
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import os
+import time
+
+import discord
+
+import metrics
+
+logger = logging.getLogger(__name__)
+MESSAGE_CALLS = metrics.counter(
+    'cardbot_claims_messages_total', 'Claims summary messages by action (edit, send, delete, unchanged).')
+PUBLISH_SECONDS = metrics.histogram(
+    'cardbot_claims_publish_seconds', 'Time taken to bring the claims summary up to date.')
+
+# Discord rejects message content longer than this.
+MESSAGE_LIMIT = 2000
+EMPTY_SUMMARY = 'No claims yet'
+
+
+def split_blocks(blocks, limit=MESSAGE_LIMIT):
+    """Pack ``(header, lines)`` blocks into message bodies of at most ``limit`` chars.
+
+    Categories stay together where possible; a category that does not fit in
+    one message continues in the next one under a repeated header.
+    """
+    messages = []
+    current = ''
+    for header, lines in blocks:
+        block = '\n'.join([header, *lines])
+        if current and len(current) + 2 + len(block) <= limit:
+            current += '\n\n' + block
+            continue
+        if current:
+            messages.append(current)
+            current = ''
+        if len(block) <= limit:
+            current = block
+            continue
+        # Too large for a single message: split the category by lines.
+        current = header
+        for line in lines:
+            line = line[:limit - len(header) - 10]
+            if len(current) + 1 + len(line) > limit:
+                messages.append(current)
+                current = f'{header} (cont.)'
+            current += '\n' + line
+    if current:
+        messages.append(current)
+    return messages or [EMPTY_SUMMARY]
+
+
+class ClaimsSummary:
+    """Incrementally maintained claims summary with coalesced message edits.
+
+    Claims and unclaims update an in-memory ``{category: {card: line}}``
+    map instead of re-walking the inventory. Publishing is debounced per
+    guild so a burst of claims results in at most one round of edits every
+    ``interval`` seconds, and the summary messages are edited through cached
+    partial messages rather than fetched first.
+    """
+
+    def __init__(self, storage, interval=None):
+        self.storage = storage
+        if interval is None:
+            interval = float(os.getenv('CLAIMS_EDIT_INTERVAL', '5'))
+        self.interval = interval
+        self._claims = {}
+        self._names = {}
+        self._blocks = {}
+        self._reloads = None
+        self._messages = {}
+        self._contents = {}
+        self._last_edit = {}
+        self._pending = {}
+        self._locks = {}
+
+    async def _sync(self):
+        """Rebuild the claim map if the store was reloaded since the last sync."""
+        store = self.storage.store
+        if self._reloads == store.reloads:
+            return
+        claimed = await self.storage.claimed_cards()
+        self._claims = {}
+        self._names = {}
+        self._blocks = {}
+        for cat, card in claimed:
+            self._names[cat['id']] = cat['name']
+            self._claims.setdefault(cat['id'], {})[card['id']] = self._line(card, card['claimed_by'])
+        self._reloads = store.reloads
+        logger.debug('Rebuilt claims summary with %s claims', len(claimed))
+
+    @staticmethod
+    def _line(card, user):
+        return f"{card['name']} - {user}"
+
+    def claimed(self, cat, card, user):
+        """Record a claim made through the bot."""
+        self._names[cat['id']] = cat['name']
+        self._claims.setdefault(cat['id'], {})[card['id']] = self._line(card, user)
+        self._blocks.pop(cat['id'], None)
+
+    def unclaimed(self, cat, card):
+        """Record an unclaim made through the bot."""
+        cards = self._claims.get(cat['id'], {})
+        cards.pop(card['id'], None)
+        if not cards:
+            self._claims.pop(cat['id'], None)
+        self._blocks.pop(cat['id'], None)
+
+    def render(self):
+        """Return the summary split into message-sized chunks."""
+        blocks = []
+        for cat_id, cards in self._claims.items():
+            block = self._blocks.get(cat_id)
+            if block is None:
+                block = self._blocks[cat_id] = (
+                    f'**{self._names.get(cat_id, cat_id)}**', list(cards.values()))
+            blocks.append(block)
+        return split_blocks(blocks)
+
+    def schedule(self, guild):
+        """Publish the summary for ``guild`` once the edit interval has passed."""
+        if guild is None or guild.id in self._pending:
+            return
+        delay = max(0.0, self._last_edit.get(guild.id, 0) + self.interval - time.monotonic())
+        self._pending[guild.id] = asyncio.create_task(self._publish_later(guild, delay))
+
+    async def _publish_later(self, guild, delay):
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self._pending.pop(guild.id, None)
+        try:
+            await self.publish(guild)
+        except discord.HTTPException:
+            logger.exception('Failed to update claims summary for guild %s', guild.id)
+
+    async def flush(self, get_guild):
+        """Publish every scheduled summary now; ``get_guild`` maps guild ids to guilds."""
+        for guild_id, task in list(self._pending.items()):
+            task.cancel()
+            guild = get_guild(guild_id)
+            if guild is None:
+                continue
+            try:
+                await self.publish(guild)
+            except discord.HTTPException:
+                logger.exception('Failed to update claims summary for guild %s', guild_id)
+
+    async def publish(self, guild):
+        """Bring the claims messages in ``guild`` up to date right away."""
+        lock = self._locks.setdefault(guild.id, asyncio.Lock())
+        async with lock:
+            with PUBLISH_SECONDS.time():
+                await self._publish(guild)
+
+    async def _publish(self, guild):
+        data = await self.storage.load()
+        settings = data.get('settings', {})
+        channel_id = settings.get('claims_channel_id')
+        if not channel_id:
+            return
+        channel = guild.get_channel(int(channel_id))
+        if not channel:
+            return
+        await self._sync()
+        chunks = self.render()
+        self._last_edit[guild.id] = time.monotonic()
+        ids = list(settings.get('claims_message_ids') or [])
+        if not ids and settings.get('claims_message_id'):
+            ids = [settings['claims_message_id']]
+        messages = self._messages.get(guild.id)
+        if messages is None or [str(m.id) for m in messages] != ids:
+            messages = [channel.get_partial_message(int(i)) for i in ids]
+        kept = []
+        for i, chunk in enumerate(chunks):
+            msg = messages[i] if i < len(messages) else None
+            if msg is not None:
+                if self._contents.get(msg.id) == chunk:
+                    MESSAGE_CALLS.inc(action='unchanged')
+                    kept.append(msg)
+                    continue
+                MESSAGE_CALLS.inc(action='edit')
+                try:
+                    await msg.edit(content=chunk)
+                except discord.NotFound:
+                    msg = None
+            if msg is None:
+                MESSAGE_CALLS.inc(action='send')
+                msg = await channel.send(chunk)
+            self._contents[msg.id] = chunk
+            kept.append(msg)
+        for msg in messages[len(chunks):]:
+            logger.debug('Removing surplus claims message %s', msg.id)
+            self._contents.pop(msg.id, None)
+            MESSAGE_CALLS.inc(action='delete')
+            try:
+                await msg.delete()
+            except discord.NotFound:
+                pass
+        self._messages[guild.id] = kept
+        new_ids = [str(m.id) for m in kept]
+        if new_ids != ids or settings.get('claims_message_id') != new_ids[0]:
+            # Only these keys; a full save could undo admin changes made meanwhile.
+            await self.storage.run(self.storage.store.update_section, 'settings', {
+                'claims_message_ids': new_ids, 'claims_message_id': new_ids[0]})
@@ -1,9 +1,29 @@
+import bisect
+import copy
+import hashlib
+import itertools
 import json
+import os
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 import logging
+try:
+    import fcntl
+except ModuleNotFoundError:  # pragma: no cover - Windows
+    fcntl = None
+    import msvcrt
+
+import events
+import metrics
 
 DATA_FILE = Path('data/inventory.json')
+DB_FILE = Path('data/inventory.db')
 logger = logging.getLogger(__name__)
+STORAGE_SECONDS = metrics.histogram(
+    'cardbot_storage_seconds', 'Time spent reading and writing the inventory backend.')
 
 
 DEFAULT_DATA = {
@@ -23,36 +43,1100 @@ DEFAULT_DATA = {
         "image_channel_id": "",
         "grid_size": 3,
         "claims_message_id": "",
+        "claims_message_ids": [],
     },
 }
 
 
-def load_data():
+def load_data(path=None):
     """Load inventory and embed configuration."""
-    logger.debug('Loading data from %s', DATA_FILE)
-    if DATA_FILE.exists():
+    path = Path(path) if path else DATA_FILE
+    logger.debug('Loading data from %s', path)
+    if path.exists():
         try:
-            with open(DATA_FILE) as f:
+            with open(path) as f:
                 data = json.load(f)
         except json.JSONDecodeError:
-            logger.error('Corrupted JSON in %s, backing up and resetting', DATA_FILE)
-            backup = DATA_FILE.with_suffix(DATA_FILE.suffix + '.bak')
-            DATA_FILE.rename(backup)
+            logger.error('Corrupted JSON in %s, backing up and resetting', path)
+            backup = path.with_suffix(path.suffix + '.bak')
+            path.rename(backup)
             logger.info('Moved bad file to %s', backup)
-            data = DEFAULT_DATA.copy()
+            data = copy.deepcopy(DEFAULT_DATA)
         for k, v in DEFAULT_DATA.items():
             if isinstance(v, dict):
                 data.setdefault(k, {})
                 for sk, sv in v.items():
                     data[k].setdefault(sk, sv)
             else:
-                data.setdefault(k, v)
+                data.setdefault(k, copy.deepcopy(v))
         return data
-    return DEFAULT_DATA.copy()
+    return copy.deepcopy(DEFAULT_DATA)
 
 
-def save_data(data):
-    logger.debug('Saving data to %s', DATA_FILE)
-    DATA_FILE.parent.mkdir(exist_ok=True)
-    with open(DATA_FILE, 'w') as f:
+def save_data(data, path=None):
+    """Write ``data`` to a temporary file and atomically rename it into place."""
+    path = Path(path) if path else DATA_FILE
+    logger.debug('Saving data to %s', path)
+    path.parent.mkdir(exist_ok=True)
+    tmp = path.with_suffix(path.suffix + '.tmp')
+    with open(tmp, 'w') as f:
         json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+_held_locks = threading.local()
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on ``<path>.lock`` shared by all processes.
+
+    Re-entrant within a thread, so a write can hold it from load to save.
+    """
+    lock_path = Path(str(path) + '.lock')
+    held = _held_locks.__dict__.setdefault('paths', {})
+    key = str(lock_path)
+    if key in held:
+        held[key] += 1
+        try:
+            yield
+        finally:
+            held[key] -= 1
+        return
+    lock_path.parent.mkdir(exist_ok=True)
+    with open(lock_path, 'a+b') as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        held[key] = 0
+        try:
+            yield
+        finally:
+            del held[key]
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class JsonBackend:
+    """Stores the whole inventory as one JSON document.
+
+    Every write rewrites the file, which is fine for small installs.
+    """
+
+    name = 'json'
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else None
+        self._lock = threading.RLock()
+
+    @property
+    def file(self):
+        return self.path or DATA_FILE
+
+    @contextmanager
+    def write_lock(self):
+        """Keep other threads and processes from writing until the block ends."""
+        with self._lock, file_lock(self.file):
+            yield
+
+    def stamp(self):
+        try:
+            st = self.file.stat()
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def load(self):
+        return load_data(self.file)
+
+    def save(self, data, stamp=None, changes=None):
+        with self._lock, file_lock(self.file):
+            save_data(data, self.file)
+            return self.stamp()
+
+    def set_claim(self, cat_id, card_id, user, expected, data=None, stamp=None):
+        """Set ``claimed_by`` to ``user`` if it currently equals ``expected``.
+
+        ``data``/``stamp`` are the caller's cached document; it is reused
+        when the file has not changed since. Returns ``(ok, data, stamp)``.
+        """
+        with self._lock, file_lock(self.file):
+            if data is None or stamp is None or stamp != self.stamp():
+                data = self.load()
+            card = _find_card(data, cat_id, card_id)
+            if card is None or card.get('claimed_by') != expected:
+                return False, data, self.stamp()
+            card['claimed_by'] = user
+            save_data(data, self.file)
+            return True, data, self.stamp()
+
+
+class SqliteBackend:
+    """Stores categories, cards and configuration in SQLite tables.
+
+    The database runs in WAL mode so the bot and the admin app can read
+    while the other writes, and a claim is a single conditional UPDATE.
+    """
+
+    name = 'sqlite'
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS categories (
+            id TEXT PRIMARY KEY,
+            position INTEGER NOT NULL,
+            name TEXT,
+            extra TEXT
+        );
+        CREATE TABLE IF NOT EXISTS cards (
+            category_id TEXT NOT NULL,
+            id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            name TEXT,
+            front TEXT,
+            back TEXT,
+            claimed_by TEXT,
+            extra TEXT,
+            PRIMARY KEY (category_id, id)
+        );
+        CREATE INDEX IF NOT EXISTS cards_position ON cards (category_id, position);
+        CREATE TABLE IF NOT EXISTS config (
+            section TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT,
+            PRIMARY KEY (section, key)
+        );
+        INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+    """
+    CARD_COLUMNS = ('id', 'name', 'front', 'back', 'claimed_by')
+
+    def __init__(self, path=None, json_path=None):
+        self.path = Path(path) if path else None
+        self.json_path = Path(json_path) if json_path else None
+        self._local = threading.local()
+
+    @property
+    def file(self):
+        return self.path or DB_FILE
+
+    @contextmanager
+    def write_lock(self):
+        """See :meth:`JsonBackend.write_lock`; claims do not take it as they update a single row."""
+        with file_lock(self.file):
+            yield
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            self.file.parent.mkdir(exist_ok=True)
+            conn = sqlite3.connect(self.file, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(self.SCHEMA)
+            self._local.conn = conn
+            self._migrate(conn)
+        return conn
+
+    def _migrate(self, conn):
+        """Import ``inventory.json`` the first time the database is opened."""
+        json_path = self.json_path or DATA_FILE
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            done = conn.execute("SELECT value FROM meta WHERE key = 'migrated'").fetchone()
+            if done or not json_path.exists():
+                conn.execute('COMMIT')
+                return
+            logger.info('Migrating %s into %s', json_path, self.file)
+            self._write(conn, load_data(json_path))
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+            conn.execute("INSERT INTO meta (key, value) VALUES ('migrated', 1)")
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def stamp(self):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return row[0]
+
+    def load(self):
+        conn = self._conn()
+        conn.execute('BEGIN')
+        try:
+            data = copy.deepcopy(DEFAULT_DATA)
+            for section, key, value in conn.execute('SELECT section, key, value FROM config'):
+                data.setdefault(section, {})[key] = json.loads(value)
+            cats = {}
+            for cat_id, name, extra in conn.execute(
+                    'SELECT id, name, extra FROM categories ORDER BY position'):
+                cat = {'id': cat_id, 'name': name}
+                cat.update(json.loads(extra or '{}'))
+                cat['cards'] = []
+                cats[cat_id] = cat
+                data['categories'].append(cat)
+            for row in conn.execute(
+                    'SELECT category_id, id, name, front, back, claimed_by, extra '
+                    'FROM cards ORDER BY category_id, position'):
+                card = dict(zip(self.CARD_COLUMNS, row[1:6]))
+                card.update(json.loads(row[6] or '{}'))
+                cat = cats.get(row[0])
+                if cat is not None:
+                    cat['cards'].append(card)
+        finally:
+            conn.execute('COMMIT')
+        return data
+
+    def save(self, data, stamp=None, changes=None):
+        """Write ``data``; returns the new stamp, or None if ``data`` was stale.
+
+        ``changes`` limits the write to the listed ``('config', section)``,
+        ``('category', cat_id)`` and ``('card', cat_id, card_id)`` rows
+        instead of the whole document. When someone else wrote since
+        ``stamp`` the stored claims may differ from ``data``, so the caller
+        has to reload.
+        """
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            before = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+            if changes is None:
+                self._write(conn, data)
+            else:
+                self._write_changes(conn, data, changes)
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return before + 1 if stamp == before else None
+
+    def _write(self, conn, data):
+        """Replace the stored document with ``data``.
+
+        Existing cards keep their stored ``claimed_by`` so a document loaded
+        before a concurrent claim cannot undo it.
+        """
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS keep_categories (id TEXT)')
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS keep_cards (category_id TEXT, id TEXT)')
+        conn.execute('DELETE FROM keep_categories')
+        conn.execute('DELETE FROM keep_cards')
+        for section in ('embed', 'settings'):
+            self._write_config(conn, data, section)
+        for pos, cat in enumerate(data.get('categories', [])):
+            conn.execute(
+                'INSERT INTO categories (id, position, name, extra) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (id) DO UPDATE SET position = excluded.position, '
+                'name = excluded.name, extra = excluded.extra',
+                (cat['id'], pos, cat.get('name'), self._category_extra(cat)))
+            rows = [(cat['id'], card['id'], i, *self._card_values(card))
+                    for i, card in enumerate(cat.get('cards', []))]
+            conn.executemany(
+                'INSERT INTO cards (category_id, id, position, name, front, back, '
+                'claimed_by, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (category_id, id) DO UPDATE SET position = excluded.position, '
+                'name = excluded.name, front = excluded.front, back = excluded.back, '
+                'extra = excluded.extra', rows)
+            conn.execute('INSERT INTO keep_categories (id) VALUES (?)', (cat['id'],))
+            conn.executemany('INSERT INTO keep_cards (category_id, id) VALUES (?, ?)',
+                             [row[:2] for row in rows])
+        conn.execute('DELETE FROM categories WHERE id NOT IN (SELECT id FROM keep_categories)')
+        conn.execute('DELETE FROM cards WHERE NOT EXISTS (SELECT 1 FROM keep_cards k '
+                     'WHERE k.category_id = cards.category_id AND k.id = cards.id)')
+
+    def _write_changes(self, conn, data, changes):
+        cats = {cat['id']: cat for cat in data.get('categories', [])}
+        cards = {}
+        for change in changes:
+            kind, cat_id = change[0], change[1]
+            if kind == 'config':
+                self._write_config(conn, data, cat_id)
+            elif kind == 'category':
+                cat = cats.get(cat_id)
+                if cat is None:
+                    conn.execute('DELETE FROM categories WHERE id = ?', (cat_id,))
+                    conn.execute('DELETE FROM cards WHERE category_id = ?', (cat_id,))
+                    continue
+                conn.execute(
+                    'INSERT INTO categories (id, position, name, extra) VALUES '
+                    '(?, (SELECT COALESCE(MAX(position), -1) + 1 FROM categories), ?, ?) '
+                    'ON CONFLICT (id) DO UPDATE SET name = excluded.name, extra = excluded.extra',
+                    (cat_id, cat.get('name'), self._category_extra(cat)))
+            elif kind == 'card':
+                card_id = change[2]
+                if cat_id not in cards:
+                    cards[cat_id] = {c['id']: c for c in cats.get(cat_id, {}).get('cards', [])}
+                card = cards[cat_id].get(card_id)
+                if card is None:
+                    conn.execute('DELETE FROM cards WHERE category_id = ? AND id = ?',
+                                 (cat_id, card_id))
+                    continue
+                conn.execute(
+                    'INSERT INTO cards (category_id, id, position, name, front, back, '
+                    'claimed_by, extra) VALUES (?, ?, (SELECT COALESCE(MAX(position), -1) + 1 '
+                    'FROM cards WHERE category_id = ?), ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (category_id, id) DO UPDATE SET name = excluded.name, '
+                    'front = excluded.front, back = excluded.back, extra = excluded.extra',
+                    (cat_id, card_id, cat_id, *self._card_values(card)))
+
+    def _write_config(self, conn, data, section):
+        conn.execute('DELETE FROM config WHERE section = ?', (section,))
+        conn.executemany(
+            'INSERT INTO config (section, key, value) VALUES (?, ?, ?)',
+            [(section, k, json.dumps(v)) for k, v in data.get(section, {}).items()])
+
+    @staticmethod
+    def _category_extra(cat):
+        return json.dumps({k: v for k, v in cat.items() if k not in ('id', 'name', 'cards')})
+
+    def _card_values(self, card):
+        return (card.get('name'), card.get('front'), card.get('back'), card.get('claimed_by'),
+                json.dumps({k: v for k, v in card.items() if k not in self.CARD_COLUMNS}))
+
+    def set_claim(self, cat_id, card_id, user, expected, data=None, stamp=None):
+        """Conditionally update one card row; see :meth:`JsonBackend.set_claim`.
+
+        ``data`` is handed back for the caller to patch when nobody else
+        wrote since ``stamp``, otherwise ``(ok, None, None)`` tells the
+        caller to reload.
+        """
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            before = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+            if expected is None:
+                cur = conn.execute(
+                    'UPDATE cards SET claimed_by = ? '
+                    'WHERE category_id = ? AND id = ? AND claimed_by IS NULL',
+                    (user, cat_id, card_id))
+            else:
+                cur = conn.execute(
+                    'UPDATE cards SET claimed_by = ? '
+                    'WHERE category_id = ? AND id = ? AND claimed_by = ?',
+                    (user, cat_id, card_id, expected))
+            ok = cur.rowcount == 1
+            if ok:
+                conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if data is None or stamp != before:
+            return ok, None, None
+        return ok, data, before + 1 if ok else before
+
+
+class JournalBackend:
+    """JSON snapshot plus an append-only journal of claim changes.
+
+    Claims and unclaims are appended to ``inventory.journal`` as one small
+    fsync'd line each instead of rewriting the snapshot. The current state
+    is the snapshot with the journal replayed on top; a claim record only
+    applies if the card is still in the expected state, so the journal order
+    decides races between processes. Once the journal grows past
+    ``compact_every`` records a background thread folds it into a new
+    snapshot that is atomically renamed into place.
+    """
+
+    name = 'journal'
+    compact_every = 500
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else None
+        self._data = None
+        self._generation = 0
+        self._offset = 0
+        self._records = 0
+        self._cards = {}
+        self._snap_stamp = None
+        self._compacting = False
+        self._lock = threading.RLock()
+
+    @property
+    def file(self):
+        return self.path or DATA_FILE
+
+    @property
+    def journal(self):
+        return self.file.with_suffix('.journal')
+
+    @contextmanager
+    def write_lock(self):
+        """See :meth:`JsonBackend.write_lock`."""
+        with self._lock, file_lock(self.file):
+            yield
+
+    def stamp(self):
+        try:
+            st = self.file.stat()
+            snap = st.st_mtime_ns, st.st_size
+        except FileNotFoundError:
+            snap = None
+        try:
+            size = self.journal.stat().st_size
+        except FileNotFoundError:
+            size = 0
+        return snap, size
+
+    def load(self):
+        with self._lock, file_lock(self.file):
+            self._catch_up()
+            return self._data
+
+    def save(self, data, stamp=None, changes=None):
+        """Write ``data`` as the new snapshot, folding in any journaled claims."""
+        with self._lock, file_lock(self.file):
+            self._catch_up()
+            if data is not self._data:
+                _merge_claims(data, self._data)
+                self._data = data
+            self._index()
+            self._write_snapshot()
+            return self.stamp()
+
+    def compact(self):
+        """Fold the journal into a fresh snapshot."""
+        try:
+            with self._lock, file_lock(self.file):
+                self._catch_up()
+                if self._records:
+                    logger.debug('Compacting %s journal records into %s',
+                                 self._records, self.file)
+                    self._write_snapshot()
+        finally:
+            self._compacting = False
+
+    def set_claim(self, cat_id, card_id, user, expected, data=None, stamp=None):
+        """Append a claim record; see :meth:`JsonBackend.set_claim`."""
+        with self._lock, file_lock(self.file):
+            before = self._data
+            applied = self._catch_up()
+            changed = applied or self._data is not before or data is not self._data
+            card = self._card(cat_id, card_id)
+            if card is None or card.get('claimed_by') != expected:
+                ok = False
+            else:
+                record = {'cat': cat_id, 'card': card_id, 'user': user, 'expected': expected}
+                line = (json.dumps(record) + '\n').encode()
+                with open(self.journal, 'ab') as f:
+                    if self._offset == 0:
+                        header = (json.dumps({'generation': self._generation}) + '\n').encode()
+                        f.write(header)
+                        self._offset += len(header)
+                    f.write(line)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._offset += len(line)
+                self._records += 1
+                card['claimed_by'] = user
+                ok = True
+            if self._records >= self.compact_every and not self._compacting:
+                self._compacting = True
+                threading.Thread(target=self.compact, daemon=True).start()
+            if changed:
+                return ok, None, None
+            return ok, self._data, self.stamp()
+
+    def _catch_up(self):
+        """Bring ``_data`` up to date; must hold the file lock.
+
+        Returns the number of journal records applied.
+        """
+        try:
+            st = self.file.stat()
+            snap = st.st_mtime_ns, st.st_size
+        except FileNotFoundError:
+            snap = None
+        if self._data is None or snap != self._snap_stamp:
+            self._data = load_data(self.file)
+            self._generation = self._data.get('journal_generation', 0)
+            self._snap_stamp = snap
+            self._offset = 0
+            self._records = 0
+            self._index()
+        try:
+            f = open(self.journal, 'rb')
+        except FileNotFoundError:
+            return 0
+        applied = 0
+        with f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # A crash mid-append left a torn record; drop it.
+                    logger.warning('Discarding torn journal record in %s', self.journal)
+                    os.truncate(self.journal, self._offset)
+                    break
+                self._offset += len(line)
+                record = json.loads(line)
+                if 'generation' in record:
+                    if record['generation'] != self._generation:
+                        # Left over from a compaction that crashed after the
+                        # snapshot was renamed; it is already folded in.
+                        os.truncate(self.journal, 0)
+                        self._offset = 0
+                        break
+                    continue
+                self._records += 1
+                card = self._card(record['cat'], record['card'])
+                if card is not None and card.get('claimed_by') == record['expected']:
+                    card['claimed_by'] = record['user']
+                    applied += 1
+        return applied
+
+    def _index(self):
+        self._cards = {(cat['id'], card['id']): card
+                       for cat in self._data.get('categories', [])
+                       for card in cat.get('cards', [])}
+
+    def _card(self, cat_id, card_id):
+        card = self._cards.get((cat_id, card_id))
+        if card is None:
+            card = _find_card(self._data, cat_id, card_id)
+        return card
+
+    def _write_snapshot(self):
+        self._generation += 1
+        self._data['journal_generation'] = self._generation
+        save_data(self._data, self.file)
+        with open(self.journal, 'wb') as f:
+            f.flush()
+            os.fsync(f.fileno())
+        st = self.file.stat()
+        self._snap_stamp = st.st_mtime_ns, st.st_size
+        self._offset = 0
+        self._records = 0
+
+
+BACKENDS = {
+    JsonBackend.name: JsonBackend,
+    SqliteBackend.name: SqliteBackend,
+    JournalBackend.name: JournalBackend,
+}
+
+
+def get_backend(name=None, directory=None):
+    """Create the backend selected by ``name`` or ``STORAGE_BACKEND``.
+
+    ``directory`` keeps the files there instead of in ``data/``.
+    """
+    name = (name or os.getenv('STORAGE_BACKEND', 'json')).lower()
+    try:
+        cls = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f'Unknown storage backend {name!r}') from None
+    if directory is None:
+        return cls()
+    directory = Path(directory)
+    if cls is SqliteBackend:
+        return cls(directory / DB_FILE.name, directory / DATA_FILE.name)
+    return cls(directory / DATA_FILE.name)
+
+
+def _allocate_id(owner, counter, items, taken):
+    """Return the next unused numeric id from ``owner[counter]``.
+
+    The counter is seeded from the highest numeric id in ``items`` and only
+    moves forward, so ids of deleted entries are never handed out again.
+    """
+    if counter not in owner:
+        owner[counter] = max((int(i['id']) for i in items if str(i['id']).isdigit()), default=0)
+    while True:
+        owner[counter] += 1
+        new_id = str(owner[counter])
+        if not taken(new_id):
+            return new_id
+
+
+def _merge_claims(data, source):
+    """Copy ``claimed_by`` for every card of ``data`` from ``source``."""
+    claims = {(cat['id'], card['id']): card.get('claimed_by')
+              for cat in source.get('categories', []) for card in cat.get('cards', [])}
+    for cat in data.get('categories', []):
+        for card in cat.get('cards', []):
+            key = (cat['id'], card['id'])
+            if key in claims:
+                card['claimed_by'] = claims[key]
+
+
+def _find_card(data, cat_id, card_id):
+    for cat in data.get('categories', []):
+        if cat['id'] == cat_id:
+            return next((c for c in cat.get('cards', []) if c['id'] == card_id), None)
+    return None
+
+
+class InventoryStore:
+    """Cached inventory document with lookup indexes.
+
+    The document is only re-read when the backend's stamp (file mtime and
+    size, or the SQLite version counter) changes, so repeated lookups from
+    the bot and the admin app avoid a full parse.
+    """
+
+    def __init__(self, backend=None):
+        self._backend = backend
+        self.data = None
+        self.version = 0
+        self.reloads = 0
+        self.categories = {}
+        self.category_versions = {}
+        self.cards = {}
+        self.claimed = {}
+        self.claimed_in = {}
+        self._names = {}
+        self._stamp = None
+        self._lock = threading.RLock()
+        # Called with (changes, stamp before, stamp after) after every write.
+        self.listeners = []
+
+    @property
+    def backend(self):
+        # Created lazily so STORAGE_BACKEND from .env is honoured.
+        if self._backend is None:
+            self._backend = get_backend()
+        return self._backend
+
+    def load(self):
+        """Return the cached document, re-reading it if storage changed."""
+        with self._lock:
+            stamp = self.backend.stamp()
+            if self.data is None or stamp is None or stamp != self._stamp:
+                with STORAGE_SECONDS.time(op='load', backend=self.backend.name):
+                    self.data = self.backend.load()
+                self._stamp = stamp
+                self._reindex()
+            return self.data
+
+    @contextmanager
+    def _writing(self):
+        """Hold this store's lock and the backend's write lock.
+
+        Writes read the document inside, so writers in other threads and
+        processes (admin app workers, the bot) never undo each other's changes.
+        """
+        with self._lock, self.backend.write_lock():
+            yield
+
+    def writing(self):
+        """Keep other writers out for a block, e.g. to check :meth:`etag` before a change."""
+        return self._writing()
+
+    def save(self, data=None):
+        """Persist ``data`` (or the cached document) and refresh the indexes."""
+        with self._writing():
+            if data is None:
+                data = self.data
+            stamp = self._stamp if data is self.data else None
+            with STORAGE_SECONDS.time(op='save', backend=self.backend.name):
+                self._stamp = self.backend.save(data, stamp)
+            self.data = data
+            self._reindex()
+            self._emit([('reload',)], stamp)
+
+    def etag(self):
+        """Opaque version of the stored inventory, shared by all processes."""
+        with self._lock:
+            self.load()
+            return hashlib.sha1(repr(self._stamp).encode()).hexdigest()[:16]
+
+    def _commit(self, changes):
+        """Persist only ``changes`` of the cached document; see :meth:`SqliteBackend.save`."""
+        before = self._stamp
+        with STORAGE_SECONDS.time(op='save', backend=self.backend.name):
+            self._stamp = self.backend.save(self.data, self._stamp, changes)
+        self._emit(changes, before)
+
+    def _emit(self, changes, before):
+        for listener in self.listeners:
+            try:
+                listener(changes, before, self._stamp)
+            except Exception:
+                logger.exception('Change listener failed')
+
+    def apply_changes(self, commits):
+        """Catch up with :class:`events.Commit` records written by another process.
+
+        When the commits account for every write since the cached copy, only
+        the categories they touch get a new version, so snapshots and page
+        layouts of the others stay valid. Returns the touched category ids,
+        or None if every category has to be treated as changed.
+        """
+        with self._lock:
+            categories = events.touched(commits)
+            stamp = self.backend.stamp()
+            if self.data is not None and stamp is not None and stamp == self._stamp:
+                return categories
+            expected = self._stamp
+            for commit in commits:
+                if commit.before != expected:
+                    categories = None
+                    break
+                expected = commit.after
+            if stamp is None or stamp != expected:
+                categories = None
+            with STORAGE_SECONDS.time(op='load', backend=self.backend.name):
+                self.data = self.backend.load()
+            self._stamp = stamp
+            self._reindex(categories)
+            return categories
+
+    def _touch(self, cat_id):
+        self.version += 1
+        self.category_versions[cat_id] = self.version
+        self._names.pop(cat_id, None)
+
+    def add_category(self, cat):
+        """Append ``cat``, giving it the next free id unless it has one."""
+        with self._writing():
+            self.load()
+            changes = []
+            if 'id' not in cat:
+                settings = self.data.setdefault('settings', {})
+                cat['id'] = _allocate_id(settings, 'next_category_id', self.data['categories'],
+                                         lambda i: i in self.categories)
+                changes.append(('config', 'settings'))
+            cat.setdefault('cards', [])
+            self.data['categories'].append(cat)
+            self._commit([('category', cat['id'])] + changes)
+            self._reindex()
+            return cat
+
+    def update_category(self, cat_id, fields):
+        """Update fields of a category; returns it, or None if it does not exist."""
+        with self._writing():
+            cat = self.get_category(cat_id)
+            if cat is None:
+                return None
+            cat.update(fields)
+            self._commit([('category', cat_id)])
+            self._touch(cat_id)
+            return cat
+
+    def update_categories(self, updates, sections=None):
+        """Apply ``{cat_id: fields}`` and ``{section: fields}`` with a single write.
+
+        Missing categories are skipped; returns the ids of the updated ones.
+        """
+        with self._writing():
+            self.load()
+            updated = [cat_id for cat_id in updates if cat_id in self.categories]
+            for cat_id in updated:
+                self.categories[cat_id].update(updates[cat_id])
+            for section, fields in (sections or {}).items():
+                self.data.setdefault(section, {}).update(fields)
+            changes = [('category', cat_id) for cat_id in updated]
+            changes += [('config', section) for section in sections or {}]
+            if changes:
+                self._commit(changes)
+            for cat_id in updated:
+                self._touch(cat_id)
+            if sections:
+                self.version += 1
+            return updated
+
+    def delete_category(self, cat_id):
+        with self._writing():
+            if self.get_category(cat_id) is None:
+                return False
+            self.data['categories'] = [c for c in self.data['categories'] if c['id'] != cat_id]
+            self._commit([('category', cat_id)])
+            self._reindex()
+            return True
+
+    def add_card(self, cat_id, card):
+        """Append ``card`` to a category; returns it, or None if the category is missing."""
+        cards = self.add_cards(cat_id, [card])
+        return cards and cards[0]
+
+    def add_cards(self, cat_id, cards):
+        """Append several cards with a single write; returns them, or None if the category is missing.
+
+        Cards without an ``id`` get the next free one.
+        """
+        with self._writing():
+            if self.get_category(cat_id) is None:
+                return None
+            self.upsert_cards({cat_id: cards})
+            return cards
+
+    def update_card(self, cat_id, card_id, fields):
+        """Update fields of a card; returns it, or None if it does not exist."""
+        return self.update_cards([(cat_id, card_id, fields)])[0]
+
+    def update_cards(self, updates):
+        """Apply ``(cat_id, card_id, fields)`` updates with a single write.
+
+        Returns the updated cards, with None for cards that do not exist.
+        """
+        return self.upsert_cards({}, updates)
+
+    def upsert_cards(self, added, updates=()):
+        """Add ``{cat_id: [card, ...]}`` and apply ``updates`` in one write.
+
+        Cards for missing categories are skipped. Returns the updated cards
+        as :meth:`update_cards` does.
+        """
+        with self._writing():
+            self.load()
+            changes = []
+            touched = set()
+            for cat_id, cards in added.items():
+                cat = self.categories.get(cat_id)
+                if cat is None:
+                    continue
+                existing = cat.setdefault('cards', [])
+                for card in cards:
+                    if 'id' not in card:
+                        card['id'] = _allocate_id(cat, 'next_card_id', existing,
+                                                  lambda i: (cat_id, i) in self.cards)
+                        touched.add(('category', cat_id))
+                    existing.append(card)
+                    self.cards[(cat_id, card['id'])] = card
+                    if card.get('claimed_by'):
+                        self.claimed[(cat_id, card['id'])] = (cat, card)
+                        self.claimed_in.setdefault(cat_id, {})[card['id']] = card
+                    changes.append(('card', cat_id, card['id']))
+            updated = []
+            for cat_id, card_id, fields in updates:
+                card = self.cards.get((cat_id, card_id))
+                if card is not None:
+                    card.update(fields)
+                    changes.append(('card', cat_id, card_id))
+                updated.append(card)
+            if changes:
+                self._commit(changes + sorted(touched))
+                for cat_id in {change[1] for change in changes}:
+                    self._touch(cat_id)
+            return updated
+
+    def delete_card(self, cat_id, card_id):
+        with self._writing():
+            if self.get_card(cat_id, card_id) is None:
+                return False
+            cat = self.categories[cat_id]
+            cat['cards'] = [c for c in cat['cards'] if c['id'] != card_id]
+            self._commit([('card', cat_id, card_id)])
+            self.cards.pop((cat_id, card_id), None)
+            self.claimed.pop((cat_id, card_id), None)
+            self.claimed_in.get(cat_id, {}).pop(card_id, None)
+            self._touch(cat_id)
+            return True
+
+    def update_section(self, section, fields):
+        """Update the ``embed`` or ``settings`` block and return it."""
+        with self._writing():
+            self.load()
+            block = self.data.setdefault(section, {})
+            block.update(fields)
+            self._commit([('config', section)])
+            self.version += 1
+            return block
+
+    def claim(self, cat_id, card_id, user):
+        """Claim a card for ``user``; returns False if it is already taken."""
+        return self._set_claim(cat_id, card_id, user, None)
+
+    def unclaim(self, cat_id, card_id, user):
+        """Release a card claimed by ``user``; returns False otherwise."""
+        return self._set_claim(cat_id, card_id, None, user)
+
+    def _set_claim(self, cat_id, card_id, user, expected):
+        with self._lock:
+            self.load()
+            with STORAGE_SECONDS.time(op='claim', backend=self.backend.name):
+                ok, data, stamp = self.backend.set_claim(
+                    cat_id, card_id, user, expected, self.data, self._stamp)
+            if data is None:
+                self._stamp = None
+            elif data is not self.data:
+                self.data = data
+                self._stamp = stamp
+                self._reindex()
+            else:
+                self._stamp = stamp
+                if ok:
+                    self._update_claim(cat_id, card_id, user)
+            return ok
+
+    def _update_claim(self, cat_id, card_id, user):
+        key = (cat_id, card_id)
+        card = self.cards.get(key)
+        if card is not None:
+            card['claimed_by'] = user
+        if user and card is not None:
+            self.claimed[key] = (self.categories[cat_id], card)
+            self.claimed_in.setdefault(cat_id, {})[card_id] = card
+        else:
+            self.claimed.pop(key, None)
+            self.claimed_in.get(cat_id, {}).pop(card_id, None)
+        # After the change; see _reindex.
+        self.version += 1
+        self.category_versions[cat_id] = self.version
+
+    def unload(self):
+        """Drop the cached document and indexes; the next access reads storage again."""
+        with self._lock:
+            self.data = None
+            self._stamp = None
+            self.categories = {}
+            self.category_versions = {}
+            self.cards = {}
+            self.claimed = {}
+            self.claimed_in = {}
+            self._names = {}
+
+    def _reindex(self, touched=None):
+        """Rebuild the indexes; categories not in ``touched`` keep their version.
+
+        The bot reads :attr:`categories` and :attr:`category_versions` on its
+        event loop without the lock, so the new indexes are built aside and
+        swapped in at once, versions last: whoever sees a new version also
+        sees the category it belongs to.
+        """
+        self.version += 1
+        self.reloads += 1
+        versions = self.category_versions if touched is not None else {}
+        touched = touched or ()
+        categories, category_versions, cards, claimed, claimed_in = {}, {}, {}, {}, {}
+        for cat in self.data.get('categories', []):
+            categories[cat['id']] = cat
+            if cat['id'] in touched or cat['id'] not in versions:
+                category_versions[cat['id']] = self.version
+            else:
+                category_versions[cat['id']] = versions[cat['id']]
+            in_cat = claimed_in[cat['id']] = {}
+            for card in cat.get('cards', []):
+                key = (cat['id'], card['id'])
+                cards[key] = card
+                if card.get('claimed_by'):
+                    claimed[key] = (cat, card)
+                    in_cat[card['id']] = card
+        self.categories, self.cards, self.claimed, self.claimed_in, self._names, \
+            self.category_versions = categories, cards, claimed, claimed_in, {}, category_versions
+        logger.debug('Indexed %s categories and %s cards (version %s)',
+                     len(self.categories), len(self.cards), self.version)
+
+    def get_category(self, cat_id):
+        with self._lock:
+            self.load()
+            return self.categories.get(cat_id)
+
+    def get_card(self, cat_id, card_id):
+        with self._lock:
+            self.load()
+            return self.cards.get((cat_id, card_id))
+
+    def claimed_cards(self):
+        """Return ``(category, card)`` pairs for every claimed card."""
+        with self._lock:
+            self.load()
+            return list(self.claimed.values())
+
+    def category_stats(self, cat_id):
+        """Return ``{'cards': n, 'claimed': m}`` for a category."""
+        with self._lock:
+            self.load()
+            cat = self.categories.get(cat_id)
+            if cat is None:
+                return {'cards': 0, 'claimed': 0}
+            return {'cards': len(cat.get('cards', [])),
+                    'claimed': len(self.claimed_in.get(cat_id, {}))}
+
+    def _name_index(self, cat_id):
+        """Sorted ``(lower-case name, position)`` pairs, built on first use."""
+        names = self._names.get(cat_id)
+        if names is None:
+            cards = self.categories[cat_id].get('cards', [])
+            names = self._names[cat_id] = sorted(
+                ((card.get('name') or '').lower(), i) for i, card in enumerate(cards))
+        return names
+
+    def query_categories(self, prefix='', offset=0, limit=50):
+        """Return ``(categories, total)`` whose name starts with ``prefix``."""
+        with self._lock:
+            self.load()
+            prefix = prefix.strip().lower()
+            cats = self.data.get('categories', [])
+            if prefix:
+                cats = [c for c in cats if (c.get('name') or '').lower().startswith(prefix)]
+            return cats[offset:offset + limit], len(cats)
+
+    def query_cards(self, cat_id, prefix='', status='', claimant='', offset=0, limit=50):
+        """Return ``(cards, total)`` for one page of a filtered category listing.
+
+        ``status`` is ``'claimed'``, ``'unclaimed'`` or empty. Name prefixes
+        use the per-category name index and the claim filters use the
+        claimed-card index, so the work is proportional to the matches
+        rather than to the size of the category.
+        """
+        with self._lock:
+            self.load()
+            cat = self.categories.get(cat_id)
+            if cat is None:
+                return [], 0
+            cards = cat.get('cards', [])
+            claimed = self.claimed_in.get(cat_id, {})
+            prefix = prefix.strip().lower()
+            claimant = claimant.strip().lower()
+            if claimant:
+                if status == 'unclaimed':
+                    return [], 0
+                matches = [c for c in claimed.values()
+                           if (c.get('claimed_by') or '').lower() == claimant
+                           and (c.get('name') or '').lower().startswith(prefix)]
+                return matches[offset:offset + limit], len(matches)
+            if prefix:
+                names = self._name_index(cat_id)
+                lo = bisect.bisect_left(names, (prefix,))
+                hi = bisect.bisect_left(names, (prefix + '\uffff',), lo)
+                matches = [cards[i] for _, i in names[lo:hi]]
+                if status:
+                    want = status == 'claimed'
+                    matches = [c for c in matches if bool(c.get('claimed_by')) == want]
+                return matches[offset:offset + limit], len(matches)
+            if status == 'claimed':
+                page = list(itertools.islice(claimed.values(), offset, offset + limit))
+                return page, len(claimed)
+            if status == 'unclaimed':
+                unclaimed = (c for c in cards if not c.get('claimed_by'))
+                page = list(itertools.islice(unclaimed, offset, offset + limit))
+                return page, len(cards) - len(claimed)
+            return cards[offset:offset + limit], len(cards)
+
+
+store = InventoryStore()
+
+
+def migrate_json_to_sqlite(json_path=None, db_path=None):
+    """Copy ``inventory.json`` into a SQLite database.
+
+    Cards that already exist in the database keep their stored claim.
+    """
+    backend = SqliteBackend(db_path, json_path)
+    data = load_data(json_path)
+    backend.save(data)
+    logger.info('Migrated %s categories into %s', len(data['categories']), backend.file)
+    return backend
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['migrate']:
+        migrate_json_to_sqlite(*sys.argv[2:4])
+        print('Migration complete.')
+    else:
+        print('Usage: python data_manager.py migrate [inventory.json] [inventory.db]')
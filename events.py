@@ -0,0 +1,370 @@
+"""Inventory change notifications between the admin app and the bot.
+
+``run.py`` owns a :class:`Hub` listening on a local socket (a named pipe on
+Windows) and passes its address and key to the children through
+``CARDBOT_EVENTS``/``CARDBOT_EVENTS_KEY``. Each process connects an
+:class:`EventClient`; the admin app publishes every commit of its
+:class:`data_manager.InventoryStore` and the hub forwards it to every other
+process that subscribed by listening (the bot). Admin app workers only
+publish and never read, so they must not be sent anything: a full socket
+buffer would block the hub. Messages are JSON, never pickles.
+
+A commit carries the store stamps before and after it, so the bot can tell
+whether the events explain every write since its own copy (then only the
+touched categories are invalidated) or whether it missed something and has
+to reload everything. :class:`ChangeWatcher` also polls the store, which
+covers processes started without ``run.py`` and lost events.
+"""
+import asyncio
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.connection import Client, Listener
+import logging
+
+logger = logging.getLogger(__name__)
+
+ADDRESS_ENV = 'CARDBOT_EVENTS'
+KEY_ENV = 'CARDBOT_EVENTS_KEY'
+POLL_INTERVAL = float(os.getenv('EVENTS_POLL_INTERVAL', '5'))
+# Events arriving within this window are applied together, e.g. during an import.
+DEBOUNCE = 0.5
+RECONNECT_DELAY = 5.0
+# First message of a client that wants to receive commits.
+SUBSCRIBE = b'{"subscribe": true}'
+
+# ``kind`` is 'category', 'card', 'config' or 'reload' (the whole document was replaced).
+Change = namedtuple('Change', 'kind category card section')
+# ``guild`` is the partition key of the store (see partitions.py), None for the shared one.
+Commit = namedtuple('Commit', 'changes before after guild')
+
+
+def change(entry):
+    """Turn a store change tuple such as ``('card', cat_id, card_id)`` into a :class:`Change`."""
+    kind = entry[0]
+    if kind == 'config':
+        return Change(kind, None, None, entry[1])
+    if kind == 'category':
+        return Change(kind, entry[1], None, None)
+    if kind == 'card':
+        return Change(kind, entry[1], entry[2], None)
+    return Change('reload', None, None, None)
+
+
+def _freeze(value):
+    """Stamps travel as JSON; turn their lists back into comparable tuples."""
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def encode(commit):
+    return json.dumps({
+        'changes': [list(c) for c in commit.changes],
+        'before': commit.before,
+        'after': commit.after,
+        'guild': commit.guild,
+    }).encode()
+
+
+def decode(payload):
+    msg = json.loads(payload)
+    return Commit([Change(*c) for c in msg['changes']], _freeze(msg['before']),
+                  _freeze(msg['after']), msg.get('guild'))
+
+
+def touched(commits):
+    """Category ids affected by ``commits``, or None if everything may have changed."""
+    categories = set()
+    for commit in commits:
+        for c in commit.changes:
+            if c.kind == 'reload':
+                return None
+            if c.category is not None:
+                categories.add(c.category)
+    return categories
+
+
+class Hub:
+    """Accepts local connections and forwards each message to every other subscriber."""
+
+    def __init__(self, authkey=None):
+        self.authkey = authkey or secrets.token_bytes(32)
+        self.listener = Listener(authkey=self.authkey)
+        self.connections = []
+        self.subscribers = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @property
+    def address(self):
+        return self.listener.address
+
+    def environ(self):
+        """Environment variables that let child processes connect."""
+        return {ADDRESS_ENV: self.address, KEY_ENV: self.authkey.hex()}
+
+    def start(self):
+        threading.Thread(target=self._accept, daemon=True, name='events-hub').start()
+        logger.info('Event hub listening on %s', self.address)
+        return self
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                if self._closed:
+                    return
+                logger.exception('Event hub failed to accept a connection')
+                continue
+            except Exception:
+                # Wrong key or garbage from an unrelated client.
+                logger.warning('Event hub rejected a connection', exc_info=True)
+                continue
+            with self._lock:
+                self.connections.append(conn)
+            threading.Thread(target=self._forward, args=(conn,), daemon=True,
+                             name='events-hub-conn').start()
+
+    def _forward(self, conn):
+        try:
+            while True:
+                payload = conn.recv_bytes()
+                if payload == SUBSCRIBE:
+                    with self._lock:
+                        self.subscribers.append(conn)
+                    continue
+                with self._lock:
+                    others = [c for c in self.subscribers if c is not conn]
+                for other in others:
+                    try:
+                        other.send_bytes(payload)
+                    except OSError:
+                        self._drop(other)
+        except (EOFError, OSError):
+            pass
+        finally:
+            self._drop(conn)
+
+    def _drop(self, conn):
+        with self._lock:
+            if conn in self.connections:
+                self.connections.remove(conn)
+            if conn in self.subscribers:
+                self.subscribers.remove(conn)
+        conn.close()
+
+    def close(self):
+        self._closed = True
+        self.listener.close()
+        with self._lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+            self.subscribers = []
+
+
+class EventClient:
+    """Connection of one process to the :class:`Hub`, if ``run.py`` started one.
+
+    :meth:`publish` never blocks the caller; messages are sent from a
+    background thread and dropped while the hub is unreachable, which the
+    receiving :class:`ChangeWatcher` notices by polling. Incoming commits
+    are passed to ``on_commit`` on the receiving thread.
+    """
+
+    def __init__(self, address=None, authkey=None, on_commit=None):
+        self.address = address or os.getenv(ADDRESS_ENV)
+        key = authkey or os.getenv(KEY_ENV)
+        self.authkey = bytes.fromhex(key) if isinstance(key, str) else key
+        self.on_commit = on_commit
+        self.conn = None
+        self._outbox = None
+        self._connect_lock = threading.Lock()
+        self._retry_at = 0
+        self._started = False
+
+    @property
+    def enabled(self):
+        return bool(self.address and self.authkey)
+
+    @property
+    def connected(self):
+        return self.conn is not None
+
+    def _connect(self):
+        with self._connect_lock:
+            if self.conn is not None or time.monotonic() < self._retry_at:
+                return self.conn
+            try:
+                conn = Client(self.address, authkey=self.authkey)
+                if self._started:
+                    conn.send_bytes(SUBSCRIBE)
+            except Exception:
+                logger.warning('Event hub at %s unavailable', self.address, exc_info=True)
+                self._retry_at = time.monotonic() + RECONNECT_DELAY
+                return None
+            self.conn = conn
+            logger.debug('Connected to event hub at %s', self.address)
+            return self.conn
+
+    def _disconnect(self, conn):
+        with self._connect_lock:
+            if self.conn is conn:
+                self.conn = None
+                self._retry_at = time.monotonic() + RECONNECT_DELAY
+        conn.close()
+
+    def publish(self, changes, before, after, guild=None):
+        """Queue one commit of ``changes`` (store change tuples) for the other processes."""
+        if not self.enabled:
+            return
+        commit = Commit([change(c) for c in changes], before, after, guild)
+        try:
+            payload = encode(commit)
+        except TypeError:
+            logger.debug('Cannot encode stamps %r/%r; sending a reload', before, after)
+            payload = encode(Commit([change(('reload',))], None, None, guild))
+        if self._outbox is None:
+            with self._connect_lock:
+                if self._outbox is None:
+                    self._outbox = queue.SimpleQueue()
+                    threading.Thread(target=self._send, daemon=True, name='events-send').start()
+        self._outbox.put(payload)
+
+    def _send(self):
+        while True:
+            payload = self._outbox.get()
+            conn = self._connect()
+            if conn is None:
+                continue
+            try:
+                conn.send_bytes(payload)
+            except OSError:
+                logger.warning('Lost connection to event hub')
+                self._disconnect(conn)
+
+    def listen(self):
+        """Subscribe to commits and receive them on a daemon thread, reconnecting as needed."""
+        if not self.enabled or self._started:
+            return
+        self._started = True
+        with self._connect_lock:
+            # Reconnect a connection opened by publish(), so it subscribes.
+            conn, self.conn = self.conn, None
+        if conn is not None:
+            conn.close()
+        threading.Thread(target=self._receive, daemon=True, name='events-client').start()
+
+    def _receive(self):
+        while True:
+            conn = self._connect()
+            if conn is None:
+                time.sleep(RECONNECT_DELAY)
+                continue
+            try:
+                while True:
+                    commit = decode(conn.recv_bytes())
+                    if self.on_commit is not None:
+                        self.on_commit(commit)
+            except (EOFError, OSError):
+                logger.warning('Lost connection to event hub')
+                self._disconnect(conn)
+            except Exception:
+                logger.exception('Bad message from event hub')
+                self._disconnect(conn)
+
+
+class ChangeWatcher:
+    """Applies inventory changes made by other processes inside the bot.
+
+    ``stores()`` returns ``{partition key: AsyncStore}`` for the partitions
+    the bot has loaded; commits for any other partition are ignored since
+    it is read fresh when first used. Commits from the hub are collected
+    for :data:`DEBOUNCE` seconds and applied with
+    :meth:`InventoryStore.apply_changes`, then ``on_change(key, categories)``
+    is awaited with the touched category ids, or None when everything has
+    to be assumed changed. Every :data:`POLL_INTERVAL` seconds the loaded
+    stores are also checked for reloads the events did not account for.
+    """
+
+    def __init__(self, stores, on_change, client=None, poll_interval=POLL_INTERVAL):
+        self.stores = stores
+        self.on_change = on_change
+        self.client = client or EventClient()
+        self.poll_interval = poll_interval
+        self.queue = None
+        self.tasks = []
+        self._seen = {}
+        self._loop = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self._seen = {key: storage.store.reloads for key, storage in self.stores().items()}
+        self.client.on_commit = self._received
+        self.client.listen()
+        self.tasks = [asyncio.ensure_future(self._consume()),
+                      asyncio.ensure_future(self._poll())]
+        return self.tasks
+
+    def _received(self, commit):
+        self._loop.call_soon_threadsafe(self.queue.put_nowait, commit)
+
+    async def _consume(self):
+        while True:
+            commits = [await self.queue.get()]
+            await asyncio.sleep(DEBOUNCE)
+            while not self.queue.empty():
+                commits.append(self.queue.get_nowait())
+            by_guild = {}
+            for commit in commits:
+                by_guild.setdefault(commit.guild, []).append(commit)
+            stores = self.stores()
+            for key, guild_commits in by_guild.items():
+                storage = stores.get(key)
+                if storage is None:
+                    continue
+                try:
+                    categories = await storage.run(storage.store.apply_changes, guild_commits)
+                    self._seen[key] = storage.store.reloads
+                    logger.debug('Applied %s change events to %s; categories %s',
+                                 len(guild_commits), key or 'the shared inventory',
+                                 'all' if categories is None else sorted(categories))
+                    await self.on_change(key, categories)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception('Could not apply change events')
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            stores = self.stores()
+            for key in set(self._seen) - set(stores):
+                del self._seen[key]
+            for key, storage in stores.items():
+                try:
+                    await storage.load()
+                    reloads = storage.store.reloads
+                    if key not in self._seen:
+                        self._seen[key] = reloads
+                    elif reloads != self._seen[key]:
+                        self._seen[key] = reloads
+                        logger.debug('Inventory %s reloaded without events; refreshing everything',
+                                     key or 'shared')
+                        await self.on_change(key, None)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception('Could not check the inventory for changes')
+
+    def stop(self):
+        self.client.on_commit = None
+        for task in self.tasks:
+            task.cancel()
@@ -0,0 +1,188 @@
+import asyncio
+import io
+import os
+import time
+from urllib.parse import parse_qs, urlsplit
+import logging
+
+import discord
+
+from publisher import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Discord allows at most 10 attachments per message.
+ATTACHMENTS_PER_MESSAGE = 10
+# Default upload limit for bots in servers without boosts.
+MAX_MESSAGE_BYTES = int(os.getenv('IMAGE_DUMP_MAX_BYTES', str(10 * 1024 * 1024)))
+INTERVAL = float(os.getenv('IMAGE_DUMP_INTERVAL', '60'))
+# Attachment URLs are signed and expire; refresh them this long beforehand.
+REFRESH_MARGIN = 6 * 3600
+FIELDS = ('front', 'back')
+
+
+def url_expiry(url):
+    """Unix time a signed attachment URL expires, or None if it does not."""
+    try:
+        return int(parse_qs(urlsplit(url).query)['ex'][0], 16)
+    except (KeyError, ValueError):
+        return None
+
+
+class ImageDumpPublisher:
+    """Re-hosts card images in the image dump channel so embeds can show them.
+
+    Local images (``/images/...`` and old ``/static/uploads/...`` paths) are
+    uploaded up to 10 per message. The attachment URL is stored on the
+    image store record, keyed by content hash, and on each card as
+    ``front_url``/``back_url``, so an image shared by many cards is only
+    uploaded once. URLs close to expiry are refreshed by re-fetching their
+    message. Requests are paced through a :class:`publisher.RateLimiter`.
+    """
+
+    def __init__(self, storage, images, limiter=None):
+        self.storage = storage
+        self.images = images
+        self.limiter = limiter or RateLimiter()
+        self.wake = asyncio.Event()
+        self.task = None
+        self._lock = asyncio.Lock()
+
+    def plan(self, data, now=None):
+        """Return ``(upload, refresh, updates)`` for the current inventory.
+
+        ``upload`` maps digests to records that still need uploading,
+        ``refresh`` maps message ids to the digests whose URLs expire soon,
+        and ``updates`` lists ``(cat_id, card_id, fields)`` for cards whose
+        recorded URL is missing or out of date. A recorded URL is cleared
+        when its side no longer points at an uploaded local image, e.g.
+        after an admin set an external URL.
+        """
+        now = now or time.time()
+        upload = {}
+        refresh = {}
+        updates = []
+        for cat in data.get('categories', []):
+            for card in cat.get('cards', []):
+                fields = {}
+                for field in FIELDS:
+                    record = self.images.resolve(card.get(field))
+                    published = record and record.get('published')
+                    if published is None:
+                        if card.get(f'{field}_url'):
+                            fields[f'{field}_url'] = None
+                        if record is not None:
+                            upload[record['digest']] = record
+                        continue
+                    expires = url_expiry(published['url'])
+                    if expires is not None and expires - now < REFRESH_MARGIN:
+                        refresh.setdefault(published['message_id'], set()).add(record['digest'])
+                    if card.get(f'{field}_url') != published['url']:
+                        fields[f'{field}_url'] = published['url']
+                if fields:
+                    updates.append((cat['id'], card['id'], fields))
+        return upload, refresh, updates
+
+    def batches(self, records):
+        """Group records into messages of at most 10 files and MAX_MESSAGE_BYTES."""
+        batch, size = [], 0
+        for record in records:
+            if record['size'] > MAX_MESSAGE_BYTES:
+                logger.warning('Image %s is too large to upload (%s bytes)',
+                               record['digest'], record['size'])
+                continue
+            if batch and (len(batch) == ATTACHMENTS_PER_MESSAGE
+                          or size + record['size'] > MAX_MESSAGE_BYTES):
+                yield batch
+                batch, size = [], 0
+            batch.append(record)
+            size += record['size']
+        if batch:
+            yield batch
+
+    async def publish(self, channel):
+        """Upload pending images to ``channel`` and record their URLs.
+
+        Returns ``{'uploaded': n, 'messages': n, 'refreshed': n, 'cards': n}``.
+        """
+        async with self._lock:
+            data = await self.storage.load()
+            upload, refresh, _ = await self.storage.run(self.plan, data)
+            counts = {'uploaded': 0, 'messages': 0, 'refreshed': 0, 'cards': 0}
+            for batch in self.batches(upload.values()):
+                await self.limiter.wait('send', channel.id)
+                files = await self.storage.run(self._files, batch)
+                msg = await channel.send(files=files)
+                published = self._published(msg, batch)
+                await self.storage.run(self.images.set_published, published)
+                counts['uploaded'] += len(published)
+                counts['messages'] += 1
+                logger.debug('Uploaded %s images in message %s', len(published), msg.id)
+            for message_id, digests in refresh.items():
+                await self.limiter.wait('fetch', channel.id)
+                try:
+                    msg = await channel.fetch_message(int(message_id))
+                except discord.NotFound:
+                    logger.debug('Image message %s vanished; images will be re-uploaded', message_id)
+                    published = {d: None for d in digests}
+                else:
+                    index = await self.storage.run(self.images.load)
+                    records = [r for r in index.values() if r['digest'] in digests]
+                    published = self._published(msg, records)
+                await self.storage.run(self.images.set_published, published)
+                counts['refreshed'] += len(published)
+            if counts['uploaded'] or counts['refreshed']:
+                data = await self.storage.load()
+            _, _, updates = await self.storage.run(self.plan, data)
+            if updates:
+                await self.storage.update_cards(updates)
+                counts['cards'] = len(updates)
+            logger.info('Image dump: %s', counts)
+            return counts
+
+    def _files(self, batch):
+        """Read the images of ``batch`` into attachments; runs on the storage thread.
+
+        A batch stays under ``MAX_MESSAGE_BYTES``, so sending it from memory
+        keeps the upload from reading the disk on the event loop.
+        """
+        return [discord.File(io.BytesIO(self.images.path(r).read_bytes()),
+                             filename=r['digest'][:16] + r['ext']) for r in batch]
+
+    def _published(self, msg, records):
+        urls = {a.filename: a.url for a in msg.attachments}
+        published = {}
+        for record in records:
+            url = urls.get(record['digest'][:16] + record['ext'])
+            if url is None:
+                logger.warning('Image %s missing from message %s', record['digest'], msg.id)
+                continue
+            published[record['digest']] = {
+                'url': url,
+                'channel_id': str(msg.channel.id),
+                'message_id': str(msg.id),
+            }
+        return published
+
+    def start(self, get_channel, interval=INTERVAL):
+        """Start :meth:`run` as a background task."""
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run(get_channel, interval))
+        return self.task
+
+    async def run(self, get_channel, interval=INTERVAL):
+        """Publish whenever woken via :attr:`wake`, or every ``interval`` seconds."""
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            try:
+                channel = await get_channel()
+                if channel is not None:
+                    await self.publish(channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Image dump failed')
@@ -0,0 +1,253 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from pathlib import Path
+import logging
+
+from werkzeug.utils import secure_filename
+
+from data_manager import file_lock, save_data
+
+try:
+    from PIL import Image
+except ModuleNotFoundError:  # pragma: no cover - optional dependency
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+IMAGE_DIR = Path('static/uploads')
+INDEX_FILE = Path('data/images.json')
+URL_PREFIX = '/images'
+THUMB_SIZE = 160
+EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.webp'}
+CHUNK = 64 * 1024
+
+
+class ImageStore:
+    """Content-addressed image files with a persistent index.
+
+    Each distinct image is stored once as ``<sha256><ext>`` no matter how
+    often or under which name it is uploaded. ``data/images.json`` lists the
+    images in upload order; it is kept in memory and only re-read when
+    another process changed it. Thumbnails are generated on first request
+    when Pillow is installed, otherwise the original is served.
+    """
+
+    def __init__(self, root=None, index=None, legacy_dir=None):
+        self.root = Path(root) if root else IMAGE_DIR
+        self.thumbs = self.root / 'thumbs'
+        self.index = Path(index) if index else INDEX_FILE
+        self.legacy_dir = Path(legacy_dir) if legacy_dir else self.root
+        self.images = {}
+        self._stamp = None
+        self._legacy = {}
+        self._lock = threading.RLock()
+
+    def _index_stamp(self):
+        try:
+            st = self.index.stat()
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def load(self):
+        """Return ``{digest: record}`` in upload order, re-reading the index only if it changed."""
+        with self._lock:
+            stamp = self._index_stamp()
+            if stamp is None and self._stamp is None and not self.images:
+                with file_lock(self.index):
+                    if self._index_stamp() is None:
+                        self._import_legacy()
+                stamp = self._index_stamp()
+            if stamp != self._stamp:
+                with open(self.index) as f:
+                    records = json.load(f).get('images', [])
+                self.images = {r['digest']: r for r in records}
+                self._stamp = stamp
+                logger.debug('Loaded image index with %s images', len(self.images))
+            return self.images
+
+    def _write_index(self):
+        save_data({'images': list(self.images.values())}, self.index)
+        self._stamp = self._index_stamp()
+
+    def _import_legacy(self):
+        """Index files uploaded before the store existed; they keep their URLs."""
+        self.images = {}
+        if self.legacy_dir.is_dir():
+            for path in sorted(self.legacy_dir.iterdir()):
+                if path.is_file() and path.suffix.lower() in EXTENSIONS:
+                    with open(path, 'rb') as f:
+                        record = self.write(f, path.name)
+                    self.images.setdefault(record['digest'], record)
+        self._write_index()
+        logger.info('Created image index with %s existing uploads', len(self.images))
+
+    def add(self, stream, filename):
+        """Store an uploaded file and return its record, or None if it is not an image.
+
+        Uploading the same bytes again returns the existing record.
+        """
+        record = self.write(stream, filename)
+        return record and self.register([record])[0]
+
+    def write(self, stream, filename):
+        """Hash ``stream`` into the store without indexing it; safe to call from many threads."""
+        ext = Path(secure_filename(filename or '')).suffix.lower()
+        if ext not in EXTENSIONS:
+            logger.debug('Rejected upload %s', filename)
+            return None
+        if ext == '.jpeg':
+            ext = '.jpg'
+        self.root.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: stream.read(CHUNK), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            digest = digest.hexdigest()
+            target = self.root / (digest + ext)
+            # Same name means same bytes, so an existing file can be kept as is.
+            if not target.exists():
+                os.replace(tmp, target)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return {'digest': digest, 'ext': ext, 'size': size, 'name': filename}
+
+    def register(self, records):
+        """Add records from :meth:`write` to the index in one write.
+
+        Returns the indexed record for each, which is the earlier one for duplicates.
+        """
+        with self._lock:
+            # Load first: building a missing index takes the file lock itself.
+            self.load()
+            with file_lock(self.index):
+                self.load()
+                result = []
+                added = 0
+                for record in records:
+                    existing = self.images.get(record['digest'])
+                    if existing is None:
+                        existing = self.images[record['digest']] = record
+                        added += 1
+                    result.append(existing)
+                if added:
+                    self._write_index()
+            logger.debug('Indexed %s images (%s new)', len(records), added)
+            return result
+
+    def discard(self, records):
+        """Delete the files of records from :meth:`write` that were never registered."""
+        with self._lock:
+            self.load()
+            with file_lock(self.index):
+                self.load()
+                for record in records:
+                    if record['digest'] not in self.images:
+                        try:
+                            os.remove(self.path(record))
+                        except FileNotFoundError:
+                            pass
+                        logger.debug('Discarded unused image %s', record['digest'])
+
+    def set_published(self, published):
+        """Record where images were re-hosted, as ``{digest: {'url': ..., ...}}``.
+
+        A value of None forgets the earlier upload.
+        """
+        with self._lock:
+            self.load()
+            with file_lock(self.index):
+                self.load()
+                for digest, info in published.items():
+                    record = self.images.get(digest)
+                    if record is None:
+                        continue
+                    if info is None:
+                        record.pop('published', None)
+                    else:
+                        record['published'] = info
+                self._write_index()
+
+    def resolve(self, url):
+        """Return the record for a local image URL, or None for anything else.
+
+        Files uploaded before the store existed are hashed on demand.
+        """
+        if not url:
+            return None
+        if url.startswith(URL_PREFIX + '/') and '/thumbs/' not in url:
+            return self.get(url[len(URL_PREFIX) + 1:])
+        if url.startswith('/' + self.legacy_dir.as_posix() + '/'):
+            path = self.legacy_dir / Path(url).name
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                return None
+            cached = self._legacy.get(path)
+            if cached is None or cached[0] != (st.st_mtime_ns, st.st_size):
+                digest = hashlib.sha256()
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(CHUNK), b''):
+                        digest.update(chunk)
+                cached = self._legacy[path] = ((st.st_mtime_ns, st.st_size), digest.hexdigest())
+            return self.load().get(cached[1])
+        return None
+
+    def get(self, name):
+        """Look up ``<digest><ext>`` as used in image URLs."""
+        record = self.load().get(Path(name).stem)
+        if record is None or record['digest'] + record['ext'] != name:
+            return None
+        return record
+
+    def path(self, record):
+        return self.root / (record['digest'] + record['ext'])
+
+    def url(self, record):
+        return f"{URL_PREFIX}/{record['digest']}{record['ext']}"
+
+    def thumb_url(self, url):
+        """Thumbnail URL for an image URL from this store; other URLs are returned unchanged."""
+        if url and url.startswith(URL_PREFIX + '/') and '/thumbs/' not in url:
+            return URL_PREFIX + '/thumbs/' + url[len(URL_PREFIX) + 1:]
+        return url
+
+    def thumbnail(self, record, size=THUMB_SIZE):
+        """Path of the cached thumbnail of ``record``, built on first use."""
+        path = self.thumbs / (record['digest'] + record['ext'])
+        if path.exists():
+            return path
+        if Image is None:
+            return self.path(record)
+        self.thumbs.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.thumbs, suffix=record['ext'])
+        os.close(fd)
+        try:
+            with Image.open(self.path(record)) as img:
+                img.thumbnail((size, size))
+                img.save(tmp, format=img.format)
+            os.replace(tmp, path)
+        except OSError:
+            logger.exception('Could not build thumbnail of %s', record['digest'])
+            return self.path(record)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        logger.debug('Built thumbnail of %s', record['digest'])
+        return path
+
+    def listing(self):
+        """Records newest first, for the uploads page."""
+        return list(reversed(self.load().values()))
+
+
+images = ImageStore()
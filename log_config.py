@@ -0,0 +1,109 @@
+"""Logging setup shared by ``app.py`` and ``bot.py``.
+
+Records are handed to an in-memory queue by the logging thread and written
+by a :class:`logging.handlers.QueueListener` thread, so a ``logger.debug``
+in a click handler or request never waits for the disk. Each process logs
+to its own file derived from ``DEBUG_LOG`` (``debug.log`` becomes
+``debug.bot.log`` and ``debug.app.log``), rotated by size or, with
+``LOG_ROTATE=midnight`` and friends, by time.
+
+``LOG_SAMPLE`` keeps only a fraction of the DEBUG records of noisy loggers,
+e.g. ``LOG_SAMPLE=bot=0.1,routing=0.05``. The rate of a logger applies to
+its children too; INFO and above are always kept.
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+from pathlib import Path
+
+FORMAT = '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(5 * 1024 * 1024)))
+BACKUPS = int(os.getenv('LOG_BACKUPS', '5'))
+
+listener = None
+
+
+def log_path(process, path=None):
+    """Per-process log file next to ``path`` (``DEBUG_LOG`` by default)."""
+    path = Path(path or os.getenv('DEBUG_LOG', 'debug.log'))
+    return path.with_name(f'{path.stem}.{process}{path.suffix or ".log"}')
+
+
+def parse_rates(spec):
+    """Turn ``'bot=0.1,routing=0.05'`` into ``{'bot': 0.1, 'routing': 0.05}``."""
+    rates = {}
+    for item in (spec or '').split(','):
+        name, sep, rate = item.strip().partition('=')
+        if not sep:
+            continue
+        try:
+            rates[name.strip()] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+class SampleFilter(logging.Filter):
+    """Drops all but a fraction of DEBUG records from the configured loggers."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self._resolved = {}
+
+    def rate(self, name):
+        rate = self._resolved.get(name)
+        if rate is None:
+            rate = 1.0
+            parts = name.split('.')
+            for i in range(len(parts), 0, -1):
+                prefix = '.'.join(parts[:i])
+                if prefix in self.rates:
+                    rate = self.rates[prefix]
+                    break
+            self._resolved[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or not self.rates:
+            return True
+        rate = self.rate(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+def file_handler(path):
+    """Rotating file handler configured from ``LOG_ROTATE``/``LOG_MAX_BYTES``/``LOG_BACKUPS``."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    when = os.getenv('LOG_ROTATE')
+    if when:
+        handler = logging.handlers.TimedRotatingFileHandler(
+            path, when=when, backupCount=BACKUPS, encoding='utf-8', delay=True)
+    else:
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=MAX_BYTES, backupCount=BACKUPS, encoding='utf-8', delay=True)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    return handler
+
+
+def configure(process):
+    """Route all logging of this process through a queue to its own rotating file.
+
+    Safe to call more than once; only the first call has an effect.
+    """
+    global listener
+    if listener is not None:
+        return listener
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    handler.addFilter(SampleFilter(parse_rates(os.getenv('LOG_SAMPLE'))))
+    root = logging.getLogger()
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    root.addHandler(handler)
+    listener = logging.handlers.QueueListener(records, file_handler(log_path(process)),
+                                              respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
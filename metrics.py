@@ -0,0 +1,213 @@
+"""Latency histograms and counters shared by the bot and the admin app.
+
+Each process records into the module level :data:`registry` and writes a
+snapshot of it to ``data/metrics/<process>.json`` every few seconds with
+:func:`export`: admin app workers through :func:`start_exporter`, the bot
+from its event loop, so a hung loop shows up as a stale export. The admin
+app's ``/metrics`` route renders its own registry together with every
+fresh snapshot in that directory in the Prometheus text format, labelled
+by ``process``.
+"""
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+import logging
+
+logger = logging.getLogger(__name__)
+
+METRICS_DIR = Path('data/metrics')
+EXPORT_INTERVAL = float(os.getenv('METRICS_INTERVAL', '10'))
+# Upper bounds in seconds; chosen around Discord's 3 second response deadline.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0)
+
+
+def _key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Counter:
+    """Monotonic count per label set."""
+
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[dict(key), value] for key, value in self.values.items()]
+
+
+class Histogram:
+    """Bucketed observations per label set, rendered as a Prometheus histogram."""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _key(labels)
+        with self._lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = {'counts': [0] * (len(self.buckets) + 1),
+                                            'sum': 0.0, 'count': 0}
+            entry['counts'][bisect.bisect_left(self.buckets, value)] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the ``with`` block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return [[dict(key), dict(entry, counts=list(entry['counts']))]
+                    for key, entry in self.values.items()]
+
+
+class Registry:
+    """Named metrics of one process."""
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, **kwargs)
+            return metric
+
+    def counter(self, name, help):
+        return self._get(Counter, name, help)
+
+    def histogram(self, name, help, buckets=BUCKETS):
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def snapshot(self):
+        """JSON-serialisable copy of every metric."""
+        result = {}
+        for metric in list(self.metrics.values()):
+            entry = {'type': metric.type, 'help': metric.help, 'values': metric.snapshot()}
+            if metric.type == 'histogram':
+                entry['buckets'] = list(metric.buckets)
+            result[metric.name] = entry
+        return result
+
+
+registry = Registry()
+counter = registry.counter
+histogram = registry.histogram
+
+
+def _labels(labels, **extra):
+    items = sorted(dict(labels, **extra).items())
+    if not items:
+        return ''
+    def escape(value):
+        return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in items) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(snapshots):
+    """Prometheus text exposition of ``{process: snapshot}``."""
+    merged = {}
+    for process, snapshot in snapshots.items():
+        for name, metric in snapshot.items():
+            entry = merged.setdefault(name, dict(metric, series=[]))
+            entry['series'].extend((process, labels, value) for labels, value in metric['values'])
+    lines = []
+    for name in sorted(merged):
+        metric = merged[name]
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for process, labels, value in metric['series']:
+            if metric['type'] == 'counter':
+                lines.append(f'{name}{_labels(labels, process=process)} {_number(value)}')
+                continue
+            total = 0
+            for bound, count in zip(metric['buckets'] + [float('inf')], value['counts']):
+                total += count
+                le = _labels(labels, process=process, le=_number(bound))
+                lines.append(f'{name}_bucket{le} {total}')
+            lines.append(f"{name}_sum{_labels(labels, process=process)} {_number(value['sum'])}")
+            lines.append(f"{name}_count{_labels(labels, process=process)} {value['count']}")
+    return '\n'.join(lines) + '\n'
+
+
+def export(process, directory=None):
+    """Write this process's snapshot for :func:`collect`."""
+    directory = Path(directory) if directory else METRICS_DIR
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f'{process}.json'
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        json.dump({'process': process, 'pid': os.getpid(), 'time': time.time(),
+                   'metrics': registry.snapshot()}, f)
+    os.replace(tmp, path)
+
+
+def start_exporter(process, interval=EXPORT_INTERVAL, directory=None):
+    """Call :func:`export` every ``interval`` seconds on a daemon thread."""
+    def run():
+        while True:
+            try:
+                export(process, directory)
+            except Exception:
+                logger.exception('Could not export metrics')
+            time.sleep(interval)
+    thread = threading.Thread(target=run, daemon=True, name=f'metrics-{process}')
+    thread.start()
+    return thread
+
+
+def collect(process, directory=None, max_age=None):
+    """Snapshots of this process and of every other process exported recently.
+
+    Snapshots older than three export intervals belong to processes that
+    stopped and are left out.
+    """
+    directory = Path(directory) if directory else METRICS_DIR
+    max_age = max_age or 3 * EXPORT_INTERVAL
+    snapshots = {}
+    for path in sorted(glob.glob(str(directory / '*.json'))):
+        try:
+            with open(path) as f:
+                exported = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        if exported.get('process') != process and time.time() - exported.get('time', 0) <= max_age:
+            snapshots[exported['process']] = exported['metrics']
+    snapshots[process] = registry.snapshot()
+    return snapshots
@@ -0,0 +1,102 @@
+"""Per-guild inventory partitions.
+
+With ``GUILD_PARTITIONS=1`` every guild has its own inventory, embed and
+settings in ``data/guilds/<guild id>/``, stored with the configured
+``STORAGE_BACKEND``. The guild named by ``PRIMARY_GUILD_ID`` keeps using
+``data/inventory.*``, so an existing shop can turn partitions on without
+migrating. Without partitions every guild shares that one inventory.
+
+Partitions are opened on first use. At most ``GUILD_CACHE_SIZE`` of them
+keep their document in memory; the least recently used one is unloaded
+and read again the next time its guild needs it.
+"""
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import logging
+
+from data_manager import InventoryStore, get_backend, store
+
+logger = logging.getLogger(__name__)
+
+GUILDS_DIR = Path('data/guilds')
+ENABLED = os.getenv('GUILD_PARTITIONS', '').lower() in ('1', 'true', 'yes')
+MAX_LOADED = int(os.getenv('GUILD_CACHE_SIZE', '100'))
+PRIMARY_GUILD = os.getenv('PRIMARY_GUILD_ID', '')
+
+
+class Partitions:
+    """Hands out the :class:`InventoryStore` of each guild; see the module docstring.
+
+    ``on_open`` callbacks receive ``(key, store)`` for each partition opened
+    and ``on_evict`` callbacks ``(key, store)`` for each one unloaded. The
+    key is the guild id as a string, or None for the shared inventory.
+    With ``unload_evicted`` off, :meth:`get` leaves unloading an evicted
+    store to its ``on_evict`` callbacks, e.g. to run it on a storage thread.
+    """
+
+    def __init__(self, default, root=None, enabled=ENABLED, max_loaded=MAX_LOADED,
+                 primary=PRIMARY_GUILD, unload_evicted=True):
+        self.default = default
+        self.root = Path(root) if root else GUILDS_DIR
+        self.enabled = enabled
+        self.max_loaded = max(1, max_loaded)
+        self.primary = str(primary or '')
+        self.unload_evicted = unload_evicted
+        self.stores = {}
+        self.on_open = []
+        self.on_evict = []
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, guild_id):
+        """Partition key of ``guild_id``; None stands for the shared inventory."""
+        if not self.enabled or guild_id is None or str(guild_id) == self.primary:
+            return None
+        return str(guild_id)
+
+    def get(self, guild_id):
+        """Store of ``guild_id``, opening its partition if needed."""
+        key = self.key(guild_id)
+        opened = evicted = None
+        with self._lock:
+            if key is None:
+                part = self.default
+            else:
+                part = self.stores.get(key)
+                if part is None:
+                    directory = self.root / os.path.basename(key)
+                    directory.mkdir(parents=True, exist_ok=True)
+                    part = opened = self.stores[key] = InventoryStore(get_backend(directory=directory))
+            self._loaded[key] = part
+            self._loaded.move_to_end(key)
+            if len(self._loaded) > self.max_loaded:
+                evicted = self._loaded.popitem(last=False)
+                self.stores.pop(evicted[0], None)
+        if opened is not None:
+            logger.debug('Opened inventory partition %s', key)
+            for callback in self.on_open:
+                callback(key, opened)
+        if evicted is not None:
+            if self.unload_evicted:
+                evicted[1].unload()
+            logger.debug('Evicted inventory partition %s', evicted[0])
+            for callback in self.on_evict:
+                callback(*evicted)
+        return part
+
+    def loaded(self):
+        """``{key: store}`` of the partitions currently held in memory."""
+        with self._lock:
+            return dict(self._loaded)
+
+    def guilds(self):
+        """Ids of every guild with a partition on disk, plus the primary guild."""
+        ids = {self.primary} if self.primary else set()
+        if self.enabled and self.root.is_dir():
+            ids.update(p.name for p in self.root.iterdir() if p.is_dir())
+        return sorted(ids)
+
+
+partitions = Partitions(store)
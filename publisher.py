@@ -0,0 +1,256 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import time
+
+import discord
+
+import metrics
+
+logger = logging.getLogger(__name__)
+RATE_LIMITED = metrics.counter(
+    'cardbot_rate_limit_waits_total', 'Discord requests that had to wait for the rate limiter.')
+RATE_LIMIT_SECONDS = metrics.histogram(
+    'cardbot_rate_limit_wait_seconds', 'Time Discord requests waited for the rate limiter.')
+
+# (requests, per seconds) for each route, applied per channel. These match
+# Discord's documented message limits closely enough to avoid 429s.
+ROUTE_LIMITS = {
+    'send': (5, 5.0),
+    'edit': (5, 5.0),
+    'delete': (5, 5.0),
+    'fetch': (5, 5.0),
+}
+
+
+class TokenBucket:
+    """Simple asyncio token bucket allowing ``capacity`` calls per ``per`` seconds."""
+
+    def __init__(self, capacity, per):
+        self.capacity = capacity
+        self.rate = capacity / per
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Take a token, returning how many seconds were spent waiting for it."""
+        started = time.monotonic()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return now - started
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """Hands out one token bucket per ``(route, channel)`` pair."""
+
+    def __init__(self, limits=None):
+        self.limits = limits or ROUTE_LIMITS
+        self._buckets = {}
+
+    async def wait(self, route, channel_id):
+        bucket = self._buckets.get((route, channel_id))
+        if bucket is None:
+            bucket = self._buckets[(route, channel_id)] = TokenBucket(*self.limits[route])
+        waited = await bucket.acquire()
+        if waited > 0.001:
+            RATE_LIMITED.inc(route=route)
+            RATE_LIMIT_SECONDS.observe(waited, route=route)
+
+
+def listing_digest(embed, view):
+    """Hash the rendered listing so unchanged ones can be skipped."""
+    payload = {
+        'embed': embed.to_dict(),
+        'components': [item.to_component_dict() for item in view.children],
+    }
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+class ListingPublisher:
+    """Publishes one listing message per category, idempotently.
+
+    Published listings are tracked in ``settings['listings']`` as
+    ``{category id: {channel_id, message_id, digest}}``. Each run diffs the
+    categories against that record: unchanged listings are left alone,
+    changed ones are edited in place, new categories are posted and
+    listings of deleted categories are removed. Requests are paced through
+    a :class:`RateLimiter`.
+    """
+
+    def __init__(self, limiter=None):
+        self.limiter = limiter or RateLimiter()
+
+    def plan(self, data, channel, render):
+        """Return the ``(action, cat_id, cat, listing)`` steps needed."""
+        listings = data.get('settings', {}).get('listings', {})
+        steps = []
+        for cat in data.get('categories', []):
+            listing = listings.get(cat['id'])
+            if listing is None and cat.get('message_id'):
+                # Posted before listings were tracked.
+                listing = {'channel_id': str(channel.id), 'message_id': str(cat['message_id'])}
+            embed, view = render(cat)
+            digest = listing_digest(embed, view)
+            if listing is None or listing['channel_id'] != str(channel.id):
+                if listing is not None:
+                    steps.append(('delete', cat['id'], cat, listing))
+                steps.append(('send', cat['id'], cat, {'digest': digest}))
+            elif listing.get('digest') != digest:
+                steps.append(('edit', cat['id'], cat, dict(listing, digest=digest)))
+        current = {cat['id'] for cat in data.get('categories', [])}
+        for cat_id, listing in listings.items():
+            if cat_id not in current:
+                steps.append(('delete', cat_id, None, listing))
+        return steps
+
+    async def publish(self, data, channel, render, get_channel=None, dry_run=False):
+        """Apply :meth:`plan` to ``channel`` and record the results in ``data``.
+
+        ``get_channel`` resolves channel ids of listings that live in a
+        different channel. Returns the executed steps; with ``dry_run``
+        nothing is sent and ``data`` is left untouched.
+        """
+        steps = self.plan(data, channel, render)
+        if dry_run:
+            return steps
+        settings = data.setdefault('settings', {})
+        listings = settings.setdefault('listings', {})
+        for action, cat_id, cat, listing in steps:
+            if action == 'delete':
+                target = channel
+                if listing['channel_id'] != str(channel.id):
+                    target = get_channel(int(listing['channel_id'])) if get_channel else None
+                if target is not None:
+                    await self.limiter.wait('delete', target.id)
+                    try:
+                        await target.get_partial_message(int(listing['message_id'])).delete()
+                    except discord.NotFound:
+                        pass
+                if listings.get(cat_id, {}).get('message_id') == listing['message_id']:
+                    del listings[cat_id]
+                if cat is not None:
+                    cat.pop('message_id', None)
+                continue
+            embed, view = render(cat)
+            msg = None
+            if action == 'edit':
+                await self.limiter.wait('edit', channel.id)
+                try:
+                    msg = channel.get_partial_message(int(listing['message_id']))
+                    await msg.edit(embed=embed, view=view)
+                except discord.NotFound:
+                    logger.debug('Listing for category %s vanished; reposting', cat_id)
+                    msg = None
+            if msg is None:
+                await self.limiter.wait('send', channel.id)
+                msg = await channel.send(embed=embed, view=view)
+            listings[cat_id] = {
+                'channel_id': str(channel.id),
+                'message_id': str(msg.id),
+                'digest': listing['digest'],
+            }
+            cat['message_id'] = msg.id
+        return steps
+
+
+def load_listings(store):
+    """Copy of the parts of the inventory that :meth:`ListingPublisher.publish` changes.
+
+    Publishing can take minutes; working on a copy keeps it from changing
+    the store's cached document while other writes go on, and
+    :func:`save_listings` stores only the results. Runs on the storage thread.
+    """
+    data = store.load()
+    settings = data.get('settings', {})
+    return {
+        'settings': dict(settings, listings=dict(settings.get('listings', {}))),
+        'embed': data.get('embed', {}),
+        'categories': [dict(cat) for cat in data.get('categories', [])],
+    }
+
+
+def save_listings(store, data, steps):
+    """Store the listing message ids of published ``steps`` in one write; runs on the storage thread."""
+    store.update_categories(
+        {cat_id: {'message_id': cat.get('message_id')} for _, cat_id, cat, _ in steps
+         if cat is not None},
+        {'settings': {'listings': data['settings'].get('listings', {})}})
+
+
+def summarize(steps):
+    """Count the steps of a plan by action, e.g. ``{'send': 2, 'edit': 1}``."""
+    counts = {'send': 0, 'edit': 0, 'delete': 0}
+    for action, *_ in steps:
+        counts[action] += 1
+    return counts
+
+
+class FakeMessage:
+    """Message stand-in recorded by :class:`FakeChannel`."""
+
+    def __init__(self, channel, message_id, **fields):
+        self.channel = channel
+        self.id = message_id
+        self.fields = fields
+
+    async def edit(self, **fields):
+        self.channel.calls.append(('edit', self.id))
+        if self.id not in self.channel.messages:
+            raise discord.NotFound(_FakeResponse(404), 'Unknown Message')
+        self.fields.update(fields)
+
+    async def delete(self):
+        self.channel.calls.append(('delete', self.id))
+        if self.channel.messages.pop(self.id, None) is None:
+            raise discord.NotFound(_FakeResponse(404), 'Unknown Message')
+
+
+class FakeAttachment:
+    def __init__(self, channel, message_id, filename):
+        self.filename = filename
+        self.url = (f'https://cdn.example/attachments/{channel.id}/{message_id}/{filename}'
+                    f'?ex={int(time.time()) + 86400:x}')
+
+
+class _FakeResponse:
+    def __init__(self, status):
+        self.status = status
+        self.reason = 'Fake'
+
+
+class FakeChannel:
+    """In-memory text channel for exercising publishers without Discord."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, channel_id=1):
+        self.id = channel_id
+        self.messages = {}
+        self.calls = []
+
+    async def send(self, content=None, **fields):
+        msg = FakeMessage(self, next(self._ids), content=content, **fields)
+        msg.attachments = [FakeAttachment(self, msg.id, f.filename)
+                           for f in fields.get('files', [])]
+        self.messages[msg.id] = msg
+        self.calls.append(('send', msg.id))
+        return msg
+
+    def get_partial_message(self, message_id):
+        msg = self.messages.get(message_id)
+        return msg if msg is not None else FakeMessage(self, message_id)
+
+    async def fetch_message(self, message_id):
+        try:
+            return self.messages[message_id]
+        except KeyError:
+            raise discord.NotFound(_FakeResponse(404), 'Unknown Message') from None
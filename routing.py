@@ -0,0 +1,41 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class InteractionRouter:
+    """Dispatch table from component ``custom_id`` to handler coroutine.
+
+    ``build(data)`` turns the inventory document into ``{custom_id: handler}``.
+    The table is only rebuilt when the store reloads the inventory, so a
+    click costs a dict lookup instead of parsing ids and scanning categories.
+    """
+
+    def __init__(self, storage, build, missing=None):
+        self.storage = storage
+        self.build = build
+        self.missing = missing
+        self.routes = {}
+        self._reloads = None
+
+    def install(self, routes):
+        """Use a table built elsewhere, e.g. while registering views at startup."""
+        self.routes = routes
+        self._reloads = self.storage.store.reloads
+        logger.debug('Installed %s interaction routes', len(routes))
+
+    async def refresh(self):
+        data = await self.storage.load()
+        if self._reloads != self.storage.store.reloads:
+            self.install(self.build(data))
+
+    async def dispatch(self, interaction):
+        custom_id = interaction.data.get('custom_id', '')
+        await self.refresh()
+        handler = self.routes.get(custom_id)
+        if handler is None:
+            logger.debug('No route for custom_id %s', custom_id)
+            if self.missing is not None:
+                await self.missing(interaction)
+            return
+        await handler(interaction)
@@ -1,31 +1,295 @@
+"""Start the admin app and the bot and keep them running.
+
+Each child is restarted when it exits or fails its health check, waiting
+1, 2, 4, ... up to ``MAX_RESTART_DELAY`` seconds between attempts; a child
+that ran for ``STABLE_AFTER`` seconds starts from 1 again. Health checks
+begin ``HEALTH_GRACE`` seconds after a start and run every
+``HEALTH_INTERVAL`` seconds. Each admin app worker must answer ``/healthz``
+on a private socket only it serves, and the bot must keep exporting metrics
+from its event loop; ``HEALTH_FAILURES`` misses in a row restart the child.
+
+``ADMIN_WORKERS`` admin app processes share one listening socket owned by
+this process (POSIX only), so a restarting worker never refuses
+connections. With ``FLASK_DEBUG`` a single development server binds its
+own socket and only has to answer ``/healthz``. Ctrl+C or SIGTERM drains every child (see serving.py and
+``bot.drain``) and kills whatever is still running after ``DRAIN_TIMEOUT``.
+Every ``REPORT_INTERVAL`` seconds the request throughput of each worker is
+logged.
+"""
+import functools
+import json
+import os
+import signal
+import socket
 import subprocess
 import sys
-import os
 import time
-import signal
+import urllib.request
+import logging
 from dotenv import load_dotenv # Add this line
 
+from events import Hub
+import log_config
+import metrics
+import serving
+
+logger = logging.getLogger('run')
+
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = float(os.getenv('MAX_RESTART_DELAY', '60'))
+STABLE_AFTER = 60.0
+HEALTH_INTERVAL = float(os.getenv('HEALTH_INTERVAL', '10'))
+HEALTH_GRACE = float(os.getenv('HEALTH_GRACE', '60'))
+HEALTH_FAILURES = int(os.getenv('HEALTH_FAILURES', '3'))
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', '20'))
+REPORT_INTERVAL = float(os.getenv('REPORT_INTERVAL', '60'))
+# Counted as "requests" in the throughput report.
+THROUGHPUT = {
+    'app': 'cardbot_admin_request_seconds',
+    'bot': 'cardbot_interaction_first_response_seconds',
+}
+
+
+def exported(process):
+    """Latest metrics export of ``process``, or None."""
+    try:
+        with open(metrics.METRICS_DIR / f'{process}.json') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def fresh_export(process):
+    snapshot = exported(process)
+    return snapshot is not None and time.time() - snapshot.get('time', 0) <= 3 * metrics.EXPORT_INTERVAL
+
+
+def http_ok(url):
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            return response.status == 200
+    except OSError:
+        return False
+
+
+class Child:
+    """One supervised process; see the module docstring."""
+
+    def __init__(self, name, script, env, check, pass_fds=()):
+        self.name = name
+        self.script = script
+        self.env = env
+        self.check = check
+        self.pass_fds = pass_fds
+        self.proc = None
+        self.started = 0.0
+        self.restart_at = 0.0
+        self.crashes = 0
+        self.misses = 0
+        self.next_check = 0.0
+        self.stopping_since = None
+
+    def start(self):
+        kwargs = {}
+        if os.name == 'nt':
+            # Lets stop() send CTRL_BREAK to this child only.
+            kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            # Keeps a Ctrl+C in the terminal from reaching the child before the drain.
+            kwargs['start_new_session'] = True
+            kwargs['pass_fds'] = self.pass_fds
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), self.script)
+        self.proc = subprocess.Popen([sys.executable, script], env=self.env, **kwargs)
+        self.started = time.monotonic()
+        self.next_check = self.started + HEALTH_GRACE
+        self.misses = 0
+        self.stopping_since = None
+        logger.info('Started %s (pid %s)', self.name, self.proc.pid)
+
+    def stop(self):
+        """Ask the child to drain and exit."""
+        if self.proc is None or self.proc.poll() is not None or self.stopping_since is not None:
+            return
+        self.stopping_since = time.monotonic()
+        try:
+            if os.name == 'nt':
+                self.proc.send_signal(signal.CTRL_BREAK_EVENT)
+            else:
+                # The whole session, including the debug server's reloaded child.
+                os.killpg(self.proc.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def kill(self):
+        try:
+            if os.name == 'nt':
+                self.proc.kill()
+            else:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def tick(self, now, stopping=False):
+        """Restart, health-check or kill the child as needed; returns whether it is running."""
+        if self.proc is None:
+            if not stopping and now >= self.restart_at:
+                self.start()
+            return self.proc is not None
+        code = self.proc.poll()
+        if code is not None:
+            self.proc = None
+            if not stopping:
+                self._exited(code, now)
+            return False
+        if self.stopping_since is not None:
+            if now - self.stopping_since > DRAIN_TIMEOUT + 5:
+                logger.warning('%s did not stop in time; killing it', self.name)
+                self.kill()
+            return True
+        if not stopping and now >= self.next_check:
+            self.next_check = now + HEALTH_INTERVAL
+            if self.check():
+                self.misses = 0
+            else:
+                self.misses += 1
+                logger.warning('%s failed its health check (%s/%s)',
+                               self.name, self.misses, HEALTH_FAILURES)
+                if self.misses >= HEALTH_FAILURES:
+                    self.stop()
+        return True
+
+    def _exited(self, code, now):
+        if now - self.started >= STABLE_AFTER:
+            self.crashes = 0
+        delay = min(MAX_RESTART_DELAY, RESTART_DELAY * 2 ** self.crashes)
+        self.crashes += 1
+        self.restart_at = now + delay
+        logger.warning('%s exited with code %s; restarting in %.0fs', self.name, code, delay)
+
+
+class ThroughputReport:
+    """Requests per second of each child since the previous report, from its metrics export."""
+
+    def __init__(self, children):
+        self.children = children
+        self.last = {}
+
+    def count(self, child):
+        snapshot = exported(child.name)
+        if snapshot is None:
+            return None, 0
+        metric = snapshot['metrics'].get(THROUGHPUT[child.name.split('-')[0]], {})
+        return snapshot.get('pid'), sum(entry['count'] for _, entry in metric.get('values', []))
+
+    def report(self, now):
+        parts = []
+        for child in self.children:
+            pid, count = self.count(child)
+            last_pid, last_count, last_time = self.last.get(child.name, (None, 0, now))
+            if pid != last_pid:
+                last_count = 0
+            if now > last_time:
+                parts.append(f'{child.name} {(count - last_count) / (now - last_time):.2f}/s')
+            self.last[child.name] = (pid, count, now)
+        if parts:
+            logger.info('Throughput: %s', ', '.join(parts))
+
+
+def admin_socket(host, port):
+    """Listening socket shared by the admin workers, or None where fds cannot be passed."""
+    if os.name == 'nt':
+        return None
+    sock = socket.create_server((host, port), backlog=128)
+    sock.set_inheritable(True)
+    return sock
+
+
+def health_socket():
+    """Private listening socket of one admin worker, on a free local port."""
+    sock = socket.create_server(('127.0.0.1', 0))
+    sock.set_inheritable(True)
+    return sock
+
+
 def main():
     load_dotenv() # Add this line to load .env file
+    log_config.configure('run')
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    logging.getLogger().addHandler(console)
     env = os.environ.copy()
     if not env.get('DISCORD_TOKEN'):
         print('Error: DISCORD_TOKEN not set. Check your .env file.')
         return
-    app_proc = subprocess.Popen([sys.executable, 'app.py'], env=env)
-    bot_proc = subprocess.Popen([sys.executable, 'bot.py'], env=env)
-    procs = [app_proc, bot_proc]
+    host = env.get('ADMIN_HOST', '127.0.0.1')
+    port = int(env.get('ADMIN_PORT', '5000'))
+    workers = max(1, int(env.get('ADMIN_WORKERS', '1')))
+    debug = serving.debug_mode(env)
+    if debug:
+        logger.info('FLASK_DEBUG is set; starting one development server')
+        workers, sock = 1, None
+    else:
+        sock = admin_socket(host, port)
+    if sock is None and workers > 1:
+        logger.warning('Several admin workers need a shared socket; starting one')
+        workers = 1
+    # Lets the admin app tell the bot about inventory changes right away.
+    hub = Hub().start()
+    env.update(hub.environ())
+    health_url = f"http://{'127.0.0.1' if host in ('0.0.0.0', '') else host}:{port}/healthz"
+
+    children = []
+    private = []
+    for n in range(1, workers + 1):
+        name = 'app' if workers == 1 else f'app-{n}'
+        child_env = dict(env)
+        if workers > 1:
+            child_env['ADMIN_WORKER'] = str(n)
+        pass_fds = ()
+        url = health_url
+        if sock is not None:
+            health = health_socket()
+            private.append(health)
+            child_env['ADMIN_FD'] = str(sock.fileno())
+            child_env['ADMIN_HEALTH_FD'] = str(health.fileno())
+            pass_fds = (sock.fileno(), health.fileno())
+            url = f'http://127.0.0.1:{health.getsockname()[1]}/healthz'
+        children.append(Child(name, 'app.py', child_env, functools.partial(http_ok, url), pass_fds))
+    children.append(Child('bot', 'bot.py', env, lambda: fresh_export('bot')))
+    report = ThroughputReport(children)
+
+    stopping = []
+
+    def request_stop(signum, frame):
+        if not stopping:
+            logger.info('Stopping; draining children for up to %.0fs', DRAIN_TIMEOUT)
+            stopping.append(signum)
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+    next_report = time.monotonic() + REPORT_INTERVAL
     try:
-        while all(p.poll() is None for p in procs):
+        while not stopping:
+            now = time.monotonic()
+            for child in children:
+                child.tick(now)
+            if now >= next_report:
+                report.report(now)
+                next_report = now + REPORT_INTERVAL
             time.sleep(0.5)
-    except KeyboardInterrupt:
-        for p in procs:
-            try:
-                p.send_signal(signal.SIGINT)
-            except Exception:
-                pass
+        for child in children:
+            child.stop()
+        while any(child.tick(time.monotonic(), stopping=True) for child in children):
+            time.sleep(0.2)
     finally:
-        for p in procs:
-            p.wait()
+        for child in children:
+            if child.proc is not None and child.proc.poll() is None:
+                child.kill()
+        hub.close()
+        for s in [sock, *private]:
+            if s is not None:
+                s.close()
+        logger.info('All processes stopped')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
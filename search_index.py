@@ -0,0 +1,140 @@
+import bisect
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Discord shows at most 25 autocomplete choices.
+MAX_RESULTS = 25
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class CardIndex:
+    """In-memory name index over every card in every category.
+
+    A sorted list of lower-cased names answers prefix queries with a
+    binary search, and a trigram table answers substring queries. Cards are
+    added, removed and re-flagged individually so claims and admin edits do
+    not require rebuilding the index.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self._sorted = []
+        self._trigrams = {}
+        self._reloads = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, cat, card):
+        key = (cat['id'], card['id'])
+        if key in self.entries:
+            self.remove(*key)
+        self._insert(cat, card)
+
+    def _insert(self, cat, card, keep_sorted=True):
+        key = (cat['id'], card['id'])
+        name = (card.get('name') or '').lower()
+        self.entries[key] = {
+            'name': card.get('name') or '',
+            'lower': name,
+            'category': cat.get('name') or '',
+            'claimed_by': card.get('claimed_by'),
+        }
+        if keep_sorted:
+            bisect.insort(self._sorted, (name, key))
+        else:
+            self._sorted.append((name, key))
+        for gram in _trigrams(name):
+            self._trigrams.setdefault(gram, set()).add(key)
+
+    def remove(self, cat_id, card_id):
+        key = (cat_id, card_id)
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        pos = bisect.bisect_left(self._sorted, (entry['lower'], key))
+        if pos < len(self._sorted) and self._sorted[pos] == (entry['lower'], key):
+            del self._sorted[pos]
+        for gram in _trigrams(entry['lower']):
+            keys = self._trigrams.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._trigrams[gram]
+
+    def set_claimed(self, cat_id, card_id, user):
+        entry = self.entries.get((cat_id, card_id))
+        if entry is not None:
+            entry['claimed_by'] = user
+
+    def sync(self, store):
+        """Apply the difference between the index and ``store`` after a reload."""
+        if self._reloads == store.reloads:
+            return
+        seen = set()
+        changed = []
+        for cat in list(store.categories.values()):
+            for card in cat.get('cards', []):
+                key = (cat['id'], card['id'])
+                seen.add(key)
+                entry = self.entries.get(key)
+                if (entry is None or entry['name'] != (card.get('name') or '')
+                        or entry['category'] != (cat.get('name') or '')):
+                    changed.append((cat, card))
+                else:
+                    entry['claimed_by'] = card.get('claimed_by')
+        removed = [k for k in self.entries if k not in seen]
+        for key in removed:
+            self.remove(*key)
+        for cat, card in changed:
+            self.remove(cat['id'], card['id'])
+        # Append everything and sort once rather than inserting one by one.
+        for cat, card in changed:
+            self._insert(cat, card, keep_sorted=False)
+        if changed:
+            self._sorted.sort()
+        self._reloads = store.reloads
+        logger.debug('Card index synced: %s changed, %s removed, %s total',
+                     len(changed), len(removed), len(self.entries))
+
+    def search(self, query, limit=MAX_RESULTS):
+        """Return up to ``limit`` keys, prefix matches first, then substring matches."""
+        query = query.strip().lower()
+        if not query:
+            return [key for _, key in self._sorted[:limit]]
+        results = []
+        pos = bisect.bisect_left(self._sorted, (query,))
+        while pos < len(self._sorted) and len(results) < limit:
+            name, key = self._sorted[pos]
+            if not name.startswith(query):
+                break
+            results.append(key)
+            pos += 1
+        if len(results) >= limit or len(query) < 3:
+            return results
+        grams = sorted((self._trigrams.get(g, set()) for g in _trigrams(query)), key=len)
+        if not grams or not grams[0]:
+            return results
+        found = set(results)
+        extra = []
+        # Stop at the first matches instead of ranking every candidate so
+        # common trigrams stay cheap on large catalogs.
+        for key in grams[0].intersection(*grams[1:]):
+            if key not in found and query in self.entries[key]['lower']:
+                extra.append(key)
+                if len(results) + len(extra) >= limit:
+                    break
+        extra.sort(key=lambda k: self.entries[k]['lower'])
+        return results + extra
+
+    def label(self, key):
+        """Human readable choice label, at most 100 characters."""
+        entry = self.entries[key]
+        label = f"{entry['name']} ({entry['category']})"
+        if entry['claimed_by']:
+            label += ' - claimed'
+        return label[:100]
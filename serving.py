@@ -0,0 +1,158 @@
+"""Production serving of the admin app.
+
+``python app.py`` serves the app with waitress when it is installed and
+with werkzeug's threaded server otherwise; ``FLASK_DEBUG=1`` keeps Flask's
+reloading development server. ``ADMIN_HOST``/``ADMIN_PORT`` pick the
+address and ``ADMIN_THREADS`` the request threads per worker. ``run.py``
+can start several workers sharing one listening socket, passed down as
+``ADMIN_FD``; each one is named ``app-<n>`` in logs and metrics. Each
+worker also serves a private socket of its own (``ADMIN_HEALTH_FD``), so
+``run.py`` can check the health of that worker rather than of whichever one
+accepts on the shared socket. In debug mode ``run.py`` starts a single app
+that binds its own socket.
+
+On SIGTERM (CTRL_BREAK on Windows) a worker drains: ``/healthz`` and new
+requests get 503, and the process exits once the requests in flight have
+finished or ``DRAIN_TIMEOUT`` seconds have passed.
+"""
+import _thread
+import os
+import signal
+import socket
+import threading
+import logging
+
+import metrics
+
+try:
+    from waitress import create_server
+except ModuleNotFoundError:  # pragma: no cover - optional dependency
+    create_server = None
+
+logger = logging.getLogger(__name__)
+
+HOST = os.getenv('ADMIN_HOST', '127.0.0.1')
+PORT = int(os.getenv('ADMIN_PORT', '5000'))
+THREADS = int(os.getenv('ADMIN_THREADS', '8'))
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', '20'))
+WORKER = os.getenv('ADMIN_WORKER')
+PROCESS = f'app-{WORKER}' if WORKER else 'app'
+
+
+class Drain:
+    """Counts requests in flight and turns new ones away once draining."""
+
+    def __init__(self):
+        self.active = 0
+        self.draining = False
+        self._cond = threading.Condition()
+
+    def enter(self):
+        with self._cond:
+            if self.draining:
+                return False
+            self.active += 1
+            return True
+
+    def leave(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def start(self):
+        with self._cond:
+            self.draining = True
+
+    def wait(self, timeout=DRAIN_TIMEOUT):
+        """Wait until no request is in flight; returns False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.active == 0, timeout)
+
+
+drain = Drain()
+
+
+def debug_mode(environ=os.environ):
+    """Whether ``FLASK_DEBUG`` asks for Flask's reloading development server."""
+    return environ.get('FLASK_DEBUG', 'false').lower() in ('1', 'true', 'yes')
+
+
+def install(app):
+    """Track the requests of ``app`` in :data:`drain`."""
+    from flask import g
+
+    @app.before_request
+    def admit():
+        if not drain.enter():
+            return 'Shutting down', 503, {'Retry-After': '5', 'Connection': 'close'}
+        g.admitted = True
+
+    @app.teardown_request
+    def release(exc=None):
+        if g.pop('admitted', False):
+            drain.leave()
+
+
+def _listen_socket(name):
+    fd = os.getenv(name)
+    if fd is None:
+        return None
+    return socket.socket(fileno=int(fd))
+
+
+def _stop_on_signal():
+    def stop(signum, frame):
+        if drain.draining:
+            return
+        logger.info('Draining %s requests before shutting down', drain.active)
+        drain.start()
+
+        def finish():
+            if not drain.wait():
+                logger.warning('Gave up waiting for %s requests', drain.active)
+            _thread.interrupt_main()
+
+        threading.Thread(target=finish, daemon=True, name='drain').start()
+
+    signal.signal(signal.SIGTERM, stop)
+    # Background processes may start with SIGINT ignored, which would also
+    # swallow the interrupt_main() ending the drain.
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    if hasattr(signal, 'SIGBREAK'):
+        signal.signal(signal.SIGBREAK, stop)
+
+
+def serve(app, host=HOST, port=PORT, threads=THREADS):
+    """Serve ``app`` until SIGTERM or Ctrl+C, then drain and return."""
+    sockets = [s for s in (_listen_socket('ADMIN_FD'), _listen_socket('ADMIN_HEALTH_FD')) if s]
+    if sockets:
+        host, port = sockets[0].getsockname()[:2]
+    if create_server is not None:
+        kwargs = {'sockets': sockets} if sockets else {'host': host, 'port': port}
+        server = create_server(app, threads=threads, **kwargs)
+        run, close, name = server.run, server.close, 'waitress'
+    else:
+        from werkzeug.serving import make_server
+        servers = [make_server(*s.getsockname()[:2], app, threaded=True, fd=s.fileno())
+                   for s in sockets] or [make_server(host, port, app, threaded=True)]
+        for extra in servers[1:]:
+            threading.Thread(target=extra.serve_forever, daemon=True, name='health-server').start()
+
+        def close():
+            for extra in servers[1:]:
+                extra.shutdown()
+            for server in servers:
+                server.server_close()
+
+        run, name = servers[0].serve_forever, 'werkzeug'
+    metrics.start_exporter(PROCESS)
+    _stop_on_signal()
+    logger.info('Serving admin app as %s on %s:%s with %s', PROCESS, host, port, name)
+    try:
+        run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        drain.start()
+        close()
+        logger.info('Admin app %s stopped', PROCESS)
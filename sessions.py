@@ -0,0 +1,127 @@
+import logging
+import sys
+import weakref
+
+logger = logging.getLogger(__name__)
+
+
+class _Record:
+    """Read-only record with attribute and ``record['key']`` access."""
+
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is read-only')
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+
+class CardRecord(_Record):
+    __slots__ = ('id', 'name', 'front', 'back', 'front_url', 'back_url', 'claimed_by')
+
+    def __init__(self, card):
+        for field in self.__slots__:
+            object.__setattr__(self, field, card.get(field))
+
+
+class CategorySnapshot(_Record):
+    """Immutable view of one category at a given version."""
+
+    __slots__ = ('id', 'name', 'cards', 'version', '_by_id')
+
+    def __init__(self, cat, version):
+        cards = tuple(CardRecord(c) for c in cat.get('cards', []))
+        object.__setattr__(self, 'id', cat['id'])
+        object.__setattr__(self, 'name', cat.get('name'))
+        object.__setattr__(self, 'cards', cards)
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, '_by_id', {c.id: c for c in cards})
+
+    def card(self, card_id):
+        return self._by_id.get(card_id)
+
+
+class SessionRegistry:
+    """Hands out shared, versioned category snapshots to open views.
+
+    Every ``ExploreView``/``CardView`` browsing a category holds the same
+    :class:`CategorySnapshot` instead of its own copy of the category. A new
+    snapshot is only built when the store reports a new version for that
+    category, and views swap to it via :meth:`current`.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._snapshots = {}
+        self._sessions = weakref.WeakSet()
+
+    def snapshot(self, cat_id):
+        """Return the latest snapshot of ``cat_id``, or None if it is gone."""
+        # The version first; see InventoryStore._reindex.
+        version = self.store.category_versions.get(cat_id)
+        snap = self._snapshots.get(cat_id)
+        if snap is not None and snap.version == version:
+            return snap
+        cat = self.store.categories.get(cat_id)
+        if cat is None:
+            self._snapshots.pop(cat_id, None)
+            return None
+        snap = self._snapshots[cat_id] = CategorySnapshot(cat, version)
+        logger.debug('Built snapshot of category %s at version %s', cat_id, version)
+        return snap
+
+    def current(self, snap):
+        """Return ``snap`` if still current, else the newer snapshot (or ``snap`` if deleted)."""
+        if self.store.category_versions.get(snap.id) == snap.version:
+            return snap
+        return self.snapshot(snap.id) or snap
+
+    def open(self, view):
+        """Track ``view`` until it is garbage collected."""
+        self._sessions.add(view)
+
+    def report(self):
+        """Summarize active sessions and the snapshot versions they hold."""
+        held = {}
+        for view in list(self._sessions):
+            snap = getattr(view, 'cat', None)
+            if isinstance(snap, CategorySnapshot):
+                held.setdefault(id(snap), [snap, 0])[1] += 1
+        categories = {}
+        total = 0
+        for snap, sessions in held.values():
+            size = _snapshot_size(snap)
+            total += size
+            entry = categories.setdefault(snap.id, {'versions': {}, 'sessions': 0})
+            entry['versions'][snap.version] = {'sessions': sessions, 'bytes': size}
+            entry['sessions'] += sessions
+        return {
+            'sessions': len(self._sessions),
+            'snapshots': len(held),
+            'bytes': total,
+            'categories': categories,
+        }
+
+
+def _snapshot_size(snap):
+    size = sys.getsizeof(snap) + sys.getsizeof(snap.cards) + sys.getsizeof(snap._by_id)
+    for card in snap.cards:
+        size += sys.getsizeof(card)
+    return size
+
+
+def format_report(report):
+    lines = [f"{report['sessions']} open views sharing {report['snapshots']} snapshots "
+             f"(~{report['bytes'] / 1024:.1f} KiB)"]
+    for cat_id, entry in report['categories'].items():
+        versions = ', '.join(f"v{v}: {info['sessions']} views"
+                             for v, info in sorted(entry['versions'].items()))
+        lines.append(f'Category {cat_id}: {versions}')
+    return '\n'.join(lines)
@@ -0,0 +1,97 @@
+// Send forms marked with data-api-url through the JSON API and update the
+// page in place. Without JavaScript the forms still post to the HTML routes.
+document.addEventListener('submit', async event => {
+  const form = event.target;
+  const url = form.dataset.apiUrl;
+  if (!url) return;
+  event.preventDefault();
+  const method = form.dataset.apiMethod || 'POST';
+  const init = {method, headers: {'Accept': 'application/json'}};
+  if (form.enctype === 'multipart/form-data') {
+    init.body = new FormData(form);
+  } else if (method !== 'DELETE') {
+    const body = {};
+    new FormData(form).forEach((value, key) => {
+      if (key !== 'action' && typeof value === 'string') body[key] = value;
+    });
+    init.headers['Content-Type'] = 'application/json';
+    init.body = JSON.stringify(body);
+  }
+  const button = form.querySelector('button[type="submit"]');
+  if (button) button.disabled = true;
+  try {
+    const response = await fetch(url, init);
+    if (!response.ok) throw new Error(response.status);
+    const data = response.status === 204 ? null : await response.json();
+    after[form.dataset.apiAfter || 'saved'](form, data);
+  } catch (err) {
+    status(form, 'Save failed (' + err.message + ')');
+  } finally {
+    if (button) button.disabled = false;
+  }
+});
+
+function status(form, text) {
+  let note = form.querySelector('.api-status');
+  if (!note) {
+    note = document.createElement('span');
+    note.className = 'api-status';
+    form.appendChild(note);
+  }
+  note.textContent = text;
+}
+
+function pollBatch(id) {
+  const note = document.getElementById('batch-status');
+  if (!note) return;
+  note.dataset.batch = id;
+  const poll = async () => {
+    const response = await fetch('/api/v1/batches/' + encodeURIComponent(id));
+    if (!response.ok) return;
+    const job = await response.json();
+    note.textContent = 'Batch ' + job.status + ': ' + job.done + ' of ' + job.total +
+      ' cards added' + (job.failed ? ', ' + job.failed + ' failed' : '');
+    if (job.status === 'queued' || job.status === 'running') {
+      setTimeout(poll, 1000);
+    } else if (job.done) {
+      window.location.reload();
+    }
+  };
+  poll();
+}
+
+document.addEventListener('DOMContentLoaded', () => {
+  const note = document.getElementById('batch-status');
+  if (note && note.dataset.batch && /queued|running/.test(note.textContent)) {
+    pollBatch(note.dataset.batch);
+  }
+});
+
+const after = {
+  saved(form) {
+    status(form, 'Saved');
+  },
+  batch(form, job) {
+    form.reset();
+    pollBatch(job.id);
+  },
+  remove(form) {
+    form.closest('li').remove();
+  },
+  'append-card'(form, card) {
+    const list = document.getElementById('card-list');
+    const template = document.getElementById('card-template');
+    if (!list || !template) return window.location.reload();
+    const item = template.content.firstElementChild.cloneNode(true);
+    item.querySelector('img').src = card.thumb || '';
+    item.querySelector('.card-name').textContent = card.name;
+    const remove = item.querySelector('form');
+    remove.dataset.apiUrl = form.dataset.apiUrl + '/' + encodeURIComponent(card.id);
+    remove.querySelector('input[name="card_id"]').value = card.id;
+    const empty = list.querySelector('.empty');
+    if (empty) empty.remove();
+    list.appendChild(item);
+    form.reset();
+    status(form, 'Added ' + card.name);
+  },
+};
@@ -0,0 +1,41 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from data_manager import BACKENDS, InventoryStore, get_backend, save_data  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Run every test in its own directory, so ``data/`` is never the real one."""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def bot(workdir, monkeypatch):
+    """The bot module, imported without a real token or log file."""
+    monkeypatch.setenv('DISCORD_TOKEN', 'test')
+    monkeypatch.setenv('DEBUG_LOG', str(workdir / 'debug.log'))
+    import bot
+    return bot
+
+
+@pytest.fixture(params=sorted(BACKENDS))
+def backend_name(request):
+    return request.param
+
+
+def drop_inventory(directory, cards=1):
+    """Write an inventory with one category of ``cards`` free cards to ``directory``."""
+    directory.mkdir(parents=True, exist_ok=True)
+    save_data({'categories': [{'id': '1', 'name': 'Drop', 'cards': [
+        {'id': str(i), 'name': f'Card {i}', 'front': '', 'back': '', 'claimed_by': None}
+        for i in range(cards)]}]}, directory / 'inventory.json')
+
+
+def open_store(backend_name, directory):
+    return InventoryStore(get_backend(backend_name, directory))
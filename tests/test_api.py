@@ -0,0 +1,78 @@
+import os
+from collections import OrderedDict
+import threading
+import time
+
+import pytest
+
+from conftest import drop_inventory
+from data_manager import InventoryStore, save_data
+
+
+@pytest.fixture
+def client(workdir, monkeypatch):
+    """A logged-in test client of the admin app, using ``data/`` in the test directory."""
+    monkeypatch.setenv('DEBUG_LOG', str(workdir / 'debug.log'))
+    import app
+    drop_inventory(workdir / 'data', cards=2)
+
+    def login():
+        client = app.app.test_client()
+        client.post('/', data={'password': os.getenv('ADMIN_PASSWORD', 'change-me')})
+        return client
+
+    return login
+
+
+def test_if_match_lets_one_of_two_concurrent_patches_through(client, monkeypatch):
+    first, second = client(), client()
+    etag = first.get('/api/v1/inventory').headers['ETag']
+    responses = []
+    others = []
+    update_card = InventoryStore.update_card
+
+    def slow_update_card(self, *args):
+        # The other request arrives while this one is about to write.
+        if not others:
+            other = threading.Thread(target=lambda: responses.append(second.patch(
+                '/api/v1/categories/1/cards/1', json={'name': 'B'}, headers={'If-Match': etag})))
+            others.append(other)
+            other.start()
+            time.sleep(0.2)
+        return update_card(self, *args)
+
+    monkeypatch.setattr(InventoryStore, 'update_card', slow_update_card)
+    responses.append(first.patch(
+        '/api/v1/categories/1/cards/0', json={'name': 'A'}, headers={'If-Match': etag}))
+    others[0].join()
+
+    assert sorted(r.status_code for r in responses) == [200, 412]
+
+
+def test_partitions_at_the_same_version_get_different_etags(client, workdir, monkeypatch):
+    import partitions
+    monkeypatch.setenv('STORAGE_BACKEND', 'sqlite')
+    monkeypatch.setattr(partitions.partitions, 'enabled', True)
+    monkeypatch.setattr(partitions.partitions, 'root', workdir / 'guilds')
+    monkeypatch.setattr(partitions.partitions, 'stores', {})
+    monkeypatch.setattr(partitions.partitions, '_loaded', OrderedDict())
+    admin = client()
+    etags = {}
+    for guild_id in ('111', '222'):
+        drop_inventory(workdir / 'guilds' / guild_id)
+        admin.post('/guild', data={'guild_id': guild_id})
+        admin.patch('/api/v1/categories/1/cards/0', json={'name': 'Renamed'})
+        etags[guild_id] = admin.get('/api/v1/inventory').headers['ETag']
+
+    admin.post('/guild', data={'guild_id': '222'})
+    response = admin.get('/api/v1/inventory', headers={'If-None-Match': etags['111']})
+    assert etags['111'] != etags['222']
+    assert response.status_code == 200
+
+
+def test_pagination_links_keep_per_page(client, workdir):
+    save_data({'categories': [{'id': str(i), 'name': f'Cat {i}', 'cards': []} for i in range(25)]},
+              workdir / 'data' / 'inventory.json')
+    page = client().get('/inventory?per_page=10&page=2').get_data(as_text=True)
+    assert 'page=1&amp;per_page=10' in page
+    assert 'page=3&amp;per_page=10' in page
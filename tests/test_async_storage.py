@@ -0,0 +1,20 @@
+import asyncio
+
+from async_storage import AsyncStore
+from conftest import drop_inventory, open_store
+
+
+def test_concurrent_claims_have_one_winner(backend_name, workdir):
+    # Several independent stores, each with its own worker thread, stand in
+    # for separate bot processes sharing the storage.
+    drop_inventory(workdir / 'shop')
+    storages = [AsyncStore(open_store(backend_name, workdir / 'shop')) for _ in range(4)]
+
+    async def race():
+        results = await asyncio.gather(
+            *(storages[i % 4].claim('1', '0', f'user{i}') for i in range(200)))
+        return results, await storages[0].get_card('1', '0')
+
+    results, card = asyncio.run(race())
+    assert results.count(True) == 1
+    assert card['claimed_by'] == f'user{results.index(True)}'
@@ -0,0 +1,57 @@
+import io
+import os
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+from batch_ingest import BatchIngest
+from data_manager import InventoryStore, JsonBackend, save_data
+from image_store import ImageStore
+
+
+def spool_job(spool_dir, job_id, pid):
+    spool = spool_dir / job_id
+    spool.mkdir(parents=True)
+    (spool / '000000').write_bytes(b'image')
+    save_data({'id': job_id, 'status': 'running', 'total': 10, 'done': 4, 'pid': pid},
+              spool / 'status.json')
+    return spool
+
+
+def test_jobs_of_exited_workers_are_interrupted(workdir):
+    exited = subprocess.Popen([sys.executable, '-c', 'pass'])
+    exited.wait()
+    spool = spool_job(workdir / 'batches', 'gone', exited.pid)
+    spool_job(workdir / 'batches', 'alive', os.getppid())
+
+    ingest = BatchIngest(None, None, workdir / 'batches')
+
+    assert ingest.status('gone')['status'] == 'interrupted'
+    assert [path.name for path in spool.iterdir()] == ['status.json']
+    assert BatchIngest(None, None, workdir / 'batches').status('gone')['done'] == 4
+    assert ingest.status('alive')['status'] == 'running'
+
+
+def upload(data, filename):
+    return SimpleNamespace(stream=io.BytesIO(data), filename=filename)
+
+
+def test_front_of_a_failed_pair_is_discarded(workdir):
+    inventory = InventoryStore(JsonBackend(workdir / 'inventory.json'))
+    inventory.add_category({'id': '1', 'name': 'Drop'})
+    images = ImageStore(workdir / 'images', workdir / 'images.json')
+    images.load()
+    ingest = BatchIngest(inventory, images, workdir / 'batches')
+    files = [upload(b'lonely', 'a.png'), upload(b'back', 'a.txt'),
+             upload(b'shared', 'b.png'), upload(b'back', 'b.txt'),
+             upload(b'shared', 'c.png'), upload(b'back', 'c.png')]
+
+    job = ingest.submit('1', ['A', 'B', 'C'], files)
+    while job.status in ('queued', 'running'):
+        time.sleep(0.01)
+
+    assert (job.done, job.failed) == (1, 2)
+    kept = {path.name for path in (workdir / 'images').iterdir()}
+    assert kept == {record['digest'] + '.png' for record in images.load().values()}
+    assert len(kept) == 2
@@ -0,0 +1,33 @@
+import asyncio
+from types import SimpleNamespace
+
+from conftest import drop_inventory, open_store
+from partitions import Partitions
+from publisher import FakeChannel
+
+
+def test_register_and_refresh_post_each_listing_once(bot, workdir, monkeypatch):
+    drop_inventory(workdir / 'data')
+    store = open_store('json', workdir / 'data')
+    store.update_section('settings', {'inventory_channel_id': '1'})
+    monkeypatch.setattr(bot, 'partitions', Partitions(store))
+    monkeypatch.setattr(bot, 'shops', {})
+    channel = FakeChannel(1)
+    monkeypatch.setattr(bot.bot, 'get_channel', lambda channel_id: channel)
+    guild = SimpleNamespace(id=10, get_channel=lambda channel_id: channel)
+
+    async def send(content):
+        pass
+
+    ctx = SimpleNamespace(guild=guild, channel=channel, author='admin', send=send)
+
+    async def scenario():
+        await bot.register(ctx)
+        store.add_category({'name': 'Second', 'cards': []})
+        await asyncio.gather(bot.register(ctx), bot.refresh_listings(bot.shop_for(guild)))
+
+    asyncio.run(scenario())
+
+    assert [action for action, _ in channel.calls].count('send') == 2
+    listings = open_store('json', workdir / 'data').load()['settings']['listings']
+    assert sorted(int(entry['message_id']) for entry in listings.values()) == sorted(channel.messages)
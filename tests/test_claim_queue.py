@@ -0,0 +1,84 @@
+import asyncio
+import random
+from types import SimpleNamespace
+
+from async_storage import AsyncStore
+from claim_queue import FULL, LIMITED, RELEASED, WAITING, WON, ClaimQueue, UserLimiter
+from conftest import drop_inventory, open_store
+
+
+def make_queue(backend_name, directory, cards=10, **kwargs):
+    drop_inventory(directory, cards)
+    return ClaimQueue(AsyncStore(open_store(backend_name, directory)), **kwargs)
+
+
+def users(n):
+    return [SimpleNamespace(id=i, name=f'user{i}') for i in range(n)]
+
+
+def test_drop_goes_to_first_click_per_card(backend_name, workdir):
+    queue = make_queue(backend_name, workdir / 'shop')
+    people = users(1000)
+    rnd = random.Random(1)
+
+    async def drop():
+        attempts = []
+        for _ in range(5000):
+            user, card_id = rnd.choice(people), str(rnd.randrange(10))
+            attempts.append((user, card_id, queue.submit('claim', '1', card_id, user)))
+        outcomes = await asyncio.gather(*(f for _, _, f in attempts))
+        return attempts, outcomes
+
+    attempts, outcomes = asyncio.run(drop())
+    first, winners = {}, {}
+    for (user, card_id, _), outcome in zip(attempts, outcomes):
+        if outcome != LIMITED:
+            first.setdefault(card_id, user.name)
+        if outcome == WON:
+            winners.setdefault(card_id, []).append(user.name)
+    assert LIMITED in outcomes
+    assert winners == {card_id: [name] for card_id, name in first.items()}
+    # Claims queued behind a decided one never reach storage.
+    assert queue.writes <= 3 * len(first)
+
+
+def test_release_promotes_first_waiting_user(backend_name, workdir):
+    queue = make_queue(backend_name, workdir / 'shop', cards=1, waitlist_size=2)
+    holder, first, second, third = users(4)
+
+    async def run():
+        assert await queue.submit('claim', '1', '0', holder) == WON
+        assert await queue.submit('join', '1', '0', first) == WAITING
+        assert await queue.submit('join', '1', '0', second) == WAITING
+        assert await queue.submit('join', '1', '0', third) == FULL
+        assert queue.position('1', '0', second.id) == 2
+        assert await queue.submit('unclaim', '1', '0', holder) == RELEASED
+        return await queue.storage.get_card('1', '0')
+
+    assert asyncio.run(run())['claimed_by'] == first.name
+    assert queue.position('1', '0', second.id) == 1
+
+
+def test_limiter_turns_away_click_spam():
+    limiter = UserLimiter(rate=2, per=10)
+    assert [limiter.allow(1, now=0) for _ in range(3)] == [True, True, False]
+    assert limiter.allow(2, now=0)
+    assert limiter.allow(1, now=5)
+
+
+def test_burst_on_one_card_records_queue_depth_and_wait(workdir, monkeypatch):
+    import claim_queue
+    depth = claim_queue.metrics.Histogram('depth', '', claim_queue.QUEUE_DEPTH.buckets)
+    wait = claim_queue.metrics.Histogram('wait', '')
+    monkeypatch.setattr(claim_queue, 'QUEUE_DEPTH', depth)
+    monkeypatch.setattr(claim_queue, 'WAIT_SECONDS', wait)
+    queue = make_queue('json', workdir / 'shop', cards=1)
+
+    async def burst():
+        return await asyncio.gather(*(queue.submit('claim', '1', '0', user) for user in users(5)))
+
+    assert asyncio.run(burst()).count(WON) == 1
+    ((_, entry),) = depth.values.items()
+    assert entry['count'] == 5 and entry['sum'] == 0 + 1 + 2 + 3 + 4
+    ((_, entry),) = wait.values.items()
+    assert entry['count'] == 5
@@ -0,0 +1,45 @@
+import asyncio
+from types import SimpleNamespace
+
+from async_storage import AsyncStore
+from claims_summary import ClaimsSummary, split_blocks
+from conftest import drop_inventory, open_store
+from publisher import FakeChannel
+
+
+class BusyChannel(FakeChannel):
+    """Lets the admin app change the settings while a message is being sent."""
+
+    def __init__(self, admin_store):
+        super().__init__(1)
+        self.admin_store = admin_store
+
+    async def send(self, content=None, **fields):
+        self.admin_store.update_section('settings', {'grid_size': 5})
+        return await super().send(content, **fields)
+
+
+def test_publish_keeps_admin_changes(backend_name, workdir):
+    drop_inventory(workdir / 'shop', cards=2)
+    admin_store = open_store(backend_name, workdir / 'shop')
+    admin_store.update_section('settings', {'claims_channel_id': '1'})
+    store = open_store(backend_name, workdir / 'shop')
+    store.claim('1', '0', 'user')
+    channel = BusyChannel(admin_store)
+    guild = SimpleNamespace(id=10, get_channel=lambda channel_id: channel)
+
+    asyncio.run(ClaimsSummary(AsyncStore(store), interval=0).publish(guild))
+
+    (msg,) = channel.messages.values()
+    assert msg.fields['content'] == '**Drop**\nCard 0 - user'
+    settings = open_store(backend_name, workdir / 'shop').load()['settings']
+    assert settings['grid_size'] == 5
+    assert settings['claims_message_ids'] == [str(msg.id)]
+
+
+def test_split_blocks_continues_long_categories():
+    lines = [f'Card {i} - user' for i in range(300)]
+    messages = split_blocks([('**Big**', lines)], limit=500)
+    assert all(len(m) <= 500 for m in messages)
+    assert messages[1].startswith('**Big** (cont.)')
+    assert sum(m.count(' - user') for m in messages) == 300
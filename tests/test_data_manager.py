@@ -0,0 +1,51 @@
+import multiprocessing
+import threading
+
+from conftest import open_store
+
+PROCESSES = 4
+THREADS = 4
+WRITES = 15
+
+
+def write_concurrently(backend_name, directory, worker, results):
+    store = open_store(backend_name, directory)
+
+    def run(thread):
+        owner = f'w{worker}-t{thread}'
+        claimed = []
+        for i in range(WRITES):
+            card = store.add_card('1', {'name': f'{owner}-{i}', 'front': '', 'back': '',
+                                        'claimed_by': None})
+            if store.claim('1', card['id'], owner):
+                claimed.append(card['id'])
+            store.update_section('settings', {owner: i})
+        results.put((owner, claimed))
+
+    pool = [threading.Thread(target=run, args=(t,)) for t in range(THREADS)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+
+
+def test_concurrent_writers_lose_nothing(backend_name, workdir):
+    # Several processes, like the admin app workers and the bot, each with
+    # several threads adding, claiming and configuring at once.
+    open_store(backend_name, workdir).add_category({'id': '1', 'name': 'Stress', 'cards': []})
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=write_concurrently,
+                                       args=(backend_name, workdir, w, results))
+               for w in range(PROCESSES)]
+    for w in workers:
+        w.start()
+    reports = [results.get(timeout=120) for _ in range(PROCESSES * THREADS)]
+    for w in workers:
+        w.join()
+
+    data = open_store(backend_name, workdir).load()
+    cards = {c['id']: c for c in data['categories'][0]['cards']}
+    assert len(cards) == PROCESSES * THREADS * WRITES
+    for owner, claimed in reports:
+        assert [cards[card_id]['claimed_by'] for card_id in claimed] == [owner] * len(claimed)
+        assert data['settings'][owner] == WRITES - 1
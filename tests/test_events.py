@@ -0,0 +1,38 @@
+import threading
+import time
+
+from events import EventClient, Hub
+
+COMMITS = 20000
+
+
+def test_commits_reach_listeners_past_silent_publishers():
+    # Admin app workers publish but never read; the hub must not send them
+    # anything or their full socket buffers would stall forwarding.
+    hub = Hub().start()
+    try:
+        address, key = hub.address, hub.authkey
+        received = []
+        done = threading.Event()
+
+        def on_commit(commit):
+            received.append(commit)
+            if commit.after == COMMITS:
+                done.set()
+
+        bot = EventClient(address, key, on_commit=on_commit)
+        bot.listen()
+        idle_worker = EventClient(address, key)
+        busy_worker = EventClient(address, key)
+        deadline = time.monotonic() + 10
+        while not received and time.monotonic() < deadline:
+            idle_worker.publish([('config', 'settings')], -1, 0)
+            time.sleep(0.05)
+        assert received, 'the listener never subscribed'
+        for i in range(COMMITS):
+            busy_worker.publish([('card', '1', str(i))], i, i + 1)
+        assert done.wait(30), f'only {len(received)} commits arrived'
+        cards = [c.changes[0].card for c in received if c.changes[0].kind == 'card']
+        assert cards == [str(i) for i in range(COMMITS)]
+    finally:
+        hub.close()
@@ -0,0 +1,104 @@
+import asyncio
+import io
+import threading
+
+import pytest
+
+import image_dump
+from async_storage import AsyncStore
+from conftest import open_store
+from image_dump import ImageDumpPublisher
+from image_store import ImageStore
+from publisher import FakeChannel, RateLimiter
+
+UNLIMITED = {route: (10 ** 6, 1.0) for route in ('send', 'edit', 'delete', 'fetch')}
+
+
+@pytest.fixture
+def shop(workdir):
+    """Twelve distinct images on 24 cards, each image shared by two cards."""
+    images = ImageStore(workdir / 'uploads', workdir / 'images.json')
+    records = [images.add(io.BytesIO(b'image %d' % i), f'{i}.png') for i in range(12)]
+    store = open_store('json', workdir / 'shop')
+    store.add_category({'id': '1', 'name': 'Drop', 'cards': [
+        {'id': str(i), 'name': f'Card {i}', 'front': images.url(records[i % 12]),
+         'back': images.url(records[(i + 1) % 12]), 'claimed_by': None}
+        for i in range(24)]})
+    storage = AsyncStore(store)
+    return store, images, ImageDumpPublisher(storage, images, RateLimiter(UNLIMITED))
+
+
+def publish(publisher, channel):
+    return asyncio.run(publisher.publish(channel))
+
+
+def test_uploads_ten_attachments_per_message(shop):
+    store, images, publisher = shop
+    channel = FakeChannel()
+    counts = publish(publisher, channel)
+    assert counts == {'uploaded': 12, 'messages': 2, 'refreshed': 0, 'cards': 24}
+    assert [len(m.attachments) for m in channel.messages.values()] == [10, 2]
+    urls = {a.url for m in channel.messages.values() for a in m.attachments}
+    for card in store.load()['categories'][0]['cards']:
+        assert card['front_url'] in urls and card['back_url'] in urls
+        assert card['front_url'] == images.resolve(card['front'])['published']['url']
+
+
+def test_skips_published_images(shop):
+    _, _, publisher = shop
+    channel = FakeChannel()
+    publish(publisher, channel)
+    calls = list(channel.calls)
+    counts = publish(publisher, channel)
+    assert counts == {'uploaded': 0, 'messages': 0, 'refreshed': 0, 'cards': 0}
+    assert channel.calls == calls
+
+
+def test_refreshes_expiring_urls(shop, monkeypatch):
+    store, images, publisher = shop
+    channel = FakeChannel()
+    publish(publisher, channel)
+    first, second = channel.messages
+    # Every URL now expires within the margin; one message is gone.
+    monkeypatch.setattr(image_dump, 'REFRESH_MARGIN', 2 * 86400)
+    for attachment in channel.messages[first].attachments:
+        attachment.url += '&fresh'
+    del channel.messages[second]
+    counts = publish(publisher, channel)
+    assert counts['refreshed'] == 12
+    assert counts['uploaded'] == 0
+    cards = store.load()['categories'][0]['cards']
+    refreshed = [c for c in cards if c['front_url'] and c['front_url'].endswith('&fresh')]
+    assert len(refreshed) == 20
+    # Images of the deleted message are uploaded again on the next run.
+    monkeypatch.setattr(image_dump, 'REFRESH_MARGIN', 0)
+    assert publish(publisher, channel)['uploaded'] == 2
+
+
+def test_clears_url_of_replaced_image(shop):
+    store, _, publisher = shop
+    publish(publisher, FakeChannel())
+    store.update_card('1', '0', {'front': 'https://example.com/new.png'})
+    assert publish(publisher, FakeChannel())['cards'] == 1
+    card = store.get_card('1', '0')
+    assert card['front_url'] is None
+    assert card['back_url']
+
+
+def test_reads_images_off_the_event_loop(shop, monkeypatch):
+    _, images, publisher = shop
+    on_loop = []
+    for name in ('load', 'path'):
+        method = getattr(images, name)
+
+        def watched(*args, method=method, name=name):
+            if threading.current_thread() is threading.main_thread():
+                on_loop.append(name)
+            return method(*args)
+
+        monkeypatch.setattr(images, name, watched)
+    channel = FakeChannel()
+    publish(publisher, channel)
+    monkeypatch.setattr(image_dump, 'REFRESH_MARGIN', 2 * 86400)
+    assert publish(publisher, channel)['refreshed'] == 12
+    assert on_loop == []
@@ -0,0 +1,35 @@
+import asyncio
+from types import SimpleNamespace
+
+from conftest import drop_inventory
+from partitions import Partitions
+from publisher import FakeChannel
+
+
+def test_evicting_a_shop_publishes_its_pending_summary(bot, workdir, monkeypatch):
+    for guild_id in ('111', '222'):
+        drop_inventory(workdir / 'guilds' / guild_id)
+    parts = Partitions(None, root=workdir / 'guilds', enabled=True, max_loaded=1,
+                       unload_evicted=False)
+    parts.on_evict.append(bot.drop_shop)
+    monkeypatch.setattr(bot, 'partitions', parts)
+    monkeypatch.setattr(bot, 'shops', {})
+    channel = FakeChannel(1)
+    guild = SimpleNamespace(id=111, get_channel=lambda channel_id: channel)
+    monkeypatch.setattr(bot.bot, 'get_guild', lambda guild_id: guild if guild_id == 111 else None)
+
+    async def scenario():
+        shop = bot.shop_for(111)
+        shop.store.update_section('settings', {'claims_channel_id': '1'})
+        shop.store.claim('1', '0', 'user')
+        shop.claims_summary.schedule(guild)
+        bot.shop_for(222)
+        assert 111 not in bot.shops and shop.store.data is not None
+        await asyncio.gather(*bot.closing)
+        return shop
+
+    shop = asyncio.run(scenario())
+
+    (msg,) = channel.messages.values()
+    assert msg.fields['content'] == '**Drop**\nCard 0 - user'
+    assert shop.store.data is None
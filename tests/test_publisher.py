@@ -0,0 +1,63 @@
+import asyncio
+
+import discord
+
+from conftest import drop_inventory, open_store
+from publisher import FakeChannel, ListingPublisher, RateLimiter, load_listings, save_listings
+
+UNLIMITED = {route: (10 ** 6, 1.0) for route in ('send', 'edit', 'delete', 'fetch')}
+
+
+def render(cat):
+    view = discord.ui.View(timeout=None)
+    view.add_item(discord.ui.Button(label='Explore', custom_id=f"explore_{cat['id']}"))
+    return discord.Embed(title=cat['name']), view
+
+
+def test_listings_keep_changes_made_while_publishing(backend_name, workdir):
+    drop_inventory(workdir / 'shop', cards=3)
+    bot_store = open_store(backend_name, workdir / 'shop')
+    admin_store = open_store(backend_name, workdir / 'shop')
+    publisher = ListingPublisher(RateLimiter(UNLIMITED))
+    channel = FakeChannel()
+
+    async def register():
+        data = load_listings(bot_store)
+        steps = await publisher.publish(data, channel, render)
+        # Publishing worked on a copy; the cached document is untouched.
+        assert not bot_store.load()['settings'].get('listings')
+        # Meanwhile the admin app adds a card and somebody claims one.
+        admin_store.add_card('1', {'name': 'New', 'front': '', 'back': '', 'claimed_by': None})
+        assert bot_store.claim('1', '0', 'user')
+        save_listings(bot_store, data, steps)
+        return steps
+
+    steps = asyncio.run(register())
+    assert [action for action, *_ in steps] == ['send']
+    data = open_store(backend_name, workdir / 'shop').load()
+    cat = data['categories'][0]
+    assert [card['name'] for card in cat['cards']] == ['Card 0', 'Card 1', 'Card 2', 'New']
+    assert cat['cards'][0]['claimed_by'] == 'user'
+    message_id = next(iter(channel.messages))
+    assert cat['message_id'] == message_id
+    assert data['settings']['listings']['1']['message_id'] == str(message_id)
+
+
+def test_listings_are_saved_in_one_write(backend_name, workdir):
+    drop_inventory(workdir / 'shop')
+    store = open_store(backend_name, workdir / 'shop')
+    for n in range(2, 5):
+        store.add_category({'id': str(n), 'name': f'Drop {n}'})
+    channel = FakeChannel()
+    data = load_listings(store)
+    steps = asyncio.run(ListingPublisher(RateLimiter(UNLIMITED)).publish(data, channel, render))
+    saves = []
+    save = store.backend.save
+    store.backend.save = lambda *args: saves.append(args) or save(*args)
+
+    save_listings(store, data, steps)
+
+    assert len(saves) == 1
+    data = open_store(backend_name, workdir / 'shop').load()
+    assert sorted(cat['message_id'] for cat in data['categories']) == sorted(channel.messages)
+    assert len(data['settings']['listings']) == 4
@@ -0,0 +1,47 @@
+import sys
+import threading
+
+from conftest import drop_inventory, open_store
+from sessions import SessionRegistry
+
+
+def loaded_store(workdir, cards):
+    drop_inventory(workdir / 'shop', cards=cards)
+    store = open_store('json', workdir / 'shop')
+    store.load()
+    return store
+
+
+def test_snapshots_stay_consistent_while_the_store_reindexes(workdir):
+    store = loaded_store(workdir, cards=50)
+    sessions = SessionRegistry(store)
+    done = threading.Event()
+    reindexed = []
+
+    def reindex():
+        while not done.is_set():
+            with store._lock:
+                store._reindex()
+            reindexed.append(None)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    thread = threading.Thread(target=reindex)
+    thread.start()
+    try:
+        snaps = []
+        while len(reindexed) < 5000:
+            snaps.append(sessions.snapshot('1'))
+    finally:
+        done.set()
+        thread.join()
+        sys.setswitchinterval(interval)
+
+    assert all(snap is not None and snap.version is not None for snap in snaps)
+    assert all(len(snap.cards) == 50 for snap in snaps)
+
+
+def test_snapshot_finds_cards_by_id(workdir):
+    snap = SessionRegistry(loaded_store(workdir, cards=3)).snapshot('1')
+    assert snap.card('2').name == 'Card 2'
+    assert snap.card('3') is None
@@ -0,0 +1,82 @@
+import logging
+from collections import OrderedDict, namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Discord rejects button labels longer than this.
+LABEL_LIMIT = 80
+
+Page = namedtuple('Page', 'cards labels has_prev has_next')
+
+
+class CategoryLayout:
+    """Card pages of one category for a given grid size, built lazily."""
+
+    def __init__(self, cards, grid_size):
+        self.cards = cards
+        self.grid_size = grid_size
+        self.per_page = grid_size * grid_size
+        self._pages = {}
+
+    @property
+    def page_count(self):
+        return max(1, -(-len(self.cards) // self.per_page))
+
+    def page(self, number):
+        page = self._pages.get(number)
+        if page is None:
+            start = number * self.per_page
+            cards = tuple(self.cards[start:start + self.per_page])
+            page = self._pages[number] = Page(
+                cards=cards,
+                labels=tuple(card['name'][:LABEL_LIMIT] for card in cards),
+                has_prev=number > 0,
+                has_next=start + self.per_page < len(self.cards),
+            )
+        return page
+
+
+class PageLayouts:
+    """LRU cache of :class:`CategoryLayout` keyed by category, version and grid size.
+
+    ``version`` should change whenever the inventory structure is reloaded
+    so stale layouts are never handed out.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._layouts = OrderedDict()
+
+    def get(self, cat, version, grid_size):
+        key = (cat['id'], version, grid_size)
+        layout = self._layouts.get(key)
+        if layout is None or layout.cards is not cat['cards']:
+            layout = self._layouts[key] = CategoryLayout(cat['cards'], grid_size)
+            if len(self._layouts) > self.maxsize:
+                self._layouts.popitem(last=False)
+        else:
+            self._layouts.move_to_end(key)
+        return layout
+
+
+class EmbedFactory:
+    """Memoizes category embeds until the embed configuration changes."""
+
+    def __init__(self, build):
+        self.build = build
+        self._config = None
+        self._embeds = {}
+
+    def __call__(self, cat, config=None):
+        config = config or {}
+        key = tuple(sorted(config.items()))
+        if key != self._config:
+            if self._config is not None:
+                logger.debug('Embed config changed; dropping %s cached embeds', len(self._embeds))
+            self._embeds.clear()
+            self._config = key
+        # The category name is the only per-category input to the embed.
+        embed = self._embeds.get(cat['name'])
+        if embed is None:
+            embed = self._embeds[cat['name']] = self.build(cat, config)
+        return embed